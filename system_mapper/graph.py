@@ -4,9 +4,17 @@
 Cloud application domain mapping.
 """
 # Standard library imports
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import hashlib
+from itertools import islice
 import json
 import sys
 import logging
+import re
+import threading
+import time
 
 # Third-party imports
 from neomodel import (
@@ -16,7 +24,351 @@ from neomodel import (
 from system_mapper.config import CONFIG
 
 
+# Default number of rows sent in each bulk write query
+DEFAULT_BATCH_SIZE = 500
+
+# Default number of write operations committed in each transaction
+DEFAULT_COMMIT_SIZE = 10000
+
+# Default milliseconds after which the open transaction is committed
+DEFAULT_COMMIT_INTERVAL = 5000
+
+# Default seconds to wait for the indexes to be online
+DEFAULT_INDEX_TIMEOUT = 300
+
+# Label and properties in the description of an index, for example
+# `INDEX ON :Property(key, value)`
+INDEX_DESCRIPTION = re.compile(r':`?(\w+)`?\((.*)\)')
+
+# How the properties and tags of the elements are stored: `node` creates a
+# node for each key-value of each element, `shared` reuses a single node
+# per key-value and `map` stores them as prefixed properties of the element
+PROPERTY_STORAGE_MODES = ['node', 'shared', 'map']
+
+# Prefixes of the properties and tags stored with the `map` mode
+MAP_PREFIXES = {'OBJ_PROPERTY': 'property.', 'OBJ_TAG': 'tag.'}
+
+# Default number of node ids kept in memory while mapping
+DEFAULT_NODE_CACHE_SIZE = 100000
+
+# Properties identifying the nodes in the relationships lookups. Azure ids
+# ignore case, so their values are stored and matched in lower case.
+LOOKUP_KEYS = ['uid', 'backend_pool_id']
+
+# Default number of elements deleted in each transaction when clearing
+DEFAULT_CLEAR_BATCH_SIZE = 10000
+
+# Default number of elements updated in each transaction when migrating
+DEFAULT_MIGRATE_BATCH_SIZE = 10000
+
+# Default number of mapping stages written at the same time
+DEFAULT_WRITE_WORKERS = 4
+
+
+def batches(rows, size):
+    """Yield lists with at most `size` consecutive rows."""
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def content_hash(value):
+    """Return a hash of the JSON representation of a value."""
+    return hashlib.sha256(json.dumps(
+        value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
 # ------------------------- Interface of a Graph mapper -----------------------
+def index_query(action, label, properties, unique):
+    """
+    Return the query to `CREATE` or `DROP` an index on the properties of a
+    label, or the uniqueness constraint on its property if `unique`.
+    """
+    if unique:
+        return (
+            '{action} CONSTRAINT ON (n:{label}) '
+            'ASSERT n.{property} IS UNIQUE').format(
+                action=action, label=label, property=properties[0])
+    return '{action} INDEX ON :{label}({properties})'.format(
+        action=action, label=label, properties=', '.join(properties))
+
+
+def node_labels(node_classes):
+    """Return the labels of the given node classes without repetitions."""
+    return list(OrderedDict.fromkeys(
+        node_class.__label__ for node_class in node_classes))
+
+
+def normalize_keys(values):
+    """Return the values with the `LOOKUP_KEYS` ones in lower case."""
+    return OrderedDict(
+        (name, value.lower()
+         if name in LOOKUP_KEYS and isinstance(value, str) else value)
+        for name, value in values.items())
+
+
+def tag_values(tags):
+    """Return the tags of an element as a dict or `None` if not valid."""
+    if not isinstance(tags, dict):
+        try:
+            tags = json.loads(tags)
+        except Exception:
+            logging.error("Error parsing Tags")
+            return None
+    return tags if isinstance(tags, dict) else None
+
+
+def property_values(properties, unwanted_properties=()):
+    """Return the non empty properties of an element to map."""
+    return OrderedDict(
+        (key, value) for key, value in properties.items()
+        if key not in unwanted_properties and value)
+
+
+class SchemaError(Exception):
+    """Index or constraint required by the mapping not available."""
+
+    pass
+
+
+class WriteState(threading.local):
+    """Write batch of the current thread, with its own transaction."""
+
+    def __init__(self):
+        self.in_batch = False
+        self.pending_operations = 0
+        self.transaction_started = None
+
+
+class NodeCache():
+    """
+    LRU cache of the ids of the nodes created while mapping.
+
+    The nodes are found by the properties identifying them, listed in
+    `KEYS`. Their values are normalized, as in the database, so a node is
+    found the same way in the cache and in the database.
+    """
+
+    KEYS = [(name,) for name in LOOKUP_KEYS]
+
+    def __init__(self, max_size=DEFAULT_NODE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(values):
+        """Return the key of the identifying values of a node."""
+        return tuple(sorted(normalize_keys(values).items()))
+
+    def add(self, node):
+        """Add a saved node under each of its identifying keys."""
+        labels = set(node.inherited_labels())
+        for names in self.KEYS:
+            values = {name: getattr(node, name, None) for name in names}
+            if None in values.values():
+                continue
+            key = self.key(values)
+            with self.lock:
+                self.entries[key] = (node.id, labels)
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+    def get(self, node_class, values):
+        """Return the id of a node of the given class or `None`."""
+        key = self.key(values)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or node_class.__label__ not in entry[1]:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def clear(self):
+        """Remove all the entries."""
+        with self.lock:
+            self.entries.clear()
+
+
+class SyncState():
+    """
+    Nodes and relationships of the previous and the current sync.
+
+    The nodes are kept as a map of their uid to their content hash and the
+    relationships by their identity, as returned by
+    `RelationshipBatch.identity`. Comparing both gives the changes to apply.
+    """
+
+    def __init__(self, nodes=None, relationships=()):
+        # Manifests written before the uids were normalized
+        self.previous_nodes = {
+            uid.lower(): node_hash
+            for uid, node_hash in (nodes or {}).items()}
+        self.previous_relationships = set(relationships)
+        self.nodes = OrderedDict()
+        self.relationships = set()
+        self.added = []
+        self.changed = []
+
+    def track_node(self, uid, node_hash):
+        """Record a node and return if it has to be written."""
+        self.nodes[uid] = node_hash
+        previous_hash = self.previous_nodes.get(uid)
+        if previous_hash == node_hash:
+            return False
+        if previous_hash is None:
+            self.added.append(uid)
+        else:
+            self.changed.append(uid)
+        return True
+
+    def track_relationship(self, identity):
+        """Record a relationship and return if it has to be written."""
+        self.relationships.add(identity)
+        return identity not in self.previous_relationships
+
+    def forget_relationships(self, identities):
+        """Drop relationships that were not created from the current sync."""
+        self.relationships.difference_update(identities)
+
+    def removed_nodes(self):
+        """Return the uids of the nodes not found in the current sync."""
+        return [uid for uid in self.previous_nodes if uid not in self.nodes]
+
+    def removed_relationships(self):
+        """Return the relationships not found in the current sync."""
+        return sorted(self.previous_relationships - self.relationships)
+
+    def report(self):
+        """Return the changes of the current sync."""
+        return OrderedDict([
+            ('added', self.added),
+            ('changed', self.changed),
+            ('removed', self.removed_nodes()),
+            ('unchanged', len(self.nodes) - len(self.added) - len(
+                self.changed)),
+            ('added_relationships', len(
+                self.relationships - self.previous_relationships)),
+            ('removed_relationships', len(self.removed_relationships())),
+        ])
+
+
+class RelationshipBatch():
+    """
+    Relationships collected to be created in bulk.
+
+    The endpoints of each relationship are either nodes, matched by their
+    id if saved or else by their uid, or `(node_class, {property: value})`
+    tuples matched by label and properties, for example
+    `(Owner, {'uid': subscription_id})`. The values of the `LOOKUP_KEYS`
+    are matched in lower case, as stored. Endpoints found in `node_cache`
+    are matched by id instead.
+
+    With a `sync` state only the relationships missing in the previous
+    sync are kept, with their identity to report the ones not created.
+    """
+
+    def __init__(self, node_cache=None, sync=None):
+        self.node_cache = node_cache
+        self.sync = sync
+        self.groups = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def identity(relation_type, from_node, to_node):
+        """Return a string identifying a relationship between runs."""
+        def logical(node):
+            if isinstance(node, StructuredNode):
+                return [node.__label__, {'uid': node.uid.lower()}]
+            return [node[0].__label__, normalize_keys(node[1])]
+        return json.dumps(
+            [relation_type, logical(from_node), logical(to_node)],
+            sort_keys=True)
+
+    def endpoint(self, node):
+        """Return the label, match keys and values of an endpoint."""
+        if isinstance(node, StructuredNode):
+            if getattr(node, 'id', None) is not None:
+                return None, ('id',), {'id': node.id}
+            # Node not written by a sync
+            node = (type(node), {'uid': node.uid})
+        node_class, values = node
+        values = normalize_keys(values)
+        if self.node_cache is not None:
+            node_id = self.node_cache.get(node_class, values)
+            if node_id is not None:
+                return None, ('id',), {'id': node_id}
+        return node_class.__label__, tuple(sorted(values)), values
+
+    def add(self, relation_type, from_node, to_node):
+        """Add a relationship going from `from_node` to `to_node`."""
+        if self.sync is not None:
+            identity = self.identity(relation_type, from_node, to_node)
+            if not self.sync.track_relationship(identity):
+                return
+        from_label, from_keys, from_values = self.endpoint(from_node)
+        to_label, to_keys, to_values = self.endpoint(to_node)
+        group = (relation_type, from_label, from_keys, to_label, to_keys)
+        edge = {'from': from_values, 'to': to_values}
+        if self.sync is not None:
+            edge['identity'] = identity
+        with self.lock:
+            self.groups.setdefault(group, []).append(edge)
+
+    def __len__(self):
+        return sum(len(edges) for edges in self.groups.values())
+
+
+class ResourceMapping():
+    """
+    Declarative mapping of a table of rows to nodes, run in bulk by
+    `BaseGraphMapper.map_rows`.
+
+    `rows` returns the rows from the mapper and the retrieved data. For
+    each row `uid` returns the normalized uid of its node and `node` the
+    other node properties. `content` returns what is compared between runs,
+    by default the node properties. `properties` and `tags` return the
+    values mapped as `Property`, except `unwanted_properties`, and `Tag`
+    nodes, if given. `edges` are functions returning the relationships of
+    a row and its node as `(relation_type, from_node, to_node)` tuples, as
+    added to a `RelationshipBatch`.
+    """
+
+    def __init__(
+            self, node_class, rows, uid, node, content=None, properties=None,
+            unwanted_properties=(), tags=None, edges=()):
+        self.node_class = node_class
+        self.rows = rows
+        self.uid = uid
+        self.node = node
+        self.content = content
+        self.properties = properties
+        self.unwanted_properties = unwanted_properties
+        self.tags = tags
+        self.edges = edges
+
+
+def match_clause(variable, label, keys, field):
+    """Return a `MATCH` clause of a relationship endpoint."""
+    if label is None:
+        condition = 'id({variable}) = edge.{field}.id'.format(
+            variable=variable, field=field)
+        return 'MATCH ({variable}) WHERE {condition}'.format(
+            variable=variable, condition=condition)
+    return 'MATCH ({variable}:{label}) WHERE {conditions}'.format(
+        variable=variable, label=label, conditions=' AND '.join(
+            '{variable}.{key} = edge.{field}.{key}'.format(
+                variable=variable, key=key, field=field)
+            for key in keys))
+
+
 class BaseGraphMapper():
     """Base class to implement a graph mapper."""
 
@@ -29,41 +381,857 @@ class BaseGraphMapper():
         self.database_url = database_url
         config.DATABASE_URL = self.database_url
         self.db = db
+        self.batch_size = self.config.get(
+            'neo4j_batch_size', DEFAULT_BATCH_SIZE)
+        self.node_cache = NodeCache(self.config.get(
+            'neo4j_node_cache_size', DEFAULT_NODE_CACHE_SIZE))
+        self.property_storage = self.config.get('property_storage', 'node')
+        if self.property_storage not in PROPERTY_STORAGE_MODES:
+            raise ValueError('Unknown property storage {mode}'.format(
+                mode=self.property_storage))
+        # Upserts
+        self.upsert = False
+        self.sync = None
+        self.written_lock = threading.Lock()
+        self.written_uids = {}
+        self.written_relationships = set()
+        # Transaction batching
+        self.commit_size = self.config.get(
+            'neo4j_commit_size', DEFAULT_COMMIT_SIZE)
+        self.commit_interval = self.config.get(
+            'neo4j_commit_interval', DEFAULT_COMMIT_INTERVAL)
+        self.write_state = WriteState()
+        # Metrics
+        self.metrics_lock = threading.Lock()
+        self.operations = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        self.batch_time = 0.0
+        self.active_batches = 0
+        self.batches_started = None
         if logger:
             self.create_logger(logfile=logfile)
 
+    @contextmanager
+    def write_batch(self):
+        """
+        Run the writes of the block in batched transactions.
+
+        The open transaction is committed every `neo4j_commit_size`
+        operations or `neo4j_commit_interval` milliseconds, whatever comes
+        first. With a commit size of `0` everything is written in a single
+        transaction. If the block fails the open transaction is rolled back.
+
+        Each thread has its own write batch and transaction.
+        """
+        if self.write_state.in_batch:
+            yield
+            return
+        with self.metrics_lock:
+            if not self.active_batches:
+                self.batches_started = time.monotonic()
+            self.active_batches += 1
+        self.write_state.in_batch = True
+        self.begin_transaction()
+        try:
+            yield
+        except Exception:
+            self.db.rollback()
+            # The ids of the nodes rolled back are not valid
+            self.node_cache.clear()
+            logging.error(
+                'Write batch failed, rolled back {count} operations'.format(
+                    count=self.write_state.pending_operations))
+            raise
+        else:
+            self.commit_transaction()
+        finally:
+            self.write_state.in_batch = False
+            # Time with any batch open, batches in parallel count once
+            with self.metrics_lock:
+                self.active_batches -= 1
+                if not self.active_batches:
+                    self.batch_time += (
+                        time.monotonic() - self.batches_started)
+        logging.info('Graph writes: {metrics}'.format(
+            metrics=self.write_metrics()))
+
+    def begin_transaction(self):
+        """Open the transaction used by the write batch."""
+        self.db.begin()
+        self.write_state.pending_operations = 0
+        self.write_state.transaction_started = time.monotonic()
+
+    def commit_transaction(self):
+        """Commit the transaction used by the write batch."""
+        start = time.monotonic()
+        self.db.commit()
+        with self.metrics_lock:
+            self.commit_time += time.monotonic() - start
+            self.commits += 1
+        self.write_state.pending_operations = 0
+
+    def record_operations(self, count=1):
+        """
+        Count write operations, committing the batch when it is full.
+
+        Outside a write batch the operations are only counted.
+        """
+        with self.metrics_lock:
+            self.operations += count
+        state = self.write_state
+        if not state.in_batch:
+            return
+        state.pending_operations += count
+        if not self.commit_size:
+            return
+        elapsed = (time.monotonic() - state.transaction_started) * 1000
+        if (state.pending_operations >= self.commit_size or
+                (self.commit_interval and elapsed >= self.commit_interval)):
+            self.commit_transaction()
+            self.begin_transaction()
+
+    def write_metrics(self):
+        """Return the write operations, commits and throughput counters."""
+        return {
+            'operations': self.operations,
+            'commits': self.commits,
+            'average_commit_time': (
+                self.commit_time / self.commits if self.commits else 0),
+            'operations_per_second': (
+                self.operations / self.batch_time if self.batch_time else 0),
+        }
+
+    def run_stage(self, name, function):
+        """Run a mapping stage in its own write batch."""
+        start = time.monotonic()
+        with self.write_batch():
+            function()
+        logging.info('Stage {name} done in {seconds:.1f} seconds'.format(
+            name=name, seconds=time.monotonic() - start))
+
+    def run_stages(self, stages):
+        """
+        Run the stages of a mapping, each one once the ones it depends on
+        are done.
+
+        `stages` maps the name of each stage to a `(function, dependencies)`
+        tuple. With `neo4j_write_workers` above 1 the independent stages run
+        at the same time, each one in its own thread, and therefore database
+        session, and in its own write batch. Otherwise they run one after
+        the other in the current write batch. That is always the case with a
+        `neo4j_commit_size` of `0`, to write everything in one transaction,
+        and with the `shared` property storage, which merges the same nodes
+        from every stage.
+        """
+        workers = self.config.get(
+            'neo4j_write_workers', DEFAULT_WRITE_WORKERS)
+        if self.property_storage == 'shared' or not self.commit_size:
+            workers = 1
+        pending = OrderedDict(stages)
+        done = set()
+
+        def ready():
+            names = [
+                name for name, (_, dependencies) in pending.items()
+                if done.issuperset(dependencies)]
+            for name in names:
+                yield name, pending.pop(name)[0]
+
+        if workers <= 1:
+            while pending:
+                stage = next(ready(), None)
+                if stage is None:
+                    break
+                self.run_stage(*stage)
+                done.add(stage[0])
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                running = {}
+                while True:
+                    for name, function in ready():
+                        running[executor.submit(
+                            self.run_stage, name, function)] = name
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        # Raise the error of a failed stage
+                        future.result()
+                        done.add(name)
+        if pending:
+            raise ValueError('Stages with unmet dependencies: {names}'.format(
+                names=', '.join(pending)))
+
+    def start_sync_run(self, upsert=False, sync=None):
+        """
+        Start a mapping run.
+
+        With `upsert` the nodes are merged on their `uid` and the uids of
+        the nodes and the endpoints of the relationships mapped are kept, so
+        the ones in the database not mapped can be removed afterwards with
+        `delete_stale_nodes` and `delete_stale_relationships`.
+
+        With a `sync` state the run upserts only the nodes and relationships
+        changed since the previous sync. `delete_removed_relationships` and
+        `delete_removed` delete then the ones not found anymore.
+        """
+        self.upsert = upsert or sync is not None
+        self.sync = sync
+        self.written_uids = {}
+        self.written_relationships = set()
+
+    def create_nodes(self, node_class, rows, contents=None):
+        """
+        Create nodes of the given class in bulk.
+
+        Each batch of rows is sent as a single `UNWIND` query. The nodes get
+        the same labels and deflated properties as when saved one by one and
+        are returned in the order of the rows.
+
+        Each node keeps a `content_hash` of its content, the corresponding
+        item of `contents` or the row itself. When upserting, existing nodes
+        with the same hash are not written again and are returned with
+        `unchanged` set, so their properties and tags are kept too. Upserted
+        nodes are merged on the label of the base class, so an existing node
+        of another class of the hierarchy, for example a virtual machine
+        becoming a database, gets the labels of `node_class` when written.
+        During a sync the nodes unchanged since the previous one are not
+        sent to the database and are returned unsaved.
+        """
+        inherited_labels = node_class.inherited_labels()
+        labels = ':'.join(inherited_labels)
+        if self.upsert:
+            # Labels of the subclasses, removed from the changed nodes
+            subclasses = node_class.__subclasses__()
+            removed_labels = []
+            while subclasses:
+                subclass = subclasses.pop()
+                removed_labels.append(subclass.__label__)
+                subclasses.extend(subclass.__subclasses__())
+            query = """
+UNWIND $rows AS row
+MERGE (n:{base_label} {{uid: row.uid}})
+WITH n, row, n.content_hash = row.content_hash
+    AND size(labels(n)) = {label_count} AND n:{labels} AS unchanged
+FOREACH (_ IN CASE WHEN unchanged THEN [] ELSE [1] END |
+    SET n = row, n:{labels}{remove_labels})
+RETURN n, unchanged
+""".format(
+                base_label=inherited_labels[-1], labels=labels,
+                label_count=len(inherited_labels),
+                remove_labels=''.join(
+                    ' REMOVE n:' + label
+                    for label in OrderedDict.fromkeys(removed_labels)))
+        else:
+            query = """
+UNWIND $rows AS row
+CREATE (n:{labels})
+SET n = row
+RETURN n, false
+""".format(labels=labels)
+        rows = list(rows)
+        if contents is None:
+            contents = rows
+        rows = [normalize_keys(row) for row in rows]
+        nodes = [None] * len(rows)
+        pending = []
+        for index, (row, content) in enumerate(zip(rows, contents)):
+            deflated = node_class.deflate(row, skip_empty=True)
+            deflated['content_hash'] = content_hash(content)
+            if self.sync is not None and not self.sync.track_node(
+                    deflated['uid'], deflated['content_hash']):
+                # Unchanged since the previous sync, not written
+                nodes[index] = node_class(**row)
+                nodes[index].unchanged = True
+            else:
+                pending.append((index, deflated))
+        for batch in batches(pending, self.batch_size):
+            results, _ = self.db.cypher_query(query, {
+                'rows': [row for _, row in batch]})
+            for (index, _), (node, unchanged) in zip(batch, results):
+                nodes[index] = node_class.inflate(node)
+                nodes[index].unchanged = bool(unchanged)
+            if self.upsert:
+                self.remove_key_values([
+                    nodes[index].id for index, _ in batch
+                    if not nodes[index].unchanged])
+            self.record_operations(len(batch))
+        if self.upsert:
+            with self.written_lock:
+                for label in inherited_labels:
+                    self.written_uids.setdefault(label, set()).update(
+                        row['uid'] for row in rows)
+        for node in nodes:
+            if getattr(node, 'id', None) is not None:
+                self.node_cache.add(node)
+        unchanged = sum(node.unchanged for node in nodes)
+        logging.info(
+            'Wrote {count} {label} nodes, {unchanged} unchanged'.format(
+                count=len(nodes), label=node_class.__label__,
+                unchanged=unchanged))
+        return nodes
+
+    def remove_key_values(self, ids):
+        """
+        Remove the properties and tags of the nodes with the given ids.
+
+        Shared properties and tags are only deleted when no longer used.
+        """
+        if not ids:
+            return
+        query = """
+MATCH (n)-[r:OBJ_PROPERTY|OBJ_TAG]->(p) WHERE id(n) IN $ids
+DELETE r{properties}
+RETURN count(DISTINCT n){key_values}
+""".format(
+            properties=', p' if self.property_storage == 'node' else '',
+            key_values=self.deleted_key_values_column())
+        results, _ = self.db.cypher_query(query, {'ids': ids})
+        self.delete_orphaned_key_values(self.deleted_key_values(results))
+
+    def deleted_key_values_column(self):
+        """
+        Return the column added to the delete queries to collect the ids of
+        the shared properties and tags `p` of the deleted nodes.
+        """
+        if self.property_storage != 'shared':
+            return ''
+        return ', collect(DISTINCT id(p))'
+
+    def deleted_key_values(self, results):
+        """Return the shared property ids collected by a delete query."""
+        if self.property_storage != 'shared':
+            return []
+        return results[0][1]
+
+    def delete_orphaned_key_values(self, ids):
+        """
+        Delete the shared properties and tags with the given ids no longer
+        used by any node.
+
+        Only the given nodes are checked, in batches, instead of scanning
+        every property.
+        """
+        query = """
+MATCH (p:Property) WHERE id(p) IN $ids AND NOT (p)--()
+DELETE p
+RETURN count(p)
+"""
+        deleted = 0
+        for batch in batches(sorted(ids), self.batch_size):
+            results, _ = self.db.cypher_query(query, {'ids': batch})
+            deleted += results[0][0]
+        if deleted:
+            logging.info('Deleted {count} unused properties'.format(
+                count=deleted))
+
+    def delete_stale_nodes(self, node_classes):
+        """
+        Delete the nodes of the given classes not written in this run.
+
+        The uids of each label in the database are compared with the ones
+        written and the others are deleted in batches with their properties
+        and tags.
+        """
+        query = """
+MATCH (n:{label}) WHERE n.uid IN $uids
+OPTIONAL MATCH (n)-[:OBJ_PROPERTY|OBJ_TAG]->(p)
+DETACH DELETE {properties}n
+RETURN count(DISTINCT n){key_values}
+"""
+        deleted = 0
+        key_values = set()
+        for label in node_labels(node_classes):
+            results, _ = self.db.cypher_query(
+                'MATCH (n:{label}) RETURN n.uid'.format(label=label))
+            written = self.written_uids.get(label, set())
+            stale = [uid for uid, in results if uid not in written]
+            for batch in batches(stale, self.batch_size):
+                results, _ = self.db.cypher_query(
+                    query.format(
+                        label=label, properties=(
+                            'p, ' if self.property_storage == 'node'
+                            else ''),
+                        key_values=self.deleted_key_values_column()),
+                    {'uids': batch})
+                deleted += results[0][0]
+                key_values.update(self.deleted_key_values(results))
+                self.record_operations(len(batch))
+        self.delete_orphaned_key_values(key_values)
+        self.node_cache.clear()
+        logging.info('Deleted {count} stale nodes'.format(count=deleted))
+
+    def delete_stale_relationships(self, relation_types):
+        """
+        Delete the relationships of the given types not written in this run.
+
+        The relationships in the database are compared by type and endpoint
+        uids with the ones written and the others are deleted by id.
+        """
+        stale = []
+        for relation_type in relation_types:
+            results, _ = self.db.cypher_query(
+                'MATCH (a)-[r:{relation_type}]->(b) '
+                'RETURN a.uid, b.uid, id(r)'.format(
+                    relation_type=relation_type))
+            stale.extend(
+                relationship_id for from_uid, to_uid, relationship_id
+                in results if (relation_type, from_uid, to_uid)
+                not in self.written_relationships)
+        deleted = 0
+        for batch in batches(stale, self.batch_size):
+            results, _ = self.db.cypher_query(
+                'MATCH ()-[r]->() WHERE id(r) IN $ids '
+                'DELETE r RETURN count(r)', {'ids': batch})
+            deleted += results[0][0]
+            self.record_operations(len(batch))
+        logging.info('Deleted {count} stale relationships'.format(
+            count=deleted))
+
+    def create_relationships(self, relationships):
+        """
+        Create the relationships of a `RelationshipBatch`.
+
+        The relationships with the same type and kind of endpoints are sent
+        in batches as a single `UNWIND` query. Relationships with an endpoint
+        that is not found are skipped and reported together. When upserting
+        the endpoint uids of the relationships are kept for
+        `delete_stale_relationships`.
+
+        Return the identities of the relationships not created when they
+        were added with a sync state, so they are not saved as synced.
+        """
+        missing = OrderedDict()
+        not_created = []
+        for group, edges in relationships.groups.items():
+            relation_type, from_label, from_keys, to_label, to_keys = group
+            query = """
+UNWIND $edges AS edge
+OPTIONAL {match_from}
+OPTIONAL {match_to}
+FOREACH (_ IN CASE WHEN a IS NULL OR b IS NULL THEN [] ELSE [1] END |
+    MERGE (a)-[r:{relation_type}]->(b))
+RETURN sum(CASE WHEN a IS NULL OR b IS NULL THEN 1 ELSE 0 END),
+    {endpoints},
+    {identities}
+""".format(
+                match_from=match_clause('a', from_label, from_keys, 'from'),
+                match_to=match_clause('b', to_label, to_keys, 'to'),
+                relation_type=relation_type,
+                endpoints=(
+                    'collect(CASE WHEN a IS NULL OR b IS NULL THEN NULL '
+                    'ELSE [a.uid, b.uid] END)' if self.upsert else '[]'),
+                identities=(
+                    'collect(CASE WHEN a IS NULL OR b IS NULL '
+                    'THEN edge.identity END)'
+                    if relationships.sync is not None else '[]'))
+            for batch in batches(edges, self.batch_size):
+                results, _ = self.db.cypher_query(query, {'edges': batch})
+                if results[0][0]:
+                    missing[relation_type] = (
+                        missing.get(relation_type, 0) + results[0][0])
+                    not_created.extend(results[0][2])
+                with self.written_lock:
+                    self.written_relationships.update(
+                        (relation_type, from_uid, to_uid)
+                        for from_uid, to_uid in results[0][1])
+                self.record_operations(len(batch))
+        logging.info(
+            'Created {count} relationships, {hits} endpoints found in the '
+            'node cache and {misses} matched in the database'.format(
+                count=len(relationships) - sum(missing.values()),
+                hits=self.node_cache.hits, misses=self.node_cache.misses))
+        for relation_type, count in missing.items():
+            logging.warning(
+                '{count} {relation_type} relationships not created, '
+                'endpoint not found'.format(
+                    count=count, relation_type=relation_type))
+        return not_created
+
+    def delete_relationships(self, identities):
+        """Delete the relationships with the given identities."""
+        groups = OrderedDict()
+        for identity in identities:
+            relation_type, (from_label, from_values), (to_label, to_values) = (
+                json.loads(identity))
+            group = (
+                relation_type, from_label, tuple(sorted(from_values)),
+                to_label, tuple(sorted(to_values)))
+            groups.setdefault(group, []).append(
+                {'from': from_values, 'to': to_values})
+        deleted = 0
+        for group, edges in groups.items():
+            relation_type, from_label, from_keys, to_label, to_keys = group
+            query = """
+UNWIND $edges AS edge
+{match_from}
+{match_to}
+MATCH (a)-[r:{relation_type}]->(b)
+DELETE r
+RETURN count(r)
+""".format(
+                match_from=match_clause('a', from_label, from_keys, 'from'),
+                match_to=match_clause('b', to_label, to_keys, 'to'),
+                relation_type=relation_type)
+            for batch in batches(edges, self.batch_size):
+                results, _ = self.db.cypher_query(query, {'edges': batch})
+                deleted += results[0][0]
+                self.record_operations(len(batch))
+        logging.info('Deleted {count} relationships'.format(count=deleted))
+
+    def delete_removed_relationships(self):
+        """
+        Delete the relationships removed since the last sync.
+
+        It must be called before creating the new relationships: the same
+        relationship gets another identity when an endpoint changes its
+        class, for example a virtual machine becoming a database, and the
+        existing one is reused by the new identity.
+        """
+        self.delete_relationships(self.sync.removed_relationships())
+
+    def delete_removed(self, node_classes):
+        """Delete the nodes of the given classes removed since last sync."""
+        self.delete_nodes(self.sync.removed_nodes(), node_classes)
+
+    def schema_indexes(self):
+        """
+        Return the indexes as `(label, properties, state, unique)` tuples,
+        `unique` being true for the ones backing a uniqueness constraint.
+        """
+        results, _ = self.db.cypher_query(
+            'CALL db.indexes() YIELD description, state, type '
+            'RETURN description, state, type')
+        indexes = []
+        for description, state, index_type in results:
+            match = INDEX_DESCRIPTION.search(description)
+            if match:
+                properties = tuple(
+                    name.strip(' `') for name in match.group(2).split(','))
+                indexes.append((
+                    match.group(1), properties, state,
+                    index_type == 'node_unique_property'))
+        return indexes
+
+    def existing_indexes(self):
+        """Return the state of the indexes by label and properties."""
+        return {
+            (label, properties): state
+            for label, properties, state, _ in self.schema_indexes()}
+
+    def ensure_schema(self, node_classes, composite_indexes=()):
+        """
+        Create the indexes and constraints used by the mapping lookups.
+
+        The properties declared with `unique_index` or `index` in the given
+        classes get a uniqueness constraint or an index, and
+        `composite_indexes` lists `(node_class, properties)` indexes on
+        several properties. Only the missing ones are created. Then it waits
+        until all of them are online and raises `SchemaError` otherwise.
+
+        Before creating a uniqueness constraint the existing nodes are
+        checked and `SchemaError` is raised listing some of the duplicated
+        values, if any, as the constraint could not be created.
+        """
+        required = OrderedDict()
+        for node_class in node_classes:
+            for name, node_property in node_class.defined_properties(
+                    aliases=False, rels=False).items():
+                key = (node_class.__label__, (
+                    node_property.db_property or name,))
+                if node_property.unique_index:
+                    required[key] = True
+                elif node_property.index:
+                    required.setdefault(key, False)
+        for node_class, properties in composite_indexes:
+            required.setdefault(
+                (node_class.__label__, tuple(properties)), False)
+
+        existing = self.existing_indexes()
+        duplicates = []
+        for (label, properties), unique in required.items():
+            if unique and (label, properties) not in existing:
+                duplicates += self.duplicated_values(label, properties[0])
+        if duplicates:
+            raise SchemaError(
+                'Duplicated values prevent creating the uniqueness '
+                'constraints, clear the database or remove them: '
+                '{duplicates}'.format(duplicates=', '.join(duplicates)))
+        for (label, properties), unique in required.items():
+            if (label, properties) in existing:
+                continue
+            query = index_query('CREATE', label, properties, unique)
+            logging.info(query)
+            self.db.cypher_query(query)
+
+        self.db.cypher_query(
+            'CALL db.awaitIndexes($timeout)', {'timeout': self.config.get(
+                'neo4j_index_timeout', DEFAULT_INDEX_TIMEOUT)})
+        existing = self.existing_indexes()
+        not_online = [
+            '{label}({properties})'.format(
+                label=label, properties=', '.join(properties))
+            for label, properties in required
+            if existing.get((label, properties)) != 'ONLINE']
+        if not_online:
+            raise SchemaError('Indexes not online: {indexes}'.format(
+                indexes=', '.join(not_online)))
+        logging.info('{count} indexes and constraints online'.format(
+            count=len(required)))
+
+    def duplicated_values(self, label, name, limit=10):
+        """
+        Return up to `limit` values of a property repeated in several nodes
+        of a label, as `label.name=value` strings.
+        """
+        results, _ = self.db.cypher_query(
+            'MATCH (n:{label}) WHERE n.{name} IS NOT NULL '
+            'WITH n.{name} AS value, count(n) AS count WHERE count > 1 '
+            'RETURN value LIMIT $limit'.format(label=label, name=name),
+            {'limit': limit})
+        return [
+            '{label}.{name}={value}'.format(
+                label=label, name=name, value=value)
+            for value, in results]
+
+    def add_key_values(self, element_relationship, node_class, values):
+        """
+        Add key-value nodes to an element with a single query.
+
+        `element_relationship` is the relationship of the element used to
+        link them, for example its `object_properties`.
+        """
+        self.add_elements_key_values(
+            element_relationship.definition['relation_type'], node_class,
+            [(element_relationship.source, values)])
+
+    def add_elements_key_values(self, relation_type, node_class, elements):
+        """
+        Add key-value nodes to several elements in bulk.
+
+        `elements` are `(node, values)` tuples and the values are linked
+        with `relation_type`, for example `OBJ_PROPERTY`. Each batch of
+        elements is sent as a single query. How they are stored depends on
+        the `property_storage` mode. Nothing is written for elements
+        returned as unchanged by an upsert.
+        """
+        elements = [
+            {'id': node.id, 'items': [
+                {'key': str(key), 'value': str(value)}
+                for key, value in values.items()]}
+            for node, values in elements
+            if values and not getattr(node, 'unchanged', False)]
+        labels = node_class.inherited_labels()
+        if self.property_storage == 'map':
+            query = """
+UNWIND $elements AS element
+MATCH (n) WHERE id(n) = element.id
+SET n += element.values
+"""
+            prefix = MAP_PREFIXES[relation_type]
+            for element in elements:
+                element['values'] = {
+                    prefix + item['key']: item['value']
+                    for item in element.pop('items')}
+        elif self.property_storage == 'shared':
+            # Nodes with other labels, like tags for properties, are skipped
+            query = """
+UNWIND $elements AS element
+MATCH (n) WHERE id(n) = element.id
+UNWIND element.items AS item
+MATCH (p:{labels} {{key: item.key, value: item.value}})
+WHERE size(labels(p)) = $label_count
+WITH n, item, head(collect(p)) AS p
+MERGE (n)-[:{relation_type}]->(p)
+""".format(labels=':'.join(labels), relation_type=relation_type)
+            # The missing key-values are created once before linking them
+            create_query = """
+UNWIND $items AS item
+OPTIONAL MATCH (p:{labels} {{key: item.key, value: item.value}})
+WHERE size(labels(p)) = $label_count
+WITH item, count(p) AS found
+WHERE found = 0
+CREATE (:{labels} {{key: item.key, value: item.value}})
+""".format(labels=':'.join(labels))
+        else:
+            query = """
+UNWIND $elements AS element
+MATCH (n) WHERE id(n) = element.id
+UNWIND element.items AS item
+CREATE (n)-[:{relation_type}]->(:{labels} {{
+    key: item.key, value: item.value}})
+""".format(labels=':'.join(labels), relation_type=relation_type)
+        for batch in batches(elements, self.batch_size):
+            if self.property_storage == 'shared':
+                items = OrderedDict(
+                    ((item['key'], item['value']), item)
+                    for element in batch for item in element['items'])
+                self.db.cypher_query(create_query, {
+                    'items': list(items.values()),
+                    'label_count': len(labels)})
+            self.db.cypher_query(query, {
+                'elements': batch, 'label_count': len(labels)})
+            self.record_operations(sum(
+                len(element.get('items') or element['values'])
+                for element in batch))
+
     def add_property(
             self, element_properties, property_key='key', property_value=None):
         """Add property to the given element using the properties relation."""
-        new_property = Property(key=property_key, value=property_value)
-        new_property.save()
-        element_properties.connect(new_property)
+        self.add_key_values(
+            element_properties, Property, {property_key: property_value})
 
     def add_tag(self, element_tags, tag_key, tag_value):
         """Add tag to element using the tags relation."""
-        new_tag = Tag(key=tag_key, value=tag_value)
-        new_tag.save()
-        element_tags.connect(new_tag)
+        self.add_key_values(element_tags, Tag, {tag_key: tag_value})
 
     def add_tags(self, element_tags, tags):
         """Add mulitple tags to an element."""
-        if not isinstance(tags, dict):
-            try:
-                tags = json.loads(tags)
-            except Exception:
-                logging.error("Error parsing Tags")
-                return
-        if isinstance(tags, dict):
-            for key, value in tags.items():
-                self.add_tag(element_tags, key, value)
+        tags = tag_values(tags)
+        if tags is not None:
+            self.add_key_values(element_tags, Tag, tags)
 
     def add_properties(
             self, element_properties, properties, unwanted_properties=['key']):
         """Add multiple properties to an element."""
-        for key, value in properties.items():
-            if key not in unwanted_properties and value:
-                self.add_property(
-                    element_properties, property_key=key, property_value=value)
+        self.add_key_values(element_properties, Property, property_values(
+            properties, unwanted_properties))
+
+    def map_rows(self, mapping, data, relationships):
+        """
+        Map a table of rows with a `ResourceMapping`.
+
+        The nodes of all the rows, then their properties and tags, are
+        written in bulk and their relationships are added to the
+        `relationships` batch. Return the nodes in the order of the rows.
+        """
+        rows = list(mapping.rows(self, data))
+        node_rows = []
+        for row in rows:
+            node_row = OrderedDict(uid=mapping.uid(row))
+            node_row.update(mapping.node(row))
+            node_rows.append(node_row)
+        nodes = self.create_nodes(
+            mapping.node_class, node_rows, contents=None
+            if mapping.content is None else [
+                mapping.content(row) for row in rows])
+        if mapping.properties is not None:
+            self.add_elements_key_values('OBJ_PROPERTY', Property, [
+                (node, property_values(
+                    mapping.properties(row), mapping.unwanted_properties))
+                for row, node in zip(rows, nodes)])
+        if mapping.tags is not None:
+            self.add_elements_key_values('OBJ_TAG', Tag, [
+                (node, tag_values(mapping.tags(row)))
+                for row, node in zip(rows, nodes)])
+        for row, node in zip(rows, nodes):
+            for edges in mapping.edges:
+                for relation_type, from_node, to_node in edges(row, node):
+                    relationships.add(relation_type, from_node, to_node)
+        return nodes
+
+    def migrate_property_storage(self, mode):
+        """
+        Convert the properties and tags of the graph to another storage.
+
+        Graphs stored with the `node` mode can be converted to the `shared`
+        and `map` modes, and the `shared` ones to the `map` mode. The `map`
+        conversion uses APOC to set the prefixed properties. The nodes are
+        converted in batches of `neo4j_migrate_batch_size`, each one in its
+        own transaction. Graphs are never converted back to the `node` mode,
+        so there is nothing to do for it.
+        """
+        if mode not in PROPERTY_STORAGE_MODES:
+            raise ValueError('Unsupported property storage {mode}'.format(
+                mode=mode))
+        if mode == 'node':
+            logging.info('Property storage node, nothing to migrate')
+            return
+        batch_size = self.config.get(
+            'neo4j_migrate_batch_size', DEFAULT_MIGRATE_BATCH_SIZE)
+        for node_class, relation_type in [
+                (Property, 'OBJ_PROPERTY'), (Tag, 'OBJ_TAG')]:
+            labels = node_class.inherited_labels()
+            if mode == 'shared':
+                count = self.merge_duplicated_key_values(
+                    labels, relation_type, batch_size)
+            else:
+                query = """
+MATCH (p:{labels})
+WHERE size(labels(p)) = $label_count AND ()-[:{relation_type}]->(p)
+WITH p LIMIT $batch_size
+MATCH (n)-[:{relation_type}]->(p)
+CALL apoc.create.setProperty(n, $prefix + p.key, p.value) YIELD node
+DETACH DELETE p
+RETURN count(DISTINCT p)
+"""
+                count = self.write_in_batches(
+                    query.format(
+                        labels=':'.join(labels), relation_type=relation_type),
+                    '{label} nodes to {mode}'.format(
+                        label=node_class.__label__, mode=mode),
+                    batch_size=batch_size, action='Migrated', params={
+                        'label_count': len(labels),
+                        'prefix': MAP_PREFIXES[relation_type]})
+            logging.info('Migrated {count} {label} nodes to {mode}'.format(
+                count=count, label=node_class.__label__, mode=mode))
+        self.property_storage = mode
+
+    def merge_duplicated_key_values(self, labels, relation_type, batch_size):
+        """
+        Link the elements to a single key-value node of the given labels.
+
+        The nodes are visited in batches of `batch_size` ordered by id,
+        carrying the last id between batches, so each one only reads its
+        own nodes. The nodes with the same key and value as one with a
+        lower id, found through the key index, are replaced by it.
+        Return the number of nodes deleted, or raise `ValueError` if a
+        batch does not move past the last id.
+        """
+        label_count = len(labels)
+        labels = ':'.join(labels)
+        query = """
+MATCH (p) WHERE id(p) IN $ids
+MATCH (kept:{labels})
+WHERE kept.key = p.key AND kept.value = p.value
+AND size(labels(kept)) = $label_count AND id(kept) < id(p)
+WITH p, kept ORDER BY id(kept)
+WITH p, head(collect(kept)) AS kept
+OPTIONAL MATCH (n)-[:{relation_type}]->(p)
+FOREACH (_ IN CASE WHEN n IS NULL THEN [] ELSE [1] END |
+    MERGE (n)-[:{relation_type}]->(kept))
+DETACH DELETE p
+RETURN count(DISTINCT p)
+""".format(labels=labels, relation_type=relation_type)
+        last = -1
+        deleted = 0
+        visited = 0
+        while True:
+            results, _ = self.db.cypher_query(
+                'MATCH (p:{labels}) '
+                'WHERE id(p) > $last AND size(labels(p)) = $label_count '
+                'RETURN id(p) ORDER BY id(p) LIMIT $batch_size'.format(
+                    labels=labels),
+                {'last': last, 'label_count': label_count,
+                 'batch_size': batch_size})
+            ids = [node_id for node_id, in results]
+            if not ids:
+                break
+            if ids[-1] <= last:
+                raise ValueError(
+                    'Page of {labels} nodes not after id {last}'.format(
+                        labels=labels, last=last))
+            results, _ = self.db.cypher_query(
+                query, {'ids': ids, 'label_count': label_count})
+            deleted += results[0][0]
+            visited += len(ids)
+            last = ids[-1]
+            logging.info(
+                'Visited {visited} {labels} nodes, {deleted} merged'.format(
+                    visited=visited, labels=labels, deleted=deleted))
+        return deleted
 
     def get_app_data(
             self,
@@ -84,9 +1252,189 @@ class BaseGraphMapper():
         """Persist data using the graph data base elements definitions."""
         raise NotImplementedError
 
+    def write_in_batches(
+            self, query, description, total=None, batch_size=None,
+            action='Deleted', params=None):
+        """
+        Run a write `query` returning the number of changed elements, with
+        `$batch_size` as limit and the given `params`, until nothing is
+        left. Each batch is run in its own transaction and the progress is
+        logged after each one.
+        """
+        if batch_size is None:
+            batch_size = self.config.get(
+                'neo4j_clear_batch_size', DEFAULT_CLEAR_BATCH_SIZE)
+        params = dict(params or {}, batch_size=batch_size)
+        changed = 0
+        while True:
+            results, _ = self.db.cypher_query(query, params)
+            count = results[0][0]
+            if not count:
+                break
+            changed += count
+            logging.info('{action} {changed}{total} {description}'.format(
+                action=action, changed=changed, description=description,
+                total='' if total is None else ' of {total}'.format(
+                    total=total)))
+        return changed
+
+    def normalize_lookup_keys(self):
+        """
+        Convert the `LOOKUP_KEYS` of the nodes stored by previous versions to
+        lower case, in batches of `neo4j_migrate_batch_size`.
+        """
+        for key in LOOKUP_KEYS:
+            self.write_in_batches(
+                'MATCH (n) WHERE n.{key} <> toLower(n.{key}) '
+                'WITH n LIMIT $batch_size '
+                'SET n.{key} = toLower(n.{key}) '
+                'RETURN count(n)'.format(key=key),
+                '{key} values in lower case'.format(key=key),
+                batch_size=self.config.get(
+                    'neo4j_migrate_batch_size', DEFAULT_MIGRATE_BATCH_SIZE),
+                action='Converted')
+
     def clear_database(self):
-        """Delete database."""
-        clear_neo4j_database(self.db)
+        """
+        Delete database.
+
+        Unless `neo4j_clear_batch_size` is 0, the relationships and then the
+        nodes of each label are deleted in batches of that size, each one in
+        its own transaction, so that the memory used does not grow with the
+        size of the graph. With `neo4j_clear_drop_indexes` the indexes and
+        constraints are dropped before and created again after deleting.
+        """
+        start = time.time()
+        if not self.config.get(
+                'neo4j_clear_batch_size', DEFAULT_CLEAR_BATCH_SIZE):
+            clear_neo4j_database(self.db)
+            self.node_cache.clear()
+            return
+
+        indexes = []
+        if self.config.get('neo4j_clear_drop_indexes', False):
+            indexes = self.schema_indexes()
+            for label, properties, _, unique in indexes:
+                query = index_query('DROP', label, properties, unique)
+                logging.info(query)
+                self.db.cypher_query(query)
+
+        results, _ = self.db.cypher_query(
+            'MATCH ()-[r]->() RETURN count(r)')
+        self.write_in_batches(
+            'MATCH ()-[r]->() WITH r LIMIT $batch_size '
+            'DELETE r RETURN count(r)',
+            'relationships', results[0][0])
+
+        results, _ = self.db.cypher_query('CALL db.labels()')
+        counts = []
+        for label, in results:
+            count, _ = self.db.cypher_query(
+                'MATCH (n:`{label}`) RETURN count(n)'.format(label=label))
+            counts.append((count[0][0], label))
+        # Nodes with several labels are deleted with the largest one
+        for total, label in sorted(counts, reverse=True):
+            self.write_in_batches(
+                'MATCH (n:`{label}`) WITH n LIMIT $batch_size '
+                'DETACH DELETE n RETURN count(n)'.format(label=label),
+                '{label} nodes'.format(label=label), total)
+        self.write_in_batches(
+            'MATCH (n) WITH n LIMIT $batch_size '
+            'DETACH DELETE n RETURN count(n)', 'unlabeled nodes')
+        self.node_cache.clear()
+
+        for label, properties, _, unique in indexes:
+            query = index_query('CREATE', label, properties, unique)
+            logging.info(query)
+            self.db.cypher_query(query)
+        logging.info('Database cleared in {seconds:.1f} seconds'.format(
+            seconds=time.time() - start))
+
+    def delete_nodes(self, uids, node_classes, child_relationships=()):
+        """
+        Delete the nodes of the given classes with the given uids ignoring
+        case.
+
+        The uids are matched on the index of each label. Their properties and
+        tags are deleted too, as well as the nodes reached through
+        `child_relationships` with their properties and tags. Shared
+        properties and tags are only deleted when no longer used.
+        """
+        if not uids:
+            return
+        children = '|'.join(child_relationships)
+        query = """
+MATCH (n:{label}) WHERE n.uid IN $uids
+OPTIONAL MATCH (n)-[{children}]->(c)
+OPTIONAL MATCH (c)-[:OBJ_PROPERTY|OBJ_TAG]->(p)
+DETACH DELETE {properties}c, n
+RETURN count(DISTINCT n){key_values}
+"""
+        uids = [uid.lower() for uid in uids]
+        deleted = 0
+        key_values = set()
+        for label in node_labels(node_classes):
+            results, _ = self.db.cypher_query(
+                query.format(
+                    label=label,
+                    children=(
+                        ':' + children + '*0..1' if children else '*0..0'),
+                    # Shared properties can be used by other nodes
+                    properties=(
+                        'p, ' if self.property_storage == 'node' else ''),
+                    key_values=self.deleted_key_values_column()),
+                {'uids': uids})
+            deleted += results[0][0]
+            key_values.update(self.deleted_key_values(results))
+        self.delete_orphaned_key_values(key_values)
+        self.node_cache.clear()
+        logging.info('Deleted {count} nodes'.format(count=deleted))
+
+    def detach_nodes(self, uids, node_classes, child_relationships=()):
+        """
+        Delete the relationships of the nodes of the given classes with the
+        given uids, except their properties and tags, so they can be mapped
+        again keeping the nodes.
+
+        The nodes reached through `child_relationships` are deleted with
+        their properties and tags, as they are mapped again too.
+        """
+        if not uids:
+            return
+        query = """
+MATCH (n:{label}) WHERE n.uid IN $uids
+OPTIONAL MATCH (n)-[r]-() WHERE NOT type(r) IN $kept
+DELETE r
+WITH DISTINCT n
+"""
+        if child_relationships:
+            query += """
+OPTIONAL MATCH (n)-[:{children}]->(c)
+OPTIONAL MATCH (c)-[:OBJ_PROPERTY|OBJ_TAG]->(p)
+DETACH DELETE {properties}c
+""".format(
+                children='|'.join(child_relationships),
+                # Shared properties can be used by other nodes
+                properties=(
+                    'p, ' if self.property_storage == 'node' else ''))
+        query += 'RETURN count(DISTINCT n)'
+        if child_relationships:
+            query += self.deleted_key_values_column()
+        uids = [uid.lower() for uid in uids]
+        kept = ['OBJ_PROPERTY', 'OBJ_TAG'] + list(child_relationships)
+        detached = 0
+        key_values = set()
+        for label in node_labels(node_classes):
+            for batch in batches(uids, self.batch_size):
+                results, _ = self.db.cypher_query(
+                    query.format(label=label),
+                    {'uids': batch, 'kept': kept})
+                detached += results[0][0]
+                if child_relationships:
+                    key_values.update(self.deleted_key_values(results))
+        self.delete_orphaned_key_values(key_values)
+        self.node_cache.clear()
+        logging.info('Detached {count} nodes'.format(count=detached))
 
     def create_logger(self, logfile=None):
         """
@@ -153,8 +1501,9 @@ class AvailabilityZone(StructuredNode):
 class ResourceGroup(StructuredNode):
     """RG that groups elements on an AV."""
 
+    uid = StringProperty(unique_index=True)
     name = StringProperty()
-    subscription_id = StringProperty(unique_index=True)
+    subscription_id = StringProperty()
     properties = JSONProperty()
     elements = Relationship('Element', 'ELEMENT_RESOURCE_GROUP')
     object_tags = Relationship('Tag', 'OBJ_TAG')
@@ -164,7 +1513,7 @@ class ResourceGroup(StructuredNode):
 class Property(StructuredNode):
     """Property of an element."""
 
-    key = StringProperty()
+    key = StringProperty(index=True)
     value = StringProperty()
 
 
@@ -222,7 +1571,7 @@ class LoadBalancer(Element):
     public_ip = Relationship('PublicIp', 'LB_PUBLIC_IP')
     inbound_rules = Relationship('InboundRule', 'INBOUND_RULE')
     outbound_rules = Relationship('OutboundRule', 'OUTBOUND_RULE')
-    backend_pool_id = StringProperty()
+    backend_pool_id = StringProperty(index=True)
 
 
 class PublicIp(Element):
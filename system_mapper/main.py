@@ -17,7 +17,15 @@ if __name__ == "__main__":
             from system_mapper.provider_azure.azure_mapper import run_mapper
             run_mapper(
                 reset=run_mapper_config['reset'],
-                export_path=run_mapper_config['export_path'])
+                export_path=run_mapper_config['export_path'],
+                incremental=run_mapper_config.get('incremental', False),
+                replay=run_mapper_config.get('replay'),
+                migrate=run_mapper_config.get(
+                    'migrate_property_storage', False),
+                upsert=run_mapper_config.get('upsert', False),
+                sync=run_mapper_config.get('sync', False),
+                normalize=run_mapper_config.get(
+                    'normalize_lookup_keys', False))
 
     if 'visualization' in CONFIG:
         visualization = CONFIG['visualization']
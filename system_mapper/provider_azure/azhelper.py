@@ -2,13 +2,19 @@
 """Helper to use azure CLI programatically."""
 
 # Standard library imports
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from datetime import date, datetime
+import io
 import json
 import logging
+import threading
 
 # Third-party imports
 from azure.cli.core import get_default_cli
-import tempfile
+
+# Local imports
+from system_mapper.provider_azure.throttling import (
+    is_throttling_error, ThrottledError)
 
 # Logging config
 logging.basicConfig(level=logging.INFO)
@@ -16,6 +22,50 @@ logging.basicConfig(level=logging.INFO)
 
 SUCCESS_CODE = 0
 
+# Maximum number of rows the Resource Graph API returns in a single page
+DEFAULT_PAGE_SIZE = 1000
+
+# Maximum number of subscriptions the Resource Graph API accepts per request
+MAX_SUBSCRIPTIONS = 1000
+
+# The az CLI keeps global state and is not thread-safe, so its commands are
+# invoked one at a time
+AZ_CLI_LOCK = threading.Lock()
+
+
+class ResourceGraphError(Exception):
+    """Error returned by a resource graph query."""
+
+    def __init__(self, code, data):
+        super().__init__(
+            'Resource graph query failed with code {code}: {data}'.format(
+                code=code, data=data))
+        self.code = code
+        self.data = data
+
+
+def _normalize_null_values(values):
+    """Replace the null values of a list, including nested lists."""
+    return [
+        '' if value is None else
+        _normalize_null_values(value) if isinstance(value, list) else value
+        for value in values]
+
+
+def normalize_nulls(obj):
+    """
+    Replace null values with empty strings.
+
+    Meant to be used as `object_hook` while decoding JSON so the rows keep
+    the format the rest of the mapper expects.
+    """
+    for key, value in obj.items():
+        if value is None:
+            obj[key] = ''
+        elif isinstance(value, list):
+            obj[key] = _normalize_null_values(value)
+    return obj
+
 
 def az_cli(args):
     """
@@ -23,16 +73,35 @@ def az_cli(args):
 
     For example "vm list". When having extension installed they are
     also callable, for example "query -q 'Resources'"
+
+    The output is captured in an in-memory buffer and decoded in a single
+    call once the command finishes, so the whole output is held in memory
+    while it is decoded. Paging the queries bounds the size of each output.
+    Null values are replaced with empty strings on the decoded objects.
+
+    When the command fails the CLI logs the error instead of writing it to
+    the output, so the exception raised by the command is returned then.
+
+    Calls from several threads are serialized with `AZ_CLI_LOCK`.
     """
-    temp = tempfile.TemporaryFile(mode="r+")
-    code = get_default_cli().invoke(args, out_file=temp)
-    temp.seek(0)
-    data = temp.read().strip()
-    temp.close()
+    output = io.StringIO()
+    with AZ_CLI_LOCK:
+        cli = get_default_cli()
+        code = cli.invoke(args, out_file=output)
+    output.seek(0)
     if code == SUCCESS_CODE:
-        return code, json.loads(data.replace('null', '""'))
+        data = json.load(output, object_hook=normalize_nulls)
+        if data is None:
+            data = ''
+        elif isinstance(data, list):
+            data = _normalize_null_values(data)
     else:
-        return code, data
+        data = output.getvalue().strip()
+        error = getattr(cli.result, 'error', None)
+        if not data and error is not None:
+            data = error
+    output.close()
+    return code, data
 
 
 def az_status():
@@ -55,9 +124,18 @@ def az_login():
         return az_cli(['account', 'list'])
 
 
-def az_resource_graph(query, subscription=None):
-    """Use resource graph to query available resources."""
+def az_resource_graph(query, subscription=None, first=None, skip_token=None):
+    """
+    Use resource graph to query available resources.
+
+    Only one page of results is returned. Use `first` to set the page size
+    and `skip_token` to request the page following a previous one.
+    """
     command = ['graph', 'query', '-q', query, '--debug']
+    if first is not None:
+        command += ['--first', str(first)]
+    if skip_token is not None:
+        command += ['--skip-token', skip_token]
     if subscription is not None:
         subscriptions = subscription.split()
         command += ['--subscription'] + subscriptions
@@ -66,6 +144,117 @@ def az_resource_graph(query, subscription=None):
     return az_cli(command)
 
 
+def split_page(data):
+    """
+    Return the rows and the skip token of a resource graph response.
+
+    Newer versions of the resource-graph extension return a dict with the
+    rows under `data` and the continuation under `skip_token`. Older ones
+    return the list of rows directly.
+    """
+    if isinstance(data, dict):
+        rows = data.get('data') or []
+        skip_token = data.get('skip_token') or data.get('$skipToken')
+        return rows, skip_token or None
+    return data or [], None
+
+
+def paginate(fetch_page, query, subscription=None, first=DEFAULT_PAGE_SIZE,
+             stats=None, name='query'):
+    """
+    Yield the rows of a resource graph query page by page.
+
+    `fetch_page` is called with the query, subscription, page size and skip
+    token and returns the decoded response of one page. Skip tokens are
+    followed until the last page. If a `stats` dict is given it is updated
+    with the number of pages and rows retrieved. The progress is logged
+    with `name`, to tell apart the queries running at the same time.
+    """
+    if stats is None:
+        stats = {}
+    stats['pages'] = 0
+    stats['rows'] = 0
+    skip_token = None
+    while True:
+        rows, skip_token = split_page(fetch_page(
+            query, subscription=subscription, first=first,
+            skip_token=skip_token))
+        stats['pages'] += 1
+        stats['rows'] += len(rows)
+        logging.info('Retrieved page {page} of {name} ({rows} rows)'.format(
+            page=stats['pages'], name=name, rows=len(rows)))
+        yield rows
+        if skip_token is None:
+            break
+    logging.info('Query {name} finished: {pages} pages, {rows} rows'.format(
+        name=name, pages=stats['pages'], rows=stats['rows']))
+
+
+def az_resource_graph_page(query, subscription=None, first=None,
+                           skip_token=None):
+    """Return one page of a resource graph query or raise an error."""
+    code, data = az_resource_graph(
+        query, subscription=subscription, first=first, skip_token=skip_token)
+    if code != SUCCESS_CODE:
+        if is_throttling_error(data):
+            raise ThrottledError(data)
+        raise ResourceGraphError(code, data)
+    return data
+
+
+def az_resource_graph_pages(
+        query, subscription=None, first=DEFAULT_PAGE_SIZE, stats=None):
+    """Yield the rows of a resource graph query page by page."""
+    return paginate(
+        az_resource_graph_page, query, subscription=subscription,
+        first=first, stats=stats)
+
+
+def shard_subscriptions(subscriptions, batch_size=MAX_SUBSCRIPTIONS):
+    """Split a list of subscriptions in space separated batches."""
+    return [
+        ' '.join(subscriptions[index:index + batch_size])
+        for index in range(0, len(subscriptions), batch_size)]
+
+
+def iter_sharded(fetch_rows, query, subscriptions,
+                 batch_size=MAX_SUBSCRIPTIONS, max_workers=4):
+    """
+    Yield the rows of a query run over batches of subscriptions.
+
+    The batches are fetched in parallel with `fetch_rows(query, subscription)`
+    and their rows are yielded as each batch completes. Rows with an `id`
+    already yielded are skipped.
+    """
+    batches = shard_subscriptions(subscriptions, batch_size=batch_size)
+    logging.info('Running query over {count} subscription batches'.format(
+        count=len(batches)))
+    seen_ids = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                lambda batch: list(fetch_rows(query, subscription=batch)),
+                batch)
+            for batch in batches]
+        for future in as_completed(futures):
+            for row in future.result():
+                row_id = row.get('id', '').lower()
+                if row_id:
+                    if row_id in seen_ids:
+                        continue
+                    seen_ids.add(row_id)
+                yield row
+
+
+def az_resource_graph_rows(
+        query, subscription=None, first=DEFAULT_PAGE_SIZE, stats=None):
+    """Yield the rows of a resource graph query one by one."""
+    for page in az_resource_graph_pages(
+            query, subscription=subscription, first=first, stats=stats):
+        for row in page:
+            yield row
+
+
 if __name__ == "__main__":
     """Test CLI programatically execution."""
     login = az_login()
@@ -4,290 +4,665 @@
 Azure infrastructure domain mapping.
 """
 # Standard library imports
+from collections import OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor, wait
+from functools import partial
 import json
 import logging
+import os
 
 # Third-party imports
 from pandas import DataFrame
-from neomodel import DoesNotExist
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from requests_ntlm import HttpNtlmAuth
-import xmltodict
 
 # Local imports
 from system_mapper.provider_azure.azhelper import (
-    az_cli, az_login, az_resource_graph, SUCCESS_CODE)
+    az_cli, az_login, az_resource_graph_page, DEFAULT_PAGE_SIZE,
+    iter_sharded, MAX_SUBSCRIPTIONS, normalize_nulls, paginate, split_page,
+    SUCCESS_CODE)
+from system_mapper.provider_azure.cache import (
+    ConditionalCache, DEFAULT_MAX_SIZE, DEFAULT_TTL, load_snapshot,
+    ResponseCache, save_snapshot)
+from system_mapper.provider_azure.iis import (
+    CircuitOpenError, DEFAULT_CONNECT_TIMEOUT, DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_HOST_CONCURRENCY, DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT,
+    IISSessionPool, PoolClosedError)
+from system_mapper.provider_azure.incremental import (
+    changes_query, current_watermark, DEFAULT_RETENTION_DAYS,
+    DEFAULT_STATE_PATH, expired_watermarks, resources_filter,
+    split_changes, WatermarkStore)
+from system_mapper.provider_azure.mappings import (
+    MAPPING_STAGES, RESOURCE_MAPPINGS)
+from system_mapper.provider_azure.queries import (
+    consolidated_query, partition_by_type, projected_queries,
+    RESOURCE_GRAPH_QUERIES, RESOURCE_TYPES)
+from system_mapper.provider_azure.resource_graph import (
+    RESOURCE_GRAPH_URL, ResourceGraphRestClient, StaticTokenProvider)
+from system_mapper.provider_azure.sync import (
+    DEFAULT_MANIFEST_PATH, load_manifest, save_manifest, write_report)
+from system_mapper.provider_azure.throttling import ThrottlingScheduler
+from system_mapper.provider_azure.web_config import (
+    DEFAULT_MAX_SIZE as DEFAULT_WEB_CONFIG_MAX_SIZE, DEFAULT_SECTIONS,
+    parse_web_config)
 from system_mapper.graph import (
-        DeployedApplication, BaseGraphMapper, Database, Disk, NetworkInterface,
-        NetworkSecurityGroup, ResourceGroup, Subnet, VirtualNetwork,
-        VirtualMachine, LoadBalancer, PublicIp, PrivateIp, Service, Storage,
-        Owner)
+        DeployedApplication, BaseGraphMapper, Database, Disk, Element,
+        NetworkInterface, NetworkSecurityGroup, ResourceGroup, Subnet,
+        VirtualNetwork, VirtualMachine, LoadBalancer, node_labels, Property,
+        PublicIp, PrivateIp, RelationshipBatch, Service, Storage, Tag, Owner)
 
 
 # Suppress SSL warnings
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
+# Default number of resource graph queries run at the same time
+DEFAULT_PARALLELISM = 4
+
+WEB_CONFIG_FILE = 'web.config'
+
+WEB_CONFIG_CHUNK = 64 * 1024
+
+# Default number of virtual machines queried at the same time for IIS data
+DEFAULT_APP_PARALLELISM = 8
+
+# Above this number of changes incremental runs do a full refresh instead
+DEFAULT_INCREMENTAL_MAX_CHANGES = 10000
+
+# Data keys with the rows of the resources mapped as graph elements
+RESOURCES_KEYS = [
+    'app_services', 'app_services_plans', 'storage_accounts',
+    'network_interfaces', 'public_ips', 'virtual_machines',
+    'network_security_groups', 'virtual_networks', 'disks',
+    'load_balancers', 'databases']
+
+# Relationships to the nodes deleted with their parent element
+CHILD_RELATIONSHIPS = ['SUBNET', 'PRIVATE_IP', 'DEPLOYED_APPLICATION']
+
+# Classes and relationship types of the nodes and relationships written
+# by the mapping, used to remove the stale ones after an upsert
+NODE_CLASSES = [
+    Owner, ResourceGroup, PublicIp, Service, Storage, LoadBalancer,
+    VirtualNetwork, Subnet, NetworkInterface, PrivateIp,
+    NetworkSecurityGroup, VirtualMachine, DeployedApplication, Disk]
+
+# Indexes on several properties used by the lookups of the mapping, the
+# ones on a single property are declared in the node classes
+COMPOSITE_INDEXES = [
+    (Property, ('key', 'value')),
+    (Tag, ('key', 'value'))]
+
+RELATIONSHIP_TYPES = [
+    'OWNED_RESOURCE_GROUP', 'OWNED_ELEMENT', 'ELEMENT_RESOURCE_GROUP',
+    'SERVICE_ELEMENTS', 'LB_PUBLIC_IP', 'SUBNET', 'SUBNET_NI', 'PUBLIC_IP',
+    'VM_BACKEND_POOL', 'PRIVATE_IP', 'NETWORK_SECURITY_GROUP',
+    'NETWORK_INTERFACE', 'DEPLOYED_APPLICATION', 'DISK']
+
+# Resources whose mapping creates relationships with the given ones. They
+# need to be mapped again when the given resources are re-created. The
+# query is run for each label so the uids are matched with its index.
+DEPENDENT_RESOURCES_QUERY = """
+MATCH (n:{label}) WHERE n.uid IN $uids
+OPTIONAL MATCH (n)-[:SUBNET*0..1]->(x)
+OPTIONAL MATCH (x)<-[r]-(a)
+WHERE type(r) IN ['LB_PUBLIC_IP', 'PUBLIC_IP', 'SUBNET_NI',
+ 'NETWORK_SECURITY_GROUP', 'NETWORK_INTERFACE']
+OPTIONAL MATCH (x)-[:VM_BACKEND_POOL|DISK|SERVICE_ELEMENTS]->(b)
+RETURN collect(DISTINCT a.uid) + collect(DISTINCT b.uid)
+"""
+
+
 class AzureGraphMapper(BaseGraphMapper):
     """Azure implementation of a graph mapper."""
 
     PROVIDER_NAME = 'AZURE'
 
-    def get_app_data(
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        rest_backend = self.config.get(
+            'resource_graph_backend', 'cli') == 'rest'
+        # The az CLI runs one command at a time, only the REST backend runs
+        # queries concurrently
+        self.parallelism = 1
+        if rest_backend:
+            self.parallelism = self.config.get(
+                'resource_graph_parallelism', DEFAULT_PARALLELISM)
+        self.scheduler = ThrottlingScheduler(
+            max_concurrency=self.parallelism,
+            max_retries=self.config.get('resource_graph_max_retries', 5))
+        # Subscriptions used to shard the queries
+        self.subscriptions = []
+        # Incremental ingestion state
+        self.watermark_store = WatermarkStore(self.config.get(
+            'incremental_state_path', DEFAULT_STATE_PATH))
+        self.run_watermark = None
+        # IIS Administration API sessions
+        self.iis_sessions = IISSessionPool(
+            token=self.config.get('app_container_token'),
+            user=self.config.get('app_container_user'),
+            password=self.config.get('app_container_password'),
+            port=self.config.get('port'),
+            pool_size=self.config.get(
+                'app_container_pool_size', DEFAULT_POOL_SIZE),
+            connect_timeout=self.config.get(
+                'app_container_connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=self.config.get(
+                'app_container_read_timeout', DEFAULT_READ_TIMEOUT),
+            host_concurrency=self.config.get(
+                'app_container_host_concurrency', DEFAULT_HOST_CONCURRENCY),
+            failure_threshold=self.config.get(
+                'app_container_failure_threshold', DEFAULT_FAILURE_THRESHOLD),
+            scheme=self.config.get('app_container_scheme', 'https'))
+        # Responses cache
+        self.cache = None
+        self.web_config_cache = None
+        if self.config.get('cache_path'):
+            self.cache = ResponseCache(
+                self.config['cache_path'],
+                ttl=self.config.get('cache_ttl', DEFAULT_TTL),
+                max_size=self.config.get(
+                    'cache_max_size', DEFAULT_MAX_SIZE))
+            self.web_config_cache = ConditionalCache(
+                os.path.join(self.config['cache_path'], 'web_config'))
+        # Resource graph backend: az CLI (default) or REST API client, the
+        # latter using the configured token instead of the az CLI if given
+        self.resource_graph_client = None
+        self.uses_az_cli = True
+        if rest_backend:
+            token_provider = None
+            if self.config.get('resource_graph_token'):
+                token_provider = StaticTokenProvider(
+                    self.config['resource_graph_token'])
+                self.uses_az_cli = False
+            self.resource_graph_client = ResourceGraphRestClient(
+                endpoint=self.config.get(
+                    'resource_graph_endpoint', RESOURCE_GRAPH_URL),
+                token_provider=token_provider,
+                pool_size=self.parallelism,
+                scheduler=self.scheduler)
+
+    def get_app_data(self, host):
+        """
+        Get deployed application data from IIS using the cache if enabled.
+
+        Only the complete results are cached, without errors nor skipped
+        websites, so the missing applications are retried in the next run.
+        """
+        if self.cache is None:
+            return self.fetch_app_data(host)
+        key = self.cache.key(
+            'iis', host, self.config['port'],
+            self.config['app_container_url'])
+        applications = self.cache.get(key)
+        if applications is None:
+            failed = []
+            applications = self.fetch_app_data(host, failed=failed)
+            # Partial results and errors are not cached
+            if not failed:
+                self.cache.put(key, applications)
+            else:
+                logging.info(
+                    'Applications of {host} not cached, {count} websites '
+                    'failed'.format(host=host, count=len(failed)))
+        return applications
+
+    def fetch_app_data(
             self,
-            host):
+            host,
+            failed=None):
         """
         Get deployed application data from IIS.
+
+        A website failing with a connection error is skipped and counted by
+        the circuit of the host, so the host is given up once the circuit
+        opens, keeping the websites already fetched. The skipped websites
+        are added to the `failed` list if given, or the websites list URL
+        if the list could not be read.
         """
-        port = self.config['port']
         app_container_url = self.config['app_container_url']
-        app_container_token = self.config['app_container_token']
-        user = self.config['app_container_user']
-        password = self.config['app_container_password']
+        iis = self.iis_sessions
         try:
             response = []
             # Check a way to search file
-            headers = {
-                'Access-Token': 'Bearer {token}'.format(
-                    token=app_container_token),
-                'Accept': 'application/hal+json'
-                }
-            # TODO: Setup cert file of the IIS server
-            base_url = 'https://{host}:{port}'.format(host=host, port=port)
-            base_info = requests.get(
-                base_url + app_container_url,
-                headers=headers,
-                verify=False,
-                auth=HttpNtlmAuth(user, password))
+            base_info = iis.get(host, app_container_url)
             applications_status = base_info.status_code
             applications_content = base_info.text
             if applications_status == requests.codes.ok:
                 applications = json.loads(applications_content)
                 if 'websites' in applications:
-                    for application in applications['websites']:
-                        app_info_url = application['_links']['self']['href']
-                        app_info = requests.get(
-                            base_url + app_info_url,
-                            headers=headers,
-                            verify=False,
-                            auth=HttpNtlmAuth(user, password))
-                        app_info_status = app_info.status_code
-                        app_info_content = json.loads(
-                            app_info.text)
-                        if app_info_status == requests.codes.ok:
-                            dir_files_url = app_info_content[
-                                '_links']['files']['href']
-                            web_config = {}
-                            dir_files_info = requests.get(
-                                base_url + dir_files_url,
-                                headers=headers,
-                                verify=False,
-                                auth=HttpNtlmAuth(user, password))
-                            dir_files_info_content = json.loads(
-                                dir_files_info.text)
-                            files_info_url = dir_files_info_content[
-                                '_links']['files']['href']
-                            files_info = json.loads(requests.get(
-                                base_url + files_info_url,
-                                headers=headers,
-                                verify=False,
-                                auth=HttpNtlmAuth(user, password)).text)
-
-                            for file in files_info['files']:
-                                if file['name'] == "web.config":
-                                    file_url = file['_links']['self']['href']
-                                    file_info = requests.get(
-                                        base_url + file_url,
-                                        headers=headers,
-                                        verify=False,
-                                        auth=HttpNtlmAuth(user, password))
-                                    file_info_content_url = json.loads(
-                                        file_info.text)['file_info'][
-                                            '_links']['self']['href']
-                                    file_content = requests.get(
-                                        base_url +
-                                        file_info_content_url.replace(
-                                            '/api/files',
-                                            '/api/files/content'),
-                                        headers=headers,
-                                        verify=False,
-                                        auth=HttpNtlmAuth(user, password)).text
-                                    web_config = dict(
-                                            xmltodict.parse(
-                                                file_content,
-                                                process_namespaces=True))
-                                    app_info_content['web_config'] = web_config
-                        response.append(app_info_content)
+                    websites = applications['websites']
+                    for index, application in enumerate(websites):
+                        try:
+                            response.append(self.fetch_website_data(
+                                host, application))
+                        except requests.RequestException as e:
+                            logging.error(e)
+                            if failed is not None:
+                                failed.append(application)
+                        except (CircuitOpenError, PoolClosedError) as e:
+                            logging.error(e)
+                            if failed is not None:
+                                failed.extend(websites[index:])
+                            break
             return response
         except Exception as e:
             logging.error(e)
-            return {}
+            if failed is not None:
+                failed.append(app_container_url)
+            return []
+
+    def fetch_website_data(self, host, application):
+        """Get the data of a website from IIS."""
+        iis = self.iis_sessions
+        app_info_url = application['_links']['self']['href']
+        app_info = iis.get(host, app_info_url)
+        app_info_status = app_info.status_code
+        app_info_content = json.loads(app_info.text)
+        if app_info_status == requests.codes.ok:
+            dir_files_url = app_info_content['_links']['files']['href']
+            dir_files_info = iis.get(host, dir_files_url)
+            dir_files_info_content = json.loads(dir_files_info.text)
+            files_info_url = dir_files_info_content[
+                '_links']['files']['href']
+            web_config = self.fetch_web_config(
+                host, app_info_content['id'], files_info_url)
+            if web_config is not None:
+                app_info_content['web_config'] = web_config
+        return app_info_content
+
+    def fetch_web_config(self, host, site_id, files_info_url):
+        """
+        Get the parsed `web.config` file of a website.
 
-    def get_data(self):
-        """Use Azure Resource Graph to get the data."""
+        The content is parsed while it is downloaded and only the sections
+        listed in `web_config_sections` are kept, reading at most
+        `web_config_max_size` bytes.
+
+        Only the `web.config` entry of the files of the website is used.
+        When the cache is enabled the file content is only downloaded if
+        its modification date changed, and then using a conditional request
+        with the ETag and Last-Modified values of the cached version.
+        Returns `None` if the website has no `web.config` file.
+        """
+        iis = self.iis_sessions
+        files_info = json.loads(iis.get(host, files_info_url).text)
+        file = next(
+            (file for file in files_info['files']
+             if file['name'] == WEB_CONFIG_FILE),
+            None)
+        if file is None:
+            return None
+        file_info = json.loads(
+            iis.get(host, file['_links']['self']['href']).text)['file_info']
+        content_url = file_info['_links']['self']['href'].replace(
+            '/api/files', '/api/files/content')
+
+        key = None
+        cached = None
+        if self.web_config_cache is not None:
+            key = self.web_config_cache.key(host, site_id, WEB_CONFIG_FILE)
+            cached = self.web_config_cache.get(key)
+        sections = self.config.get('web_config_sections', DEFAULT_SECTIONS)
+        if cached is not None and cached.get('sections') != sections:
+            # Cached with other sections
+            cached = None
+        if (cached is not None and file_info.get('last_modified') and
+                cached['file_last_modified'] ==
+                file_info['last_modified']):
+            return cached['web_config']
+
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        file_content = iis.get(
+            host, content_url, headers=headers, stream=True)
+        try:
+            status = file_content.status_code
+            if cached is not None and status == requests.codes.not_modified:
+                web_config = cached['web_config']
+            elif status == requests.codes.ok:
+                web_config = parse_web_config(
+                    file_content.iter_content(chunk_size=WEB_CONFIG_CHUNK),
+                    sections=sections,
+                    max_size=self.config.get(
+                        'web_config_max_size', DEFAULT_WEB_CONFIG_MAX_SIZE))
+            else:
+                # Errors are not parsed nor cached
+                logging.warning(
+                    'Error {status} getting {file} of {host}'.format(
+                        status=status, file=WEB_CONFIG_FILE, host=host))
+                return None
+        finally:
+            file_content.close()
+        if key is not None:
+            etag = file_content.headers.get('ETag')
+            last_modified = file_content.headers.get('Last-Modified')
+            if status == requests.codes.not_modified:
+                # Not modified responses may omit the validators
+                etag = etag or cached['etag']
+                last_modified = last_modified or cached['last_modified']
+            self.web_config_cache.put(key, {
+                'etag': etag,
+                'last_modified': last_modified,
+                'file_last_modified': file_info.get('last_modified'),
+                'sections': sections,
+                'web_config': web_config})
+        return web_config
+
+    def get_applications_data(self, virtual_machines):
+        """
+        Get the deployed applications of the virtual machines from IIS.
+
+        The hosts are queried concurrently by up to
+        `app_container_parallelism` threads. The virtual machines not done
+        after `app_container_deadline` seconds are skipped.
+        """
+        hosts = []
+        for vm in virtual_machines:
+            if not self.is_db_virtual_machine(vm):
+                # Get application data using public ip
+                vm_ip = (
+                    vm['publicIpAddress']
+                    if 'publicIpAddress' in vm and vm['publicIpAddress']
+                    else vm['privateIpAddress'])
+                hosts.append((vm['id'], vm_ip))
+        self.iis_sessions.open()
+        executor = ThreadPoolExecutor(max_workers=self.config.get(
+            'app_container_parallelism', DEFAULT_APP_PARALLELISM))
+        futures = [
+            (vm_id, executor.submit(self.get_app_data, vm_ip))
+            for vm_id, vm_ip in hosts]
+        _, not_done = wait(
+            [future for _, future in futures],
+            timeout=self.config.get('app_container_deadline'))
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+        # The requests still running fail instead of opening new sessions
+        self.iis_sessions.close()
+        if not_done:
+            logging.warning(
+                'Deadline reached, {count} virtual machines skipped'.format(
+                    count=len(not_done)))
+        applications = []
+        for vm_id, future in futures:
+            if future not in not_done:
+                app_data = {}
+                app_data['virtual_machine_id'] = vm_id
+                app_data['applications'] = future.result()
+                applications.append(app_data)
+        return applications
+
+    def iter_resource_graph(self, query, subscription=None, name='query'):
+        """
+        Yield the rows of a resource graph query, logging its progress with
+        `name`.
+
+        When `resource_graph_paginate` is enabled (default) the rows are
+        retrieved page by page following the skip tokens, with pages of
+        `resource_graph_page_size` rows. Otherwise only the first page
+        returned by the API is used.
+
+        When there are more subscriptions than
+        `resource_graph_subscription_batch` the query is run in parallel
+        over batches of subscriptions and the rows are de-duplicated by id.
+        """
+        subscriptions = (
+            subscription.split() if subscription is not None
+            else self.subscriptions)
+        batch_size = self.config.get(
+            'resource_graph_subscription_batch', MAX_SUBSCRIPTIONS)
+        if len(subscriptions) > batch_size:
+            rows = iter_sharded(
+                partial(self.iter_resource_graph, name=name), query,
+                subscriptions, batch_size=batch_size,
+                max_workers=self.parallelism)
+            for row in rows:
+                yield row
+            return
+
+        if self.resource_graph_client is not None:
+            fetch_page = self.resource_graph_client.query
+        else:
+            fetch_page = partial(self.scheduler.run, az_resource_graph_page)
+        if self.config.get('resource_graph_paginate', True):
+            pages = paginate(
+                fetch_page,
+                query,
+                subscription=subscription,
+                first=self.config.get(
+                    'resource_graph_page_size', DEFAULT_PAGE_SIZE),
+                name=name)
+        else:
+            rows, _ = split_page(fetch_page(query, subscription=subscription))
+            pages = [rows]
+        for page in pages:
+            for row in page:
+                yield row
+
+    def query_resource_graph(self, query, subscription=None, name='query'):
+        """
+        Return the rows of a resource graph query as a list.
+
+        If the cache is enabled the rows are taken from it when available.
+        The pages are requested one by one, so only the size of each
+        response is bounded: all the rows of the query are kept, as the
+        mapping stages, the cache and the snapshot use the complete lists.
+        """
+        if self.cache is None:
+            return list(self.iter_resource_graph(
+                query, subscription=subscription, name=name))
+        key = self.cache.key(
+            'resource_graph', query,
+            subscription or ' '.join(self.subscriptions))
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = list(self.iter_resource_graph(
+                query, subscription=subscription, name=name))
+            self.cache.put(key, rows)
+        return rows
+
+    def run_queries(self, queries):
+        """
+        Run multiple resource graph queries concurrently.
+
+        `queries` maps the data keys to the queries to run. With the REST
+        backend at most `resource_graph_parallelism` queries are in flight
+        at the same time, with the az CLI they are run one after another.
+        Returns a dict with the rows of each query under its key.
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = {
+                executor.submit(
+                    self.query_resource_graph, query, name=key): key
+                for key, query in queries.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                results[key] = future.result()
+                logging.info('Query {key} done ({count} rows)'.format(
+                    key=key, count=len(results[key])))
+        return results
+
+    def get_dependent_uids(self, uids):
+        """
+        Return the uids of the resources depending on the given ones.
+
+        The dependencies are followed transitively. The given uids are
+        included in the result. All the uids are lower cased.
+        """
+        uids = set(uid.lower() for uid in uids)
+        pending = uids
+        while pending:
+            dependent = set()
+            for label in node_labels(NODE_CLASSES):
+                results, _ = self.db.cypher_query(
+                    DEPENDENT_RESOURCES_QUERY.format(label=label),
+                    {'uids': list(pending)})
+                dependent.update(results[0][0])
+            pending = dependent - uids - {None}
+            uids |= pending
+        return uids
+
+    def get_changes(self):
+        """
+        Return the changes made since the last run.
+
+        Returns the ids of the resources to fetch again, the ids of the
+        deleted resources and the subscriptions without watermark, that are
+        fetched completely. Returns `None` when a full refresh is needed.
+        """
+        watermarks = self.watermark_store.load()
+        watermarks = OrderedDict(
+            (subscription, watermarks[subscription])
+            for subscription in self.subscriptions
+            if subscription in watermarks)
+        if not watermarks:
+            logging.info('No watermarks available, running a full refresh')
+            return None
+        expired = expired_watermarks(watermarks, self.config.get(
+            'incremental_retention_days', DEFAULT_RETENTION_DAYS))
+        if expired:
+            logging.info(
+                'Watermarks of {subscriptions} older than the resource '
+                'changes retention, running a full refresh'.format(
+                    subscriptions=', '.join(expired)))
+            return None
+        new_subscriptions = [
+            subscription for subscription in self.subscriptions
+            if subscription not in watermarks]
+        changed_ids, deleted_ids = split_changes(
+            self.iter_resource_graph(
+                changes_query(watermarks), name='changes'))
+        max_changes = self.config.get(
+            'incremental_max_changes', DEFAULT_INCREMENTAL_MAX_CHANGES)
+        if len(changed_ids) + len(deleted_ids) > max_changes:
+            logging.info('Too many changes, running a full refresh')
+            return None
+        changed_ids = self.get_dependent_uids(changed_ids) - deleted_ids
+        logging.info(
+            '{changed} resources to update, {deleted} deleted, '
+            '{new} new subscriptions'.format(
+                changed=len(changed_ids), deleted=len(deleted_ids),
+                new=len(new_subscriptions)))
+        return changed_ids, deleted_ids, new_subscriptions
+
+    def get_resources_data(self, incremental=False):
+        """
+        Run the resource graph queries and return their rows by data key.
+
+        With `resource_graph_consolidated` enabled the resources retrieved
+        only by type are fetched with a single query and partitioned by
+        type instead of using one query per type.
+
+        Unless `resource_graph_projection` is `full` only the columns and
+        properties used by the mapper and the dashboard are retrieved.
+
+        When `incremental` is true only the resources changed since the last
+        run are retrieved and the deleted ones are listed under
+        `deleted_ids`. `deleted_ids` is `None` when a full refresh is done.
+        """
+        project = self.config.get(
+            'resource_graph_projection', 'compact') != 'full'
+        queries = RESOURCE_GRAPH_QUERIES
+        if project:
+            queries = projected_queries(queries)
+
+        # Get the subscriptions first to shard the other queries by them
+        subscriptions = self.query_resource_graph(
+            queries['subscriptions'], name='subscriptions')
+        self.subscriptions = [s['subscriptionId'] for s in subscriptions]
+        queries = OrderedDict(
+            (key, query) for key, query in queries.items()
+            if key != 'subscriptions')
+
+        if self.config.get('resource_graph_consolidated', False):
+            queries = OrderedDict(
+                (key, query) for key, query in queries.items()
+                if key not in RESOURCE_TYPES)
+            queries['resources'] = consolidated_query(
+                RESOURCE_TYPES, project=project)
+
+        changes = self.get_changes() if incremental else None
+        if changes is not None:
+            changed_ids, deleted_ids, new_subscriptions = changes
+            where = resources_filter(changed_ids, new_subscriptions)
+            queries = OrderedDict(
+                (key, query if key == 'resource_groups'
+                 else '{query} {where}'.format(query=query, where=where))
+                for key, query in queries.items())
+
+        data = self.run_queries(queries)
+        if 'resources' in data:
+            data.update(partition_by_type(
+                data.pop('resources'), RESOURCE_TYPES))
+        data['subscriptions'] = subscriptions
+        data['deleted_ids'] = (
+            sorted(changes[1]) if changes is not None else None)
+        return data
+
+    def get_data(self, incremental=False):
+        """
+        Use Azure Resource Graph to get the data.
+
+        With `incremental` only the resources changed since the last run are
+        retrieved (see `get_resources_data`).
+
+        The az CLI login is skipped when the REST backend uses the
+        configured `resource_graph_token`. The REST client is closed at the
+        end.
+        """
         data = {}
+        self.run_watermark = current_watermark()
         try:
-            code, login = az_login()
-            logging.info('Available subscriptions:')
-            logging.info(code)
-            logging.info(login)
+            code = SUCCESS_CODE
+            if self.uses_az_cli:
+                code, login = az_login()
+                logging.info('Available subscriptions:')
+                logging.info(code)
+                logging.info(login)
+                if code == SUCCESS_CODE:
+                    # Refresh accounts lists
+                    logging.info(az_cli(["account", "list", "--refresh"]))
             if code == SUCCESS_CODE:
-                # Refresh accounts lists
-                logging.info(az_cli(["account", "list", "--refresh"]))
-
-                # Get subscriptions
-                s_query = (
-                    'resourcecontainers '
-                    '| where type == '
-                    '"microsoft.resources/subscriptions"')
-                code, data['subscriptions'] = az_resource_graph(
-                    query=s_query)
-
-                # Get resource groups
-                rg_query = (
-                    'resourcecontainers '
-                    '| where type == '
-                    '"microsoft.resources/subscriptions/resourcegroups"')
-                code, data['resource_groups'] = az_resource_graph(
-                    query=rg_query)
-
-                # Get App service instances
-                app_service_query = (
-                    'resources '
-                    '| where type == "microsoft.web/sites"')
-                code, data['app_services'] = az_resource_graph(
-                    query=app_service_query)
-
-                # Get server farms
-                app_services_plans_query = (
-                    'resources '
-                    '| where type == "microsoft.web/serverfarms"')
-                code, data['app_services_plans'] = az_resource_graph(
-                    query=app_services_plans_query)
-
-                # Get Storage accounts
-                storage_accounts_query = (
-                    'resources '
-                    '| where type == '
-                    '"microsoft.storage/storageaccounts"')
-                code, data['storage_accounts'] = az_resource_graph(
-                    query=storage_accounts_query)
-
-                # Get Network interfaces
-                ni_query = (
-                    'resources '
-                    '| where type == "microsoft.network/networkinterfaces"')
-                code, data['network_interfaces'] = az_resource_graph(
-                    query=ni_query)
-
-                # Get Public IPs
-                public_ips_query = (
-                    'resources '
-                    '| where type == "microsoft.network/publicipaddresses"')
-                code, data['public_ips'] = az_resource_graph(
-                    query=public_ips_query)
-
-                # Get VMs
-                vm_query = ("""
-resources
- | where type =~ 'microsoft.compute/virtualmachines'
- | extend nics=array_length(properties.networkProfile.networkInterfaces)
- | mv-expand nic=properties.networkProfile.networkInterfaces
- | where nics == 1 or nic.properties.primary =~ 'true' or isempty(nic)
- | project id, name, size=tostring(properties.hardwareProfile.vmSize),
- nicId = tostring(nic.id), type, properties = tostring(properties),
- resourceGroup = resourceGroup, tostring(tags), subscriptionId, tenantId
- | join kind=leftouter (
-    Resources
-    | where type =~ 'microsoft.network/networkinterfaces'
-     | extend ipConfigsCount=array_length(properties.ipConfigurations)
-     | mv-expand ipconfig=properties.ipConfigurations
-     | where ipConfigsCount == 1 or ipconfig.properties.primary =~ 'true'
-    | project nicId = id,
-     publicIpId = tostring(ipconfig.properties.publicIPAddress.id),
-     privateIpAddress = tostring(ipconfig.properties.privateIPAddress))
- on nicId
- | project-away nicId1
- | summarize by id, name, size, nicId, type, properties, resourceGroup, tags,
- subscriptionId, tenantId, publicIpId, privateIpAddress
- | join kind=leftouter (
-    Resources
-    | where type =~ 'microsoft.network/publicipaddresses'
-    | project publicIpId = id, publicIpAddress = properties.ipAddress)
- on publicIpId
- | project-away publicIpId1
-""")
-                code, data['raw_virtual_machines'] = az_resource_graph(
-                    query=vm_query)
-
-                # Get application data and parse properties:
+                # Run the independent queries concurrently
+                data.update(self.get_resources_data(
+                    incremental=incremental))
+                data['databases'] += data.pop('databases_servers')
+
+                # Parse properties and get application data
+                for vm in data['virtual_machines']:
+                    vm['properties'] = json.loads(
+                        vm['properties'], object_hook=normalize_nulls)
                 data['applications'] = []
-                data['virtual_machines'] = []
-                for vm in data['raw_virtual_machines']:
-                    vm['properties'] = json.loads(vm['properties'])
-                    data['virtual_machines'].append(vm)
-                    if (not self.is_db_virtual_machine(vm) and
-                            self.config['get_app_container_info']):
-                        # Get application data using public ip
-                        vm_ip = (
-                            vm['publicIpAddress']
-                            if 'publicIpAddress' in vm and vm['publicIpAddress']
-                            else vm['privateIpAddress'])
-                        app_data = {}
-                        app_data['virtual_machine_id'] = vm['id']
-                        app_data['applications'] = self.get_app_data(vm_ip)
-                        apps = data['applications']
-                        apps.append(app_data)
-                        data['applications'] = apps
-
-                # Get Networks security groups
-                nsg_query = (
-                    'resources '
-                    ' | where type == '
-                    '"microsoft.network/networksecuritygroups"')
-                code, data['network_security_groups'] = az_resource_graph(
-                    query=nsg_query)
-                # Get Networks
-                v_networks_query = (
-                    'resources '
-                    '| where type == "microsoft.network/virtualnetworks"')
-                code, data['virtual_networks'] = az_resource_graph(
-                    query=v_networks_query)
-                # Get disks
-                disks_query = (
-                    'resources '
-                    '| where type == "microsoft.compute/disks"')
-                code, data['disks'] = az_resource_graph(
-                    query=disks_query)
-                # Get load balancers data
-                lbs_query = (
-                    'resources '
-                    '| where type == "microsoft.network/loadbalancers"')
-                code, data['load_balancers'] = az_resource_graph(
-                    query=lbs_query)
-                # Get databases (1)
-                dbs_query = (
-                    'resources'
-                    ' | where type == "microsoft.sql/servers/databases"')
-                code, data['databases'] = az_resource_graph(
-                    query=dbs_query)
-                # Get databases (2)
-                dbs_query = (
-                    'resources'
-                    ' | where type == "microsoft.sql/servers"')
-                code, databases_servers = az_resource_graph(
-                    query=dbs_query)
-                data['databases'] += databases_servers
+                if self.config['get_app_container_info']:
+                    data['applications'] = self.get_applications_data(
+                        data['virtual_machines'])
 
             # data = data.replace('null', 'None')
             logging.info('Data:')
-            logging.info(json.dumps(data))
+            for key, value in data.items():
+                if isinstance(value, list):
+                    logging.info('{key}: {count} rows'.format(
+                        key=key, count=len(value)))
+            logging.info('Resource graph requests: {metrics}'.format(
+                metrics=self.scheduler.metrics()))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                # The whole data is serialized, only when it is logged
+                logging.debug(json.dumps(data))
+            if self.config.get('snapshot_path'):
+                save_snapshot(data, self.config['snapshot_path'])
             return data
         except Exception as e:
             logging.error("Execution error", exc_info=True)
             raise e
             # return data
+        finally:
+            if self.resource_graph_client is not None:
+                self.resource_graph_client.close()
 
     def is_db_virtual_machine(self, data):
         """
@@ -302,530 +677,198 @@ resources
                 is_db_vm = publisher in self.config['database_strings']
         return is_db_vm
 
-    def map_data(self, reset=False):
-        """Use data a initialize the database model."""
-        if reset:
-            self.clear_database()
-        data = self.get_data()
-
-        # Subscriptions
-        subscriptions = data['subscriptions']
-        for s in subscriptions:
-            subscription = Owner(
-                uid=s['id'].replace('/subscriptions/', ''),
-                name=s['name'], properties=s['properties'])
-            subscription.save()
-
-            # Map properties
-            obj_properties = subscription.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, s, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = subscription.object_tags
-            self.add_tags(obj_tags, s['tags'])
-
-        # Resource group
-        resource_groups = data['resource_groups']
-        for rg in resource_groups:
-            # TODO: location, zones
-            resource_group = ResourceGroup(
-                uid=rg['id'],
-                subscription_id=rg['subscriptionId'],
-                name=rg['resourceGroup'], properties=rg['properties'])
-            resource_group.save()
-
-            # Map properties
-            obj_properties = resource_group.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, rg, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = resource_group.object_tags
-            self.add_tags(obj_tags, rg['tags'])
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=rg['subscriptionId']).resource_groups.connect(
-                    resource_group)
-
-        # Public IP
-        public_ips = data['public_ips']
-        for pip in public_ips:
-            p_ip = PublicIp(
-                uid=pip['id'], name=pip['name'],
-                properties=pip['properties'],
-                tags=pip['tags'])
-            p_ip.save()
-
-            # Map properties
-            obj_properties = p_ip.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, pip, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = p_ip.object_tags
-            self.add_tags(obj_tags, pip['tags'])
-
-            # Connect public ip with resource groups
-            public_ip_resource_group = pip['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=public_ip_resource_group,
-                subscription_id=pip['subscriptionId']).elements.connect(
-                p_ip)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=pip['subscriptionId']).elements.connect(p_ip)
-
-        # App Services Plan
-        app_services_plans = data['app_services_plans']
-        for app_service_plan in app_services_plans:
-            service_plan = Service(
-                uid=app_service_plan['id'].lower(),
-                name=app_service_plan['name'],
-                service_name='AppServicePlan',
-                properties=app_service_plan['properties'],
-                tags=app_service_plan['tags'])
-            service_plan.save()
-
-            # Map properties
-            obj_properties = service_plan.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties,
-                app_service_plan,
-                unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = service_plan.object_tags
-            self.add_tags(obj_tags, app_service_plan['tags'])
-
-            # Connect public ip with resource groups
-            app_resource_group = app_service_plan['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=app_resource_group,
-                subscription_id=app_service_plan['subscriptionId']
-                ).elements.connect(
-                    service_plan)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=app_service_plan['subscriptionId']).elements.connect(
-                    service_plan)
-
-        # App Services
-        app_services = data['app_services']
-        for app_service in app_services:
-            service = Service(
-                uid=app_service['id'],
-                name=app_service['name'],
-                service_name='AppService',
-                properties=app_service['properties'],
-                tags=app_service['tags'])
-            service.save()
-
-            # Map properties
-            obj_properties = service.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties,
-                app_service,
-                unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = service.object_tags
-            self.add_tags(obj_tags, app_service['tags'])
-
-            # Connect public ip with resource groups
-            app_resource_group = app_service['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=app_resource_group,
-                subscription_id=app_service['subscriptionId']
-                ).elements.connect(service)
-
-            # Connect to server farm (AppServicePlan)
-            app_service_plan_id = app_service['properties']['serverFarmId']
-            Service.nodes.get(
-                uid=app_service_plan_id.lower()).elements.connect(service)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=app_service['subscriptionId']).elements.connect(service)
-
-        # Storage Account
-        storage_accounts = data['storage_accounts']
-        for storage_account in storage_accounts:
-            storage = Storage(
-                uid=storage_account['id'],
-                name=storage_account['name'],
-                properties=storage_account['properties'],
-                tags=storage_account['tags'])
-            storage.save()
-
-            # Map properties
-            obj_properties = storage.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties,
-                storage_account,
-                unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = storage.object_tags
-            self.add_tags(obj_tags, storage_account['tags'])
-
-            # Connect public ip with resource groups
-            storage_resource_group = storage_account['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=storage_resource_group,
-                subscription_id=storage_account['subscriptionId']
-                ).elements.connect(
-                    storage)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=storage_account['subscriptionId']).elements.connect(
-                    storage)
-
-        # Load balancers
-        load_balancers = data['load_balancers']
-        for lb in load_balancers:
-            lbalancer = LoadBalancer(
-                uid=lb['id'], name=lb['name'],
-                properties=lb['properties'],
-                tags=lb['tags'],
-                backend_pool_id=lb['properties'][
-                        'backendAddressPools'][0]['id'])
-            lbalancer.save()
-
-            # Map properties
-            obj_properties = lbalancer.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, lb, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = lbalancer.object_tags
-            self.add_tags(obj_tags, lb['tags'])
-
-            # Connect load balancer with resource groups
-            lb_resource_group = lb['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=lb_resource_group,
-                subscription_id=lb['subscriptionId']).elements.connect(
-                    lbalancer)
-
-            # Map public Ip address
-            lb_public_id = lb['properties']['frontendIPConfigurations'][0][
-                'properties']['publicIPAddress']['id']
-            lbalancer.public_ip.connect(PublicIp.nodes.get(uid=lb_public_id))
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=lb['subscriptionId']).elements.connect(lbalancer)
-
-        # Virtual Networks
-        virtual_networks = data['virtual_networks']
-        for vn in virtual_networks:
-            virtual_network = VirtualNetwork(
-                uid=vn['id'], name=vn['name'],
-                properties=vn['properties'],
-                tags=vn['tags'])
-            virtual_network.save()
-
-            # Map properties
-            obj_properties = virtual_network.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, vn, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = virtual_network.object_tags
-            self.add_tags(obj_tags, vn['tags'])
-
-            # Connect ni with resource groups
-            vn_resource_group = vn['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=vn_resource_group,
-                subscription_id=vn['subscriptionId']).elements.connect(
-                    virtual_network)
-
-            # Subnets
-            vn_subnets = vn['properties']['subnets']
-            # TODO: Divide subnets from gateway subnets
-            for sn in vn_subnets:
-                subnet = Subnet(
-                    uid=sn['id'], name=sn['name'], properties=sn['properties'])
-                subnet.save()
-                virtual_network.subnets.connect(subnet)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=vn['subscriptionId']).elements.connect(virtual_network)
-
-        # Network Interfaces
-        network_interfaces = data['network_interfaces']
-        for ni in network_interfaces:
-            network_interface = NetworkInterface(
-                uid=ni['id'], name=ni['name'], properties=ni['properties'],
-                tags=ni['tags'])
-            network_interface.save()
-
-            # Map properties
-            obj_properties = network_interface.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id']
-            self.add_properties(
-                obj_properties, ni, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = network_interface.object_tags
-            self.add_tags(obj_tags, ni['tags'])
-
-            # Connect ni with resource groups
-            ni_resource_group = ni['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=ni_resource_group,
-                subscription_id=ni['subscriptionId']).elements.connect(
-                    network_interface)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=ni['subscriptionId']).elements.connect(network_interface)
-
-            ip_configs = ni['properties']['ipConfigurations']
-            for ipc in ip_configs:
-                # Subnet assingment
-                ni_subnet = ipc['properties']['subnet']['id']
-                network_interface.subnet.connect(Subnet.nodes.get(
-                    uid=ni_subnet))
-
-                # Private Ip address
-                ni_subnet = ipc['properties']['subnet']['id']
-                private_ip = PrivateIp(
-                    name=ipc['properties']['privateIPAddress'])
-                private_ip.save()
-                network_interface.private_ip.connect(private_ip)
-
-                # Connect with public ip address
-                if 'publicIPAddress' in ipc['properties']:
-                    ni_subnet = ipc['properties']['publicIPAddress']['id']
-                    network_interface.public_ip.connect(PublicIp.nodes.get(
-                        uid=ni_subnet))
-
-                # Connect with load balancer
-                if 'loadBalancerBackendAddressPools' in ipc['properties']:
-                    backend_pool_id = ipc['properties'][
-                        'loadBalancerBackendAddressPools'][0]['id']
-                    try:
-                        LoadBalancer.nodes.get(
-                            backend_pool_id=backend_pool_id
-                            ).network_interfaces.connect(network_interface)
-                    except DoesNotExist as e:
-                        logging.info(
-                            "Error connecting Load balancer "
-                            "to netwoerk interface")
-                        logging.info(e)
-
-        # Network Security Group
-        ns_groups = data['network_security_groups']
-        for nsg in ns_groups:
-            ns_group = NetworkSecurityGroup(
-                uid=nsg['id'], name=nsg['name'],
-                properties=nsg['properties'],
-                tags=nsg['tags'])
-            ns_group.save()
-
-            # Map properties
-            obj_properties = ns_group.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'managedBy', 'id',
-                'name']
-            self.add_properties(
-                obj_properties, nsg, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = ns_group.object_tags
-            self.add_tags(obj_tags, nsg['tags'])
-
-            # Connect network security group with resource groups
-            d_resource_group = nsg['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=d_resource_group,
-                subscription_id=nsg['subscriptionId']).elements.connect(
-                    ns_group)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=nsg['subscriptionId']).elements.connect(ns_group)
-
-            # Connect NSG with interfaces
-            if 'networkInterfaces' in nsg['properties']:
-                for ni in nsg['properties']['networkInterfaces']:
-                    ni_id = ni['id']
-                    ns_group.network_interfaces.connect(
-                        NetworkInterface.nodes.get(uid=ni_id))
-
-        # Virtual Machines
-        virtual_machines = data['virtual_machines']
-        for vm in virtual_machines:
-            if self.is_db_virtual_machine(vm):
-                virtual_machine = Database(
-                    uid=vm['id'],
-                    name=vm['name'],
-                    properties=vm['properties'],
-                    tags=vm['tags'])
-                virtual_machine.save()
+    def remove_changed_nodes(self, data):
+        """
+        Delete the nodes of the changed and deleted resources.
+
+        The changed resources are created again by `map_data`. Subscriptions
+        and resource groups already mapped are kept and removed from `data`.
+        """
+        existing_uids = set()
+        for label, rows, key in [
+                (Owner.__label__, data['subscriptions'], 'subscriptionId'),
+                (ResourceGroup.__label__, data['resource_groups'], 'id')]:
+            results, _ = self.db.cypher_query(
+                'MATCH (n:{label}) WHERE n.uid IN $uids '
+                'RETURN n.uid'.format(label=label),
+                {'uids': [row[key].lower() for row in rows]})
+            existing_uids.update(row[0] for row in results)
+        data['subscriptions'] = [
+            s for s in data['subscriptions']
+            if s['subscriptionId'].lower() not in existing_uids]
+        data['resource_groups'] = [
+            rg for rg in data['resource_groups']
+            if rg['id'].lower() not in existing_uids]
+        uids = list(data['deleted_ids'])
+        for key in RESOURCES_KEYS:
+            uids += [row['id'] for row in data[key]]
+        self.delete_nodes(
+            uids, NODE_CLASSES, child_relationships=CHILD_RELATIONSHIPS)
+
+    def save_watermarks(self):
+        """Persist the watermark of the current run for each subscription."""
+        self.watermark_store.save(OrderedDict(
+            (subscription, self.run_watermark)
+            for subscription in self.subscriptions))
+
+    def map_data(
+            self, reset=False, incremental=False, replay=None, upsert=False,
+            sync=False):
+        """
+        Use data a initialize the database model.
+
+        With `incremental` only the resources changed since the last run
+        are mapped again and the deleted ones are removed. The graph is not
+        reset then, whatever `reset` is.
+
+        With `replay` the data is loaded from the given snapshot file
+        instead of being retrieved from Azure.
+
+        With `upsert` the graph is updated in place instead of being
+        cleared: nodes are merged on their uid, unchanged ones are not
+        written and, when all the resources were retrieved, the nodes and
+        relationships not found anymore are removed.
+
+        With `sync` all the resources are retrieved and compared with the
+        manifest of the previous sync, so only the nodes and relationships
+        added, changed or removed since then are written.
+
+        Without `reset` the existing nodes are kept, so a full mapping is
+        always an upsert: creating them again would violate the uniqueness
+        constraints on their uid.
+        """
+        reset, incremental, upsert, clear = mapping_mode(
+            reset, incremental, replay, upsert, sync, log=True)
+        if replay is not None:
+            if clear:
+                self.clear_database()
+            data = load_snapshot(replay)
+        elif incremental and not reset:
+            data = self.get_data(incremental=True)
+            if data['deleted_ids'] is None:
+                if not upsert:
+                    self.clear_database()
+            elif upsert:
+                self.delete_nodes(
+                    data['deleted_ids'], NODE_CLASSES,
+                    child_relationships=CHILD_RELATIONSHIPS)
+                # The relationships and children of the changed resources
+                # are mapped again
+                self.detach_nodes(
+                    [row['id'] for key in RESOURCES_KEYS
+                     for row in data[key]],
+                    NODE_CLASSES, child_relationships=CHILD_RELATIONSHIPS)
             else:
-                virtual_machine = VirtualMachine(
-                    uid=vm['id'],
-                    name=vm['name'],
-                    properties=vm['properties'],
-                    tags=vm['tags'])
-                virtual_machine.save()
-
-            # Map properties
-            obj_properties = virtual_machine.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, vm, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = virtual_machine.object_tags
-            self.add_tags(obj_tags, vm['tags'])
-
-            # Connect virtual machines with resource groups
-            vm_resource_group = vm['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=vm_resource_group,
-                subscription_id=vm['subscriptionId']).elements.connect(
-                    virtual_machine)
-
-            # Connect vm with net_interfaces
-            nis = vm['properties']['networkProfile']['networkInterfaces']
-            for ni in nis:
-                net_interface_id = ni['id']
-            virtual_machine.network_interfaces.connect(
-                    NetworkInterface.nodes.get(uid=net_interface_id))
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=vm['subscriptionId']).elements.connect(virtual_machine)
-
-        # Map databases
-        databases = data['databases']
-        for db in databases:
-            database = Database(
-                    uid=db['id'],
-                    name=db['name'],
-                    properties=db['properties'],
-                    tags=db['tags'])
-            database.save()
-
-            # Map properties
-            obj_properties = database.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'id', 'name']
-            self.add_properties(
-                obj_properties, db, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = database.object_tags
-            self.add_tags(obj_tags, db['tags'])
-
-            # Connect virtual machines with resource groups
-            db_resource_group = db['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=db_resource_group,
-                subscription_id=db['subscriptionId']).elements.connect(
-                    database)
-
-            # Map subscription
-            Owner.nodes.get(
-                uid=db['subscriptionId']).elements.connect(database)
-
-        # Map to IIS data
-        applications = data['applications']
-        for vm_app_data in applications:
-            for app_data in vm_app_data['applications']:
-                application = DeployedApplication(
-                    uid=app_data['id'],
-                    name=app_data['name'],
-                    properties=app_data)
-                application.save()
-
-                # Map properties
-                unwanted_properties = ['name', 'id']
-                self.add_properties(
-                    application.object_properties,
-                    app_data,
-                    unwanted_properties=unwanted_properties)
-
-                # Map deployed app to virtual_machine
-                VirtualMachine.nodes.get(
-                    uid=vm_app_data['virtual_machine_id']
-                    ).deployed_applications.connect(application)
-
-        # Disks
-        disks = data['disks']
-        for d in disks:
-            disk = Disk(
-                uid=d['id'], name=d['name'], properties=d['properties'],
-                tags=d['tags'])
-            disk.save()
-
-            # Map properties
-            obj_properties = disk.object_properties
-            unwanted_props = [
-                'properties', 'resourceGroup', 'tags', 'managedBy', 'id']
-            self.add_properties(
-                obj_properties, d, unwanted_properties=unwanted_props)
-
-            # Map tags
-            obj_tags = disk.object_tags
-            self.add_tags(obj_tags, d['tags'])
-
-            # Connect disk with resource groups
-            d_resource_group = d['resourceGroup']
-            ResourceGroup.nodes.get(
-                name=d_resource_group,
-                subscription_id=d['subscriptionId']).elements.connect(
-                disk)
-            try:
-                # Connect disk with vm
-                d_virtual_machine = d['managedBy']
-
-                VirtualMachine.nodes.get(
-                    uid=d_virtual_machine).disks.connect(disk)
-            except (DoesNotExist, KeyError) as e:
-                logging.error(
-                    "Error while connecting disk with virtual machine")
-                logging.error(e)
-
-            # Map subscription
-            Owner.nodes.get(uid=d['subscriptionId']).elements.connect(disk)
-
-        # TODO
-        # Network Peerings
-            # Using GatewaySubnets
-
-
-def run_mapper(reset=True, export_path=None):
+                self.remove_changed_nodes(data)
+        else:
+            if clear:
+                self.clear_database()
+            data = self.get_data()
+
+        if self.config.get('neo4j_ensure_schema', True):
+            self.ensure_schema(
+                NODE_CLASSES + [Element, Database, Property, Tag],
+                COMPOSITE_INDEXES)
+
+        manifest_path = self.config.get(
+            'sync_manifest_path', DEFAULT_MANIFEST_PATH)
+        self.start_sync_run(
+            upsert=upsert,
+            sync=load_manifest(manifest_path) if sync else None)
+        with self.write_batch():
+            self.map_resources(data)
+            if sync and self.sync.previous_nodes:
+                self.delete_removed(NODE_CLASSES)
+            elif upsert and data.get('deleted_ids') is None:
+                self.delete_stale_relationships(RELATIONSHIP_TYPES)
+                self.delete_stale_nodes(NODE_CLASSES)
+
+        if sync:
+            save_manifest(self.sync, manifest_path)
+            report = self.sync.report()
+            logging.info(
+                'Sync: {added} added, {changed} changed, {removed} removed '
+                'and {unchanged} unchanged nodes, {added_relationships} '
+                'added and {removed_relationships} removed '
+                'relationships'.format(
+                    added=len(report['added']),
+                    changed=len(report['changed']),
+                    removed=len(report['removed']),
+                    unchanged=report['unchanged'],
+                    added_relationships=report['added_relationships'],
+                    removed_relationships=report['removed_relationships']))
+            if self.config.get('sync_report_path'):
+                write_report(report, self.config['sync_report_path'])
+            self.sync = None
+
+        if replay is None:
+            self.save_watermarks()
+
+    def map_resources(self, data):
+        """
+        Create the nodes and relationships of the retrieved data.
+
+        Each resource type is mapped by a stage of `MAPPING_STAGES` once
+        the stages it depends on are done, independent stages at the same
+        time with `neo4j_write_workers`. A stage maps the whole table of
+        rows of each of its `RESOURCE_MAPPINGS` at once. The relationships
+        are created at the end, when all the nodes exist.
+        """
+        relationships = RelationshipBatch(self.node_cache, self.sync)
+        self.run_stages(OrderedDict(
+            (name, (
+                partial(self.map_stage, name, data, relationships),
+                dependencies))
+            for name, dependencies in MAPPING_STAGES.items()))
+
+        # TODO: Network Peerings, using GatewaySubnets
+
+        if self.sync is not None and self.sync.previous_nodes:
+            self.delete_removed_relationships()
+        not_created = self.create_relationships(relationships)
+        if self.sync is not None:
+            # Created by the next sync once their endpoints exist
+            self.sync.forget_relationships(not_created)
+
+    def map_stage(self, name, data, relationships):
+        """Map the rows of each resource mapping of a stage."""
+        for mapping in RESOURCE_MAPPINGS[name]:
+            self.map_rows(mapping, data, relationships)
+
+
+def mapping_mode(reset, incremental, replay, upsert, sync, log=False):
+    """
+    Return the `reset`, `incremental` and `upsert` flags used by a mapping
+    with the given options, and if the graph is cleared before it.
+    """
+    if sync:
+        upsert = True
+        incremental = False
+    if incremental and reset and replay is None:
+        if log:
+            logging.warning('Incremental run, the graph is not reset')
+        reset = False
+    if not reset and not incremental and not upsert:
+        if log:
+            logging.info('Upserting, the existing graph is not cleared')
+        upsert = True
+    return reset, incremental, upsert, reset and not upsert
+
+
+def run_mapper(
+        reset=True, export_path=None, incremental=False, replay=None,
+        migrate=False, upsert=False, sync=False, normalize=False):
     """Run mapper script to add populate database."""
     az_mapper = AzureGraphMapper()
-    az_mapper.map_data(reset=reset)
+    _, _, _, clear = mapping_mode(reset, incremental, replay, upsert, sync)
+    if migrate and not clear:
+        # Convert the existing graph to the configured property storage
+        az_mapper.migrate_property_storage(az_mapper.property_storage)
+    if normalize:
+        # Convert the lookup keys stored by previous versions to lower case
+        az_mapper.normalize_lookup_keys()
+    az_mapper.map_data(
+        reset=reset, incremental=incremental, replay=replay, upsert=upsert,
+        sync=sync)
     if export_path is not None:
         az_mapper.export_data(export_path=export_path)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+On-disk cache of the provider responses and data snapshots.
+
+Entries are stored as compressed JSON lines, one row per line.
+"""
+# Standard library imports
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_TTL = 24 * 3600
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+ENTRY_EXTENSION = '.jsonl.gz'
+
+
+def write_json_lines(path, rows):
+    """Write the rows to a compressed JSON lines file atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    try:
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as file:
+            for row in rows:
+                file.write(json.dumps(row))
+                file.write('\n')
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def read_json_lines(path):
+    """Yield the rows of a compressed JSON lines file."""
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+class ResponseCache():
+    """
+    Content addressed cache of responses.
+
+    Each entry is addressed by the hash of the values identifying the
+    request, for example the query text and the subscriptions. Entries
+    older than `ttl` seconds are ignored and the least recently used ones
+    are evicted when the cache is larger than `max_size` bytes.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(*values):
+        """Return the key corresponding to the given values."""
+        return hashlib.sha256(
+            json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        """Return the path of the file of an entry."""
+        return os.path.join(self.path, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Return the rows of an entry or `None` if missing or expired."""
+        path = self.entry_path(key)
+        with self.lock:
+            try:
+                modified = os.path.getmtime(path)
+                if time.time() - modified > self.ttl:
+                    os.remove(path)
+                    return None
+                rows = list(read_json_lines(path))
+                # Keep the modification time for the TTL, update the access
+                # time for the eviction
+                os.utime(path, (time.time(), modified))
+            except (OSError, ValueError):
+                return None
+        logging.info('Cache hit {key}'.format(key=key))
+        return rows
+
+    def put(self, key, rows):
+        """Store the rows of an entry."""
+        with self.lock:
+            write_json_lines(self.entry_path(key), rows)
+            self.evict()
+
+    def evict(self):
+        """Remove the expired entries and the least recently used ones."""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(ENTRY_EXTENSION):
+                continue
+            path = os.path.join(self.path, name)
+            stat = os.stat(path)
+            if now - stat.st_mtime > self.ttl:
+                os.remove(path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+
+
+class ConditionalCache():
+    """
+    Cache of entries revalidated by the caller.
+
+    Entries do not expire. They keep the values used to check if they are
+    still valid, for example the ETag and Last-Modified headers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    key = staticmethod(ResponseCache.key)
+
+    def entry_path(self, key):
+        """Return the path of the file of an entry."""
+        return os.path.join(self.path, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Return an entry or `None` if missing."""
+        try:
+            return next(read_json_lines(self.entry_path(key)))
+        except (OSError, ValueError, StopIteration):
+            return None
+
+    def put(self, key, entry):
+        """Store an entry."""
+        write_json_lines(self.entry_path(key), [entry])
+
+
+def save_snapshot(data, path):
+    """Save the data retrieved from the provider to a snapshot file."""
+    def rows():
+        for key, value in data.items():
+            if isinstance(value, list):
+                yield {'key': key, 'value': []}
+                for row in value:
+                    yield {'key': key, 'row': row}
+            else:
+                yield {'key': key, 'value': value}
+    write_json_lines(path, rows())
+    logging.info('Snapshot saved to {path}'.format(path=path))
+
+
+def load_snapshot(path):
+    """Load the data saved in a snapshot file."""
+    data = {}
+    for line in read_json_lines(path):
+        if 'row' in line:
+            data.setdefault(line['key'], []).append(line['row'])
+        else:
+            data[line['key']] = line['value']
+    logging.info('Snapshot loaded from {path}'.format(path=path))
+    return data
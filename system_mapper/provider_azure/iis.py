@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+HTTP access to the IIS Administration API of the virtual machines.
+"""
+# Standard library imports
+import logging
+import threading
+import time
+
+# Third-party imports
+import requests
+from requests.adapters import HTTPAdapter
+from requests_ntlm import HttpNtlmAuth
+
+
+DEFAULT_POOL_SIZE = 4
+
+DEFAULT_CONNECT_TIMEOUT = 5
+
+DEFAULT_READ_TIMEOUT = 30
+
+DEFAULT_HOST_CONCURRENCY = 2
+
+# Consecutive failures after which the requests to a host are not sent
+DEFAULT_FAILURE_THRESHOLD = 3
+
+# Seconds before trying again a host with the circuit open
+DEFAULT_RESET_TIMEOUT = 300
+
+
+class CircuitOpenError(Exception):
+    """Request not sent because the host failed too many times."""
+
+    pass
+
+
+class PoolClosedError(Exception):
+    """Request not sent because the sessions were closed."""
+
+    pass
+
+
+class IISSessionPool():
+    """
+    Keep-alive HTTP sessions to the IIS Administration API by host.
+
+    Each host gets its own session so the connections, and the NTLM
+    authentication bound to them, are reused between requests.
+
+    At most `host_concurrency` requests are sent to a host at the same time.
+    After `failure_threshold` consecutive connection errors the circuit of
+    the host opens and its requests fail immediately with
+    `CircuitOpenError` during `reset_timeout` seconds.
+
+    Once closed, requests fail with `PoolClosedError` until it is opened
+    again, so the requests still running do not create new sessions.
+    """
+
+    def __init__(
+            self, token, user, password, port,
+            pool_size=DEFAULT_POOL_SIZE,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT,
+            host_concurrency=DEFAULT_HOST_CONCURRENCY,
+            failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+            reset_timeout=DEFAULT_RESET_TIMEOUT,
+            scheme='https'):
+        self.token = token
+        self.user = user
+        self.password = password
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.host_concurrency = host_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.scheme = scheme
+        self.sessions = {}
+        self.semaphores = {}
+        self.failures = {}
+        self.opened_at = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def base_url(self, host):
+        """Return the base url of the API of a host."""
+        return '{scheme}://{host}:{port}'.format(
+            scheme=self.scheme, host=host, port=self.port)
+
+    def semaphore(self, host):
+        """Return the semaphore limiting the requests to a host."""
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.host_concurrency)
+            return self.semaphores[host]
+
+    def check_circuit(self, host):
+        """Raise `CircuitOpenError` if the circuit of a host is open."""
+        with self.lock:
+            if self.failures.get(host, 0) < self.failure_threshold:
+                return
+            if time.monotonic() - self.opened_at[host] < self.reset_timeout:
+                raise CircuitOpenError(
+                    'Circuit open for host {host}'.format(host=host))
+            # Let one request through to check if the host is back
+            self.opened_at[host] = time.monotonic()
+
+    def record_result(self, host, success):
+        """Update the consecutive failures of a host."""
+        with self.lock:
+            if success:
+                self.failures[host] = 0
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] == self.failure_threshold:
+                logging.warning('Circuit opened for host {host}'.format(
+                    host=host))
+            if self.failures[host] >= self.failure_threshold:
+                self.opened_at[host] = time.monotonic()
+
+    def session(self, host):
+        """Return the session of a host, creating it if needed."""
+        with self.lock:
+            if self.closed:
+                raise PoolClosedError('Sessions closed')
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update({
+                    'Access-Token': 'Bearer {token}'.format(
+                        token=self.token),
+                    'Accept': 'application/hal+json'
+                    })
+                session.auth = HttpNtlmAuth(self.user, self.password)
+                # TODO: Setup cert file of the IIS server
+                session.verify = False
+                session.mount(self.scheme + '://', HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size))
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def get(self, host, url, **kwargs):
+        """Send a GET request to the API of a host."""
+        kwargs.setdefault('timeout', self.timeout)
+        self.check_circuit(host)
+        with self.semaphore(host):
+            try:
+                response = self.session(host).get(
+                    self.base_url(host) + url, **kwargs)
+            except requests.RequestException:
+                self.record_result(host, success=False)
+                raise
+        self.record_result(host, success=True)
+        return response
+
+    def open(self):
+        """Allow new sessions after closing them."""
+        with self.lock:
+            self.closed = False
+
+    def close(self):
+        """Close all the sessions and refuse new ones until opened."""
+        with self.lock:
+            self.closed = True
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
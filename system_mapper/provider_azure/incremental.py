@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Incremental ingestion support using Resource Graph resource changes.
+
+A watermark with the time of the last successful run is kept per
+subscription. The `resourcechanges` table is used to find the resources
+created, updated or deleted since then.
+"""
+# Standard library imports
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+
+
+DEFAULT_STATE_PATH = 'incremental_state.json'
+
+# Format of the watermarks, as used by the `datetime()` KQL function
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+DELETE_CHANGE_TYPE = 'Delete'
+
+# Days the changes are kept in the `resourcechanges` table
+DEFAULT_RETENTION_DAYS = 14
+
+
+class WatermarkStore():
+    """Persist the watermark of each subscription in a JSON file."""
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+
+    def load(self):
+        """Return the watermarks by subscription id."""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as file:
+            return json.load(file).get('watermarks', {})
+
+    def save(self, watermarks):
+        """Persist the watermarks by subscription id."""
+        with open(self.path, 'w') as file:
+            json.dump({'watermarks': watermarks}, file, indent=4)
+        logging.info('Watermarks saved to {path}'.format(path=self.path))
+
+
+def current_watermark():
+    """Return the watermark corresponding to the current time."""
+    return datetime.utcnow().strftime(WATERMARK_FORMAT)
+
+
+def expired_watermarks(watermarks, retention_days, now=None):
+    """
+    Return the subscriptions whose watermark is older than the retention of
+    the resource changes, so some of their changes may be missing.
+    """
+    limit = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    return [
+        subscription for subscription, watermark in watermarks.items()
+        if datetime.strptime(watermark, WATERMARK_FORMAT) < limit]
+
+
+def quote_list(values):
+    """Return the values as a comma separated list of KQL strings."""
+    return ', '.join('"{value}"'.format(value=value) for value in values)
+
+
+def changes_query(watermarks):
+    """Return a query for the changes made since the given watermarks."""
+    conditions = ' or '.join(
+        '(subscriptionId == "{subscription}" and '
+        'changeTime > datetime({watermark}))'.format(
+            subscription=subscription, watermark=watermark)
+        for subscription, watermark in watermarks.items())
+    return (
+        'resourcechanges '
+        '| extend changeTime = todatetime('
+        'properties.changeAttributes.timestamp), '
+        'targetResourceId = tostring(properties.targetResourceId), '
+        'changeType = tostring(properties.changeType) '
+        '| where {conditions} '
+        '| project targetResourceId, changeType, changeTime, subscriptionId '
+        '| order by changeTime asc').format(conditions=conditions)
+
+
+def split_changes(changes):
+    """
+    Return the ids of the changed and deleted resources.
+
+    The changes must be sorted by time so the last change of each resource
+    wins.
+
+    The ids are lower cased since the case used by the resource changes
+    and the resources can be different.
+    """
+    changed_ids = set()
+    deleted_ids = set()
+    for change in changes:
+        resource_id = change['targetResourceId'].lower()
+        if change['changeType'] == DELETE_CHANGE_TYPE:
+            deleted_ids.add(resource_id)
+            changed_ids.discard(resource_id)
+        else:
+            changed_ids.add(resource_id)
+            deleted_ids.discard(resource_id)
+    return changed_ids, deleted_ids
+
+
+def resources_filter(ids, subscriptions):
+    """
+    Return a `where` clause keeping the given resources.
+
+    All the resources of `subscriptions` are kept, for example the ones
+    without watermark yet.
+    """
+    conditions = []
+    if ids:
+        conditions.append('id in~ ({ids})'.format(ids=quote_list(ids)))
+    if subscriptions:
+        conditions.append('subscriptionId in~ ({subscriptions})'.format(
+            subscriptions=quote_list(subscriptions)))
+    if not conditions:
+        # Nothing changed
+        conditions.append('false')
+    return '| where {conditions}'.format(conditions=' or '.join(conditions))
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Declarative mapping of the Azure resource types to the graph.
+
+Each resource type is described by one or more `ResourceMapping` tables:
+how its rows are selected, the node class, uid and properties of their
+nodes, the properties not mapped and the relationships of each row.
+"""
+# Standard library imports
+from collections import OrderedDict
+
+# Local imports
+from system_mapper.graph import (
+    Database, DeployedApplication, Disk, LoadBalancer, NetworkInterface,
+    NetworkSecurityGroup, Owner, PrivateIp, PublicIp, ResourceGroup,
+    ResourceMapping, Service, Storage, Subnet, VirtualMachine,
+    VirtualNetwork)
+
+
+# Row keys not mapped as properties of the resources
+UNWANTED_PROPERTIES = ['properties', 'resourceGroup', 'tags', 'id', 'name']
+
+
+def data_rows(key):
+    """Return a function selecting the rows of the given data key."""
+    return lambda mapper, data: data[key]
+
+
+def resource_uid(row):
+    """Return the uid of the node of a resource."""
+    return row['id']
+
+
+def resource_node(row):
+    """Return the properties of the node of a resource."""
+    return dict(name=row['name'], properties=row['properties'],
+                tags=row['tags'])
+
+
+def resource_row(row):
+    """Return the row itself, as content or properties of a resource."""
+    return row
+
+
+def resource_tags(row):
+    """Return the tags of a resource."""
+    return row['tags']
+
+
+def resource_group_uid(row):
+    """Return the uid of the resource group of a resource."""
+    return '/subscriptions/{subscription}/resourceGroups/{name}'.format(
+        subscription=row['subscriptionId'], name=row['resourceGroup'])
+
+
+def in_resource_group(row, node):
+    """Connect a resource with its resource group."""
+    yield 'ELEMENT_RESOURCE_GROUP', (ResourceGroup, {
+        'uid': resource_group_uid(row)}), node
+
+
+def owned_element(row, node):
+    """Connect a resource with its subscription."""
+    yield 'OWNED_ELEMENT', (Owner, {'uid': row['subscriptionId']}), node
+
+
+def resource_mapping(
+        node_class, key, uid=resource_uid, node=resource_node,
+        unwanted_properties=UNWANTED_PROPERTIES, edges=()):
+    """
+    Return the mapping of the rows of a resource type, by default the ones
+    of the data `key`.
+
+    The rows are compared between runs, mapped as properties and tags and
+    connected to their resource group and subscription.
+    """
+    return ResourceMapping(
+        node_class, data_rows(key) if isinstance(key, str) else key,
+        uid=uid, node=node, content=resource_row, properties=resource_row,
+        unwanted_properties=unwanted_properties, tags=resource_tags,
+        edges=[in_resource_group, owned_element] + list(edges))
+
+
+def subscription_uid(row):
+    """Return the uid of the owner node of a subscription."""
+    return row['id'].replace('/subscriptions/', '')
+
+
+def subscription_node(row):
+    """Return the properties of the owner node of a subscription."""
+    return dict(name=row['name'], properties=row['properties'])
+
+
+def resource_group_node(row):
+    """Return the properties of the node of a resource group."""
+    return dict(
+        subscription_id=row['subscriptionId'], name=row['resourceGroup'],
+        properties=row['properties'])
+
+
+def owned_resource_group(row, node):
+    """Connect a resource group with its subscription."""
+    yield 'OWNED_RESOURCE_GROUP', (Owner, {
+        'uid': row['subscriptionId']}), node
+
+
+def app_service_plan_uid(row):
+    """Return the uid of the node of an app service plan, in lower case."""
+    return row['id'].lower()
+
+
+def app_service_plan_node(row):
+    """Return the properties of the node of an app service plan."""
+    return dict(resource_node(row), service_name='AppServicePlan')
+
+
+def app_service_node(row):
+    """Return the properties of the node of an app service."""
+    return dict(resource_node(row), service_name='AppService')
+
+
+def server_farm(row, node):
+    """Connect an app service with its app service plan."""
+    yield 'SERVICE_ELEMENTS', (Service, {
+        'uid': row['properties']['serverFarmId'].lower()}), node
+
+
+def load_balancer_node(row):
+    """Return the properties of the node of a load balancer."""
+    return dict(resource_node(row), backend_pool_id=row['properties'][
+        'backendAddressPools'][0]['id'])
+
+
+def load_balancer_public_ip(row, node):
+    """Connect a load balancer with its frontend public IP address."""
+    lb_public_id = row['properties']['frontendIPConfigurations'][0][
+        'properties']['publicIPAddress']['id']
+    yield 'LB_PUBLIC_IP', node, (PublicIp, {'uid': lb_public_id})
+
+
+def subnet_rows(mapper, data):
+    """Return the `(virtual_network, subnet)` rows of the subnets."""
+    # TODO: Divide subnets from gateway subnets
+    return [
+        (vn, sn) for vn in data['virtual_networks']
+        for sn in vn['properties']['subnets']]
+
+
+def subnet_uid(row):
+    """Return the uid of the node of a subnet."""
+    _, sn = row
+    return sn['id']
+
+
+def subnet_node(row):
+    """Return the properties of the node of a subnet."""
+    _, sn = row
+    return dict(name=sn['name'], properties=sn['properties'])
+
+
+def virtual_network_subnet(row, node):
+    """Connect a subnet with its virtual network."""
+    vn, _ = row
+    yield 'SUBNET', (VirtualNetwork, {'uid': vn['id']}), node
+
+
+def ip_configurations(row, node):
+    """Connect a network interface with its subnets, IPs and pools."""
+    for ipc in row['properties']['ipConfigurations']:
+        # Subnet assingment
+        yield 'SUBNET_NI', node, (Subnet, {
+            'uid': ipc['properties']['subnet']['id']})
+
+        # Connect with public ip address
+        if 'publicIPAddress' in ipc['properties']:
+            yield 'PUBLIC_IP', node, (PublicIp, {
+                'uid': ipc['properties']['publicIPAddress']['id']})
+
+        # Connect with load balancer
+        if 'loadBalancerBackendAddressPools' in ipc['properties']:
+            backend_pool_id = ipc['properties'][
+                'loadBalancerBackendAddressPools'][0]['id']
+            yield 'VM_BACKEND_POOL', (LoadBalancer, {
+                'backend_pool_id': backend_pool_id}), node
+
+
+def private_ip_rows(mapper, data):
+    """Return the `(network_interface, ip_configuration)` rows of the IPs."""
+    return [
+        (ni, ipc) for ni in data['network_interfaces']
+        for ipc in ni['properties']['ipConfigurations']]
+
+
+def private_ip_uid(row):
+    """Return the uid of the node of a private IP address."""
+    _, ipc = row
+    return ipc['id']
+
+
+def private_ip_node(row):
+    """Return the properties of the node of a private IP address."""
+    _, ipc = row
+    return dict(name=ipc['properties']['privateIPAddress'])
+
+
+def network_interface_private_ip(row, node):
+    """Connect a private IP address with its network interface."""
+    ni, _ = row
+    yield 'PRIVATE_IP', (NetworkInterface, {'uid': ni['id']}), node
+
+
+def security_group_interfaces(row, node):
+    """Connect a network security group with its network interfaces."""
+    for ni in row['properties'].get('networkInterfaces', []):
+        yield 'NETWORK_SECURITY_GROUP', node, (NetworkInterface, {
+            'uid': ni['id']})
+
+
+def db_virtual_machine_rows(mapper, data):
+    """Return the virtual machines used as databases."""
+    return [
+        vm for vm in data['virtual_machines']
+        if mapper.is_db_virtual_machine(vm)]
+
+
+def other_virtual_machine_rows(mapper, data):
+    """Return the virtual machines not used as databases."""
+    return [
+        vm for vm in data['virtual_machines']
+        if not mapper.is_db_virtual_machine(vm)]
+
+
+def virtual_machine_interfaces(row, node):
+    """Connect a virtual machine with its network interfaces."""
+    for ni in row['properties']['networkProfile']['networkInterfaces']:
+        yield 'NETWORK_INTERFACE', node, (NetworkInterface, {
+            'uid': ni['id']})
+
+
+def application_rows(mapper, data):
+    """Return the `(vm_app_data, app_data)` rows of the IIS applications."""
+    return [
+        (vm_app_data, app_data)
+        for vm_app_data in data['applications']
+        for app_data in vm_app_data['applications']]
+
+
+def application_uid(row):
+    """Return the uid of the node of an IIS application."""
+    _, app_data = row
+    return app_data['id']
+
+
+def application_node(row):
+    """Return the properties of the node of an IIS application."""
+    _, app_data = row
+    return dict(name=app_data['name'], properties=app_data)
+
+
+def application_properties(row):
+    """Return the data of an IIS application, mapped as properties."""
+    _, app_data = row
+    return app_data
+
+
+def deployed_application(row, node):
+    """Connect an IIS application with its virtual machine."""
+    vm_app_data, _ = row
+    yield 'DEPLOYED_APPLICATION', (VirtualMachine, {
+        'uid': vm_app_data['virtual_machine_id']}), node
+
+
+def disk_virtual_machine(row, node):
+    """Connect a disk with the virtual machine using it."""
+    if row.get('managedBy'):
+        yield 'DISK', (VirtualMachine, {'uid': row['managedBy']}), node
+
+
+# Mappings of the rows of each resource type, run in order by the stage of
+# the resource type
+RESOURCE_MAPPINGS = OrderedDict([
+    ('subscriptions', [ResourceMapping(
+        Owner, data_rows('subscriptions'),
+        uid=subscription_uid, node=subscription_node, content=resource_row,
+        properties=resource_row, unwanted_properties=UNWANTED_PROPERTIES,
+        tags=resource_tags)]),
+    # TODO: location, zones
+    ('resource_groups', [ResourceMapping(
+        ResourceGroup, data_rows('resource_groups'), uid=resource_uid,
+        node=resource_group_node, content=resource_row,
+        properties=resource_row, unwanted_properties=UNWANTED_PROPERTIES,
+        tags=resource_tags, edges=[owned_resource_group])]),
+    ('public_ips', [resource_mapping(PublicIp, 'public_ips')]),
+    ('app_services_plans', [resource_mapping(
+        Service, 'app_services_plans',
+        uid=app_service_plan_uid, node=app_service_plan_node)]),
+    ('app_services', [resource_mapping(
+        Service, 'app_services', node=app_service_node,
+        edges=[server_farm])]),
+    ('storage_accounts', [resource_mapping(Storage, 'storage_accounts')]),
+    ('load_balancers', [resource_mapping(
+        LoadBalancer, 'load_balancers', node=load_balancer_node,
+        edges=[load_balancer_public_ip])]),
+    ('virtual_networks', [
+        resource_mapping(VirtualNetwork, 'virtual_networks'),
+        ResourceMapping(
+            Subnet, subnet_rows,
+            uid=subnet_uid, node=subnet_node,
+            edges=[virtual_network_subnet])]),
+    ('network_interfaces', [
+        resource_mapping(
+            NetworkInterface, 'network_interfaces',
+            unwanted_properties=['properties', 'resourceGroup', 'tags', 'id'],
+            edges=[ip_configurations]),
+        ResourceMapping(
+            PrivateIp, private_ip_rows, uid=private_ip_uid,
+            node=private_ip_node, edges=[network_interface_private_ip])]),
+    ('network_security_groups', [resource_mapping(
+        NetworkSecurityGroup, 'network_security_groups',
+        unwanted_properties=UNWANTED_PROPERTIES + ['managedBy'],
+        edges=[security_group_interfaces])]),
+    ('virtual_machines', [
+        resource_mapping(
+            Database, db_virtual_machine_rows,
+            edges=[virtual_machine_interfaces]),
+        resource_mapping(
+            VirtualMachine, other_virtual_machine_rows,
+            edges=[virtual_machine_interfaces])]),
+    ('databases', [resource_mapping(Database, 'databases')]),
+    ('applications', [ResourceMapping(
+        DeployedApplication, application_rows, uid=application_uid,
+        node=application_node, properties=application_properties,
+        unwanted_properties=['name', 'id'], edges=[deployed_application])]),
+    ('disks', [resource_mapping(
+        Disk, 'disks',
+        unwanted_properties=[
+            'properties', 'resourceGroup', 'tags', 'managedBy', 'id'],
+        edges=[disk_virtual_machine])]),
+])
+
+# Stages mapping each resource type and the stages creating the nodes their
+# relationships point to, found then in the node cache. Stages not depending
+# on each other can be mapped at the same time.
+MAPPING_STAGES = OrderedDict([
+    ('subscriptions', ()),
+    ('resource_groups', ('subscriptions',)),
+    ('public_ips', ('resource_groups',)),
+    ('app_services_plans', ('resource_groups',)),
+    ('app_services', ('app_services_plans',)),
+    ('storage_accounts', ('resource_groups',)),
+    ('load_balancers', ('public_ips',)),
+    ('virtual_networks', ('resource_groups',)),
+    ('network_interfaces', (
+        'public_ips', 'load_balancers', 'virtual_networks')),
+    ('network_security_groups', ('network_interfaces',)),
+    ('virtual_machines', ('network_interfaces',)),
+    ('databases', ('resource_groups',)),
+    ('applications', ('virtual_machines',)),
+    ('disks', ('virtual_machines',)),
+])
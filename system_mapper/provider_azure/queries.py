@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Azure Resource Graph queries used to retrieve the infrastructure data.
+"""
+# Standard library imports
+from collections import OrderedDict
+
+
+# Subscriptions
+SUBSCRIPTIONS_QUERY = (
+    'resourcecontainers '
+    '| where type == '
+    '"microsoft.resources/subscriptions"')
+
+# Resource groups
+RESOURCE_GROUPS_QUERY = (
+    'resourcecontainers '
+    '| where type == '
+    '"microsoft.resources/subscriptions/resourcegroups"')
+
+# App service instances
+APP_SERVICES_QUERY = (
+    'resources '
+    '| where type == "microsoft.web/sites"')
+
+# Server farms
+APP_SERVICES_PLANS_QUERY = (
+    'resources '
+    '| where type == "microsoft.web/serverfarms"')
+
+# Storage accounts
+STORAGE_ACCOUNTS_QUERY = (
+    'resources '
+    '| where type == '
+    '"microsoft.storage/storageaccounts"')
+
+# Network interfaces
+NETWORK_INTERFACES_QUERY = (
+    'resources '
+    '| where type == "microsoft.network/networkinterfaces"')
+
+# Public IPs
+PUBLIC_IPS_QUERY = (
+    'resources '
+    '| where type == "microsoft.network/publicipaddresses"')
+
+# VMs with their primary network interface and IP addresses
+VIRTUAL_MACHINES_QUERY = ("""
+resources
+ | where type =~ 'microsoft.compute/virtualmachines'
+ | extend nics=array_length(properties.networkProfile.networkInterfaces)
+ | mv-expand nic=properties.networkProfile.networkInterfaces
+ | where nics == 1 or nic.properties.primary =~ 'true' or isempty(nic)
+ | project id, name, size=tostring(properties.hardwareProfile.vmSize),
+ nicId = tostring(nic.id), type, properties = tostring(properties),
+ resourceGroup = resourceGroup, tostring(tags), subscriptionId, tenantId
+ | join kind=leftouter (
+    Resources
+    | where type =~ 'microsoft.network/networkinterfaces'
+     | extend ipConfigsCount=array_length(properties.ipConfigurations)
+     | mv-expand ipconfig=properties.ipConfigurations
+     | where ipConfigsCount == 1 or ipconfig.properties.primary =~ 'true'
+    | project nicId = id,
+     publicIpId = tostring(ipconfig.properties.publicIPAddress.id),
+     privateIpAddress = tostring(ipconfig.properties.privateIPAddress))
+ on nicId
+ | project-away nicId1
+ | summarize by id, name, size, nicId, type, properties, resourceGroup, tags,
+ subscriptionId, tenantId, publicIpId, privateIpAddress
+ | join kind=leftouter (
+    Resources
+    | where type =~ 'microsoft.network/publicipaddresses'
+    | project publicIpId = id, publicIpAddress = properties.ipAddress)
+ on publicIpId
+ | project-away publicIpId1
+""")
+
+# Networks security groups
+NETWORK_SECURITY_GROUPS_QUERY = (
+    'resources '
+    ' | where type == '
+    '"microsoft.network/networksecuritygroups"')
+
+# Virtual networks
+VIRTUAL_NETWORKS_QUERY = (
+    'resources '
+    '| where type == "microsoft.network/virtualnetworks"')
+
+# Disks
+DISKS_QUERY = (
+    'resources '
+    '| where type == "microsoft.compute/disks"')
+
+# Load balancers
+LOAD_BALANCERS_QUERY = (
+    'resources '
+    '| where type == "microsoft.network/loadbalancers"')
+
+# Databases (1)
+DATABASES_QUERY = (
+    'resources'
+    ' | where type == "microsoft.sql/servers/databases"')
+
+# Databases (2)
+DATABASES_SERVERS_QUERY = (
+    'resources'
+    ' | where type == "microsoft.sql/servers"')
+
+
+# Queries used by `AzureGraphMapper.get_data` by data key. They are
+# independent from each other so they can be run in any order.
+RESOURCE_GRAPH_QUERIES = OrderedDict([
+    ('subscriptions', SUBSCRIPTIONS_QUERY),
+    ('resource_groups', RESOURCE_GROUPS_QUERY),
+    ('app_services', APP_SERVICES_QUERY),
+    ('app_services_plans', APP_SERVICES_PLANS_QUERY),
+    ('storage_accounts', STORAGE_ACCOUNTS_QUERY),
+    ('network_interfaces', NETWORK_INTERFACES_QUERY),
+    ('public_ips', PUBLIC_IPS_QUERY),
+    ('virtual_machines', VIRTUAL_MACHINES_QUERY),
+    ('network_security_groups', NETWORK_SECURITY_GROUPS_QUERY),
+    ('virtual_networks', VIRTUAL_NETWORKS_QUERY),
+    ('disks', DISKS_QUERY),
+    ('load_balancers', LOAD_BALANCERS_QUERY),
+    ('databases', DATABASES_QUERY),
+    ('databases_servers', DATABASES_SERVERS_QUERY),
+])
+
+
+# Resource types retrieved with a plain `where type == ...` filter on the
+# resources table by data key. In consolidated mode they are all retrieved
+# with a single query and partitioned by type.
+RESOURCE_TYPES = OrderedDict([
+    ('app_services', 'microsoft.web/sites'),
+    ('app_services_plans', 'microsoft.web/serverfarms'),
+    ('storage_accounts', 'microsoft.storage/storageaccounts'),
+    ('network_interfaces', 'microsoft.network/networkinterfaces'),
+    ('public_ips', 'microsoft.network/publicipaddresses'),
+    ('network_security_groups', 'microsoft.network/networksecuritygroups'),
+    ('virtual_networks', 'microsoft.network/virtualnetworks'),
+    ('disks', 'microsoft.compute/disks'),
+    ('load_balancers', 'microsoft.network/loadbalancers'),
+    ('databases', 'microsoft.sql/servers/databases'),
+    ('databases_servers', 'microsoft.sql/servers'),
+])
+
+
+# Top level columns kept when projecting the resources table
+PROJECTED_COLUMNS = [
+    'id', 'name', 'type', 'kind', 'location', 'resourceGroup',
+    'subscriptionId', 'tenantId', 'managedBy', 'sku', 'zones', 'tags']
+
+# Fields of the `properties` column used by the mapper and the dashboard by
+# data key. Data keys not listed here are retrieved without projection.
+PROPERTIES_PROJECTION = OrderedDict([
+    ('app_services', [
+        'serverFarmId', 'state', 'defaultHostName', 'hostNames',
+        'httpsOnly']),
+    ('app_services_plans', ['status', 'numberOfSites']),
+    ('storage_accounts', ['primaryEndpoints', 'provisioningState']),
+    ('network_interfaces', ['ipConfigurations', 'provisioningState']),
+    ('public_ips', ['ipAddress', 'publicIPAllocationMethod']),
+    ('network_security_groups', ['networkInterfaces', 'securityRules']),
+    ('virtual_networks', ['subnets', 'addressSpace']),
+    ('disks', ['diskSizeGB', 'diskState', 'osType']),
+    ('load_balancers', ['frontendIPConfigurations', 'backendAddressPools']),
+    ('databases', ['status', 'collation']),
+    ('databases_servers', ['state', 'fullyQualifiedDomainName']),
+])
+
+
+def properties_bag(fields):
+    """Return an expression packing the given fields of `properties`."""
+    return 'pack({fields})'.format(fields=', '.join(
+        "'{field}', properties.{field}".format(field=field)
+        for field in fields))
+
+
+def project_clause(properties):
+    """Return a `project` clause keeping the columns used by the mapper."""
+    return '| project {columns}, properties = {properties}'.format(
+        columns=', '.join(PROJECTED_COLUMNS), properties=properties)
+
+
+def projected_queries(queries):
+    """
+    Add a `project` clause to the queries with a projection spec.
+
+    `queries` maps the data keys to the queries. The queries of the data
+    keys without projection spec are returned unchanged.
+    """
+    return OrderedDict(
+        (key, '{query} {project}'.format(
+            query=query,
+            project=project_clause(properties_bag(
+                PROPERTIES_PROJECTION[key])))
+         if key in PROPERTIES_PROJECTION else query)
+        for key, query in queries.items())
+
+
+def consolidated_query(resource_types, project=False):
+    """
+    Return a query retrieving all the given resource types at once.
+
+    `resource_types` maps the data keys to the resource types. When
+    `project` is true the `properties` column is projected depending on
+    the type of each row.
+    """
+    query = 'resources | where type in~ ({types})'.format(
+        types=', '.join(
+            '"{type}"'.format(type=resource_type)
+            for resource_type in resource_types.values()))
+    if project:
+        cases = ', '.join(
+            "type =~ '{type}', {properties}".format(
+                type=resource_type,
+                properties=properties_bag(PROPERTIES_PROJECTION[key]))
+            for key, resource_type in resource_types.items()
+            if key in PROPERTIES_PROJECTION)
+        query = '{query} {project}'.format(
+            query=query,
+            project=project_clause('case({cases}, properties)'.format(
+                cases=cases)))
+    return query
+
+
+def partition_by_type(rows, resource_types):
+    """
+    Split the rows of a consolidated query by data key.
+
+    `resource_types` maps the data keys to the resource types. Every key
+    is present in the result even if no rows were found for it.
+    """
+    type_index = {
+        resource_type.lower(): key
+        for key, resource_type in resource_types.items()}
+    data = {key: [] for key in resource_types}
+    for row in rows:
+        key = type_index.get(row['type'].lower())
+        if key is not None:
+            data[key].append(row)
+    return data
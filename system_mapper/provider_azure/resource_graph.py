@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+In-process client for the Azure Resource Graph REST API.
+
+Queries are sent directly to the API using a single HTTP session instead
+of invoking the az CLI for each page.
+"""
+# Standard library imports
+from datetime import datetime, timedelta
+import logging
+import threading
+
+# Third-party imports
+import requests
+from requests.adapters import HTTPAdapter
+
+# Local imports
+from system_mapper.provider_azure.azhelper import (
+    az_cli, DEFAULT_PAGE_SIZE, normalize_nulls, paginate, ResourceGraphError,
+    SUCCESS_CODE)
+from system_mapper.provider_azure.throttling import (
+    parse_resets_after, parse_retry_after, QUOTA_RESETS_AFTER_HEADER,
+    RETRY_AFTER_HEADER, ThrottledError)
+
+
+RESOURCE_GRAPH_URL = (
+    'https://management.azure.com/providers/Microsoft.ResourceGraph/'
+    'resources?api-version=2021-03-01')
+
+MANAGEMENT_RESOURCE = 'https://management.azure.com/'
+
+# Renew the tokens this long before they expire
+TOKEN_EXPIRATION_MARGIN = timedelta(minutes=5)
+
+
+class StaticTokenProvider():
+    """Provide always the same access token."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def get_token(self):
+        """Return the access token."""
+        return self.token
+
+
+class AzCliTokenProvider():
+    """
+    Provide access tokens obtained from the az CLI credentials.
+
+    The token is requested once and reused until it is about to expire.
+    """
+
+    def __init__(self, resource=MANAGEMENT_RESOURCE):
+        self.resource = resource
+        self.token = None
+        self.expires_on = None
+        self.lock = threading.Lock()
+
+    def get_token(self):
+        """Return a valid access token."""
+        with self.lock:
+            if (self.token is None or
+                    datetime.now() + TOKEN_EXPIRATION_MARGIN >=
+                    self.expires_on):
+                code, data = az_cli(
+                    ['account', 'get-access-token',
+                     '--resource', self.resource])
+                if code != SUCCESS_CODE:
+                    raise ResourceGraphError(code, data)
+                self.token = data['accessToken']
+                self.expires_on = datetime.strptime(
+                    data['expiresOn'], '%Y-%m-%d %H:%M:%S.%f')
+                logging.info('Access token valid until {date}'.format(
+                    date=self.expires_on))
+            return self.token
+
+
+class ResourceGraphRestClient():
+    """Resource Graph client using the REST API."""
+
+    def __init__(
+            self, endpoint=RESOURCE_GRAPH_URL, token_provider=None,
+            pool_size=10, timeout=60, scheduler=None):
+        self.endpoint = endpoint
+        self.scheduler = scheduler
+        self.token_provider = token_provider or AzCliTokenProvider()
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def query(self, query, subscription=None, first=None, skip_token=None):
+        """
+        Run a query and return one page of the response.
+
+        The response is a dict with the rows under `data` and the
+        continuation token under `$skipToken` when more pages are available.
+        When a scheduler is set the request is paced and retried by it.
+        """
+        if self.scheduler is None:
+            return self._query(
+                query, subscription=subscription, first=first,
+                skip_token=skip_token)
+        return self.scheduler.run(
+            self._query, query, subscription=subscription, first=first,
+            skip_token=skip_token)
+
+    def _query(self, query, subscription=None, first=None, skip_token=None):
+        """Send a query request."""
+        options = {'resultFormat': 'objectArray'}
+        if first is not None:
+            options['$top'] = first
+        if skip_token is not None:
+            options['$skipToken'] = skip_token
+        body = {'query': query, 'options': options}
+        if subscription is not None:
+            body['subscriptions'] = subscription.split()
+        headers = {
+            'Authorization': 'Bearer {token}'.format(
+                token=self.token_provider.get_token())}
+        response = self.session.post(
+            self.endpoint, json=body, headers=headers, timeout=self.timeout)
+        if self.scheduler is not None:
+            self.scheduler.update_quota_from_headers(response.headers)
+        if response.status_code == requests.codes.too_many_requests:
+            # Without valid headers the scheduler backs off
+            retry_after = parse_retry_after(
+                response.headers.get(RETRY_AFTER_HEADER))
+            if retry_after is None:
+                retry_after = parse_resets_after(
+                    response.headers.get(QUOTA_RESETS_AFTER_HEADER))
+            raise ThrottledError(response.text, retry_after=retry_after)
+        if response.status_code != requests.codes.ok:
+            raise ResourceGraphError(response.status_code, response.text)
+        return response.json(object_hook=normalize_nulls)
+
+    def pages(
+            self, query, subscription=None, first=DEFAULT_PAGE_SIZE,
+            stats=None):
+        """Yield the rows of a query page by page."""
+        return paginate(
+            self.query, query, subscription=subscription, first=first,
+            stats=stats)
+
+    def rows(
+            self, query, subscription=None, first=DEFAULT_PAGE_SIZE,
+            stats=None):
+        """Yield the rows of a query one by one."""
+        for page in self.pages(
+                query, subscription=subscription, first=first, stats=stats):
+            for row in page:
+                yield row
+
+    def close(self):
+        """Close the HTTP session."""
+        self.session.close()
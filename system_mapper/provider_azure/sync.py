@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Local manifest of the graph synced from Azure.
+
+The manifest keeps the content hash of each node by uid and the identity
+of each relationship written, so the next sync only applies the changes.
+"""
+# Standard library imports
+import json
+import logging
+import os
+
+# Local imports
+from system_mapper.graph import SyncState
+from system_mapper.provider_azure.cache import (
+    read_json_lines, write_json_lines)
+
+
+DEFAULT_MANIFEST_PATH = 'sync_manifest.jsonl.gz'
+
+
+def load_manifest(path=DEFAULT_MANIFEST_PATH):
+    """Return a sync state with the nodes and relationships of a manifest."""
+    nodes = {}
+    relationships = []
+    if os.path.exists(path):
+        for line in read_json_lines(path):
+            if 'uid' in line:
+                nodes[line['uid']] = line['hash']
+            else:
+                relationships.append(line['relationship'])
+        logging.info('Sync manifest loaded from {path}'.format(path=path))
+    else:
+        logging.info('No sync manifest in {path}, syncing everything'.format(
+            path=path))
+    return SyncState(nodes, relationships)
+
+
+def save_manifest(state, path=DEFAULT_MANIFEST_PATH):
+    """Save the nodes and relationships of the current sync."""
+    def rows():
+        for uid, node_hash in state.nodes.items():
+            yield {'uid': uid, 'hash': node_hash}
+        for identity in sorted(state.relationships):
+            yield {'relationship': identity}
+    write_json_lines(path, rows())
+    logging.info('Sync manifest saved to {path}'.format(path=path))
+
+
+def write_report(report, path):
+    """Write the changes applied by a sync to a JSON file."""
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=4)
+    logging.info('Sync report saved to {path}'.format(path=path))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Throttling aware scheduling of Azure Resource Graph requests.
+
+Resource Graph throttles the requests per user and tenant. The quota left
+and the time until it resets are reported in the response headers.
+"""
+# Standard library imports
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+
+QUOTA_REMAINING_HEADER = 'x-ms-user-quota-remaining'
+
+QUOTA_RESETS_AFTER_HEADER = 'x-ms-user-quota-resets-after'
+
+RETRY_AFTER_HEADER = 'Retry-After'
+
+# Error codes of throttled requests, matched as whole words
+THROTTLING_CODES = re.compile(
+    r'\b(RateLimiting|TooManyRequests|Too Many Requests|Throttled)\b'
+    r'|\b(status|code)\W{0,3}429\b',
+    re.IGNORECASE)
+
+
+class ThrottledError(Exception):
+    """Request rejected because the quota was exceeded."""
+
+    def __init__(self, message='', retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_throttling_error(error):
+    """
+    Return if an error corresponds to a throttled request.
+
+    `error` is either the exception raised by the request, checked by its
+    HTTP status code and message, or the error payload.
+    """
+    response = getattr(error, 'response', None)
+    status_code = getattr(
+        error, 'status_code', getattr(response, 'status_code', None))
+    if status_code == 429:
+        return True
+    return THROTTLING_CODES.search(str(error)) is not None
+
+
+def parse_resets_after(value):
+    """Return the seconds of a `hh:mm:ss` duration header value."""
+    if not value:
+        return None
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds of a `Retry-After` header value, given either as a
+    number of seconds or as an HTTP date, or `None` if it is not valid.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(
+        0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class ThrottlingScheduler():
+    """
+    Pace the requests according to the quota and retry throttled ones.
+
+    At most `max_concurrency` requests are in flight at the same time. When
+    the quota is exhausted new requests wait until it resets. Throttled
+    requests are retried up to `max_retries` times with a jittered
+    exponential backoff.
+    """
+
+    def __init__(
+            self, max_concurrency=4, max_retries=5, base_delay=1.0,
+            max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.quota_remaining = None
+        self.quota_resets_at = None
+        # Metrics
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.throttled = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def update_quota(self, remaining, resets_after=None):
+        """Update the quota using the values reported by the API."""
+        with self.lock:
+            self.quota_remaining = remaining
+            if resets_after is not None:
+                self.quota_resets_at = time.monotonic() + resets_after
+
+    def update_quota_from_headers(self, headers):
+        """
+        Update the quota using the headers of a response, ignoring a
+        malformed quota.
+        """
+        remaining = headers.get(QUOTA_REMAINING_HEADER)
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+        except ValueError:
+            logging.warning('Invalid quota remaining {value!r}'.format(
+                value=remaining))
+            return
+        self.update_quota(
+            remaining,
+            parse_resets_after(headers.get(QUOTA_RESETS_AFTER_HEADER)))
+
+    def quota_delay(self):
+        """Return the seconds to wait before the quota is available."""
+        with self.lock:
+            if (self.quota_remaining is not None and
+                    self.quota_remaining <= 0 and
+                    self.quota_resets_at is not None):
+                return max(0, self.quota_resets_at - time.monotonic())
+        return 0
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before retrying a request."""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func` with the given arguments once a slot is available.
+
+        `func` must raise `ThrottledError` when the request is throttled.
+        """
+        attempt = 0
+        while True:
+            with self.lock:
+                self.queue_depth += 1
+                self.max_queue_depth = max(
+                    self.max_queue_depth, self.queue_depth)
+            with self.semaphore:
+                with self.lock:
+                    self.queue_depth -= 1
+                delay = self.quota_delay()
+                if delay:
+                    logging.info(
+                        'Quota exhausted, waiting {delay:.1f}s'.format(
+                            delay=delay))
+                    time.sleep(delay)
+                start = time.monotonic()
+                try:
+                    return func(*args, **kwargs)
+                except ThrottledError as error:
+                    throttled_error = error
+                finally:
+                    latency = time.monotonic() - start
+                    with self.lock:
+                        self.requests += 1
+                        self.total_latency += latency
+                        self.max_latency = max(self.max_latency, latency)
+            with self.lock:
+                self.throttled += 1
+            attempt += 1
+            if attempt > self.max_retries:
+                raise throttled_error
+            delay = self.backoff_delay(
+                attempt, retry_after=throttled_error.retry_after)
+            logging.warning(
+                'Request throttled, retrying in {delay:.1f}s '
+                '(attempt {attempt})'.format(delay=delay, attempt=attempt))
+            time.sleep(delay)
+
+    def metrics(self):
+        """Return the queue depth, latency and throttling counters."""
+        with self.lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'average_latency': (
+                    self.total_latency / self.requests
+                    if self.requests else 0),
+                'max_latency': self.max_latency,
+                'quota_remaining': self.quota_remaining,
+            }
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Bounded streaming extraction of `web.config` documents.
+
+Only the configured sections are kept, using the same dict layout as
+`xmltodict` (`@` prefixed attributes, `#text` for the text content).
+"""
+# Standard library imports
+import logging
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+
+# Paths of the sections extracted below the `configuration` element
+DEFAULT_SECTIONS = [
+    'connectionStrings', 'appSettings', 'system.serviceModel/bindings']
+
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+
+def local_name(tag):
+    """Return the tag name without namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def element_to_dict(element):
+    """Convert an element to the layout used by `xmltodict`."""
+    value = {
+        '@' + local_name(key): attribute
+        for key, attribute in element.attrib.items()}
+    for child in element:
+        name = local_name(child.tag)
+        child_value = element_to_dict(child)
+        if name in value:
+            if not isinstance(value[name], list):
+                value[name] = [value[name]]
+            value[name].append(child_value)
+        else:
+            value[name] = child_value
+    text = (element.text or '').strip()
+    if not value:
+        return text or None
+    if text:
+        value['#text'] = text
+    return value
+
+
+def parse_web_config(
+        chunks, sections=DEFAULT_SECTIONS, max_size=DEFAULT_MAX_SIZE):
+    """
+    Extract the given sections of a `web.config` document.
+
+    `chunks` is an iterable with the content of the document. The elements
+    outside the sections are discarded while parsing and at most
+    `max_size` bytes are read. When the document is bigger the sections
+    read so far are returned and `@truncated` is set.
+    """
+    wanted = set(tuple(section.split('/')) for section in sections)
+    parser = XMLPullParser(events=('start', 'end'))
+    configuration = {}
+    path = []
+    # Depth of the section being extracted, if any
+    section_depth = None
+    size = 0
+
+    def handle_events():
+        nonlocal section_depth
+        for event, element in parser.read_events():
+            if event == 'start':
+                path.append(local_name(element.tag))
+                if section_depth is None and tuple(path[1:]) in wanted:
+                    section_depth = len(path)
+                continue
+            if section_depth == len(path):
+                # Section complete, keep it below its path
+                parent = configuration
+                for name in path[1:-1]:
+                    parent = parent.setdefault(name, {})
+                parent[path[-1]] = element_to_dict(element)
+                section_depth = None
+            if section_depth is None:
+                element.clear()
+            path.pop()
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if size + len(chunk) > max_size:
+                parser.feed(chunk[:max_size - size])
+                handle_events()
+                logging.warning(
+                    'web.config bigger than {size} bytes, truncated'.format(
+                        size=max_size))
+                configuration['@truncated'] = True
+                break
+            size += len(chunk)
+            parser.feed(chunk)
+            handle_events()
+        else:
+            parser.close()
+            handle_events()
+    except ParseError as e:
+        logging.error('Error parsing web.config: {error}'.format(error=e))
+        configuration['@error'] = str(e)
+    return {'configuration': configuration}
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Stand-in for the neomodel database used to test the graph writes without
+Neo4j.
+"""
+
+
+class FakeDatabase():
+    """
+    Record the queries sent and the transactions opened.
+
+    `answer` is called with each query and its parameters and returns the
+    result rows, by default a single row with a `0`. The queries are kept
+    in `queries` as `(query, params)` tuples and the transaction calls in
+    `transactions` as `'begin'`, `'commit'` or `'rollback'`.
+    """
+
+    def __init__(self, answer=None):
+        self.answer = answer or (lambda query, params: [[0]])
+        self.queries = []
+        self.transactions = []
+
+    def cypher_query(self, query, params=None):
+        self.queries.append((query, params))
+        return self.answer(query, params), None
+
+    def begin(self):
+        self.transactions.append('begin')
+
+    def commit(self):
+        self.transactions.append('commit')
+
+    def rollback(self):
+        self.transactions.append('rollback')
+
+    def matching(self, text):
+        """Return the queries containing `text` with their parameters."""
+        return [
+            (query, params) for query, params in self.queries
+            if text in query]
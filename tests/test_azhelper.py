@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the azure CLI helpers.
+"""
+# Standard library imports
+import json
+import unittest
+from unittest import mock
+
+# Local imports
+from system_mapper.provider_azure import azhelper
+from system_mapper.provider_azure.azhelper import (
+    az_cli, iter_sharded, normalize_nulls, shard_subscriptions)
+
+
+def fake_cli(output, code=0):
+    """Return a stand-in for the az CLI writing the given output."""
+    def invoke(args, out_file):
+        out_file.write(output)
+        return code
+    cli = mock.Mock()
+    cli.invoke.side_effect = invoke
+    return cli
+
+
+class NullsTest(unittest.TestCase):
+    """Replacement of the null values of the decoded responses."""
+
+    def test_nested_nulls(self):
+        data = json.loads(
+            '{"a": null, "b": {"c": null, "d": 1}, '
+            '"e": [null, [null, 2], {"f": null}]}',
+            object_hook=normalize_nulls)
+        self.assertEqual(data, {
+            'a': '', 'b': {'c': '', 'd': 1}, 'e': ['', ['', 2], {'f': ''}]})
+
+    def test_null_text_kept(self):
+        data = json.loads(
+            '{"name": "nullable", "null": "null"}',
+            object_hook=normalize_nulls)
+        self.assertEqual(data, {'name': 'nullable', 'null': 'null'})
+
+    def test_cli_output(self):
+        output = '[{"name": "nullable", "sku": null}, null, [null]]'
+        with mock.patch.object(
+                azhelper, 'get_default_cli', return_value=fake_cli(output)):
+            code, data = az_cli(['graph', 'query'])
+        self.assertEqual(code, 0)
+        self.assertEqual(data, [{'name': 'nullable', 'sku': ''}, '', ['']])
+
+    def test_cli_null_output(self):
+        with mock.patch.object(
+                azhelper, 'get_default_cli', return_value=fake_cli('null')):
+            self.assertEqual(az_cli(['account', 'show']), (0, ''))
+
+
+class ShardingTest(unittest.TestCase):
+    """Queries run over batches of subscriptions."""
+
+    def test_batch_sizes(self):
+        subscriptions = ['s{index}'.format(index=index) for index in range(5)]
+        self.assertEqual(
+            shard_subscriptions(subscriptions, batch_size=2),
+            ['s0 s1', 's2 s3', 's4'])
+        self.assertEqual(
+            shard_subscriptions(subscriptions, batch_size=5),
+            ['s0 s1 s2 s3 s4'])
+        self.assertEqual(shard_subscriptions([], batch_size=2), [])
+
+    def test_rows_deduplicated(self):
+        rows = {
+            's0 s1': [{'id': '/A'}, {'id': '/b'}, {'name': 'no id'}],
+            's2 s3': [{'id': '/a'}, {'id': '/c'}, {'name': 'no id'}],
+            's4': [{'id': '/B'}, {'id': ''}],
+        }
+        calls = []
+
+        def fetch_rows(query, subscription):
+            calls.append((query, subscription))
+            return rows[subscription]
+
+        result = list(iter_sharded(
+            fetch_rows, 'resources', ['s0', 's1', 's2', 's3', 's4'],
+            batch_size=2, max_workers=2))
+        self.assertEqual(sorted(calls), [
+            ('resources', 's0 s1'), ('resources', 's2 s3'),
+            ('resources', 's4')])
+        ids = [row['id'].lower() for row in result if row.get('id')]
+        self.assertEqual(sorted(ids), ['/a', '/b', '/c'])
+        # Rows without id are always kept
+        self.assertEqual(
+            len([row for row in result if not row.get('id')]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the graph writes against a fake database.
+"""
+# Standard library imports
+from collections import OrderedDict
+import unittest
+from unittest import mock
+
+# Local imports
+from tests.fake_database import FakeDatabase
+from tests.fake_servers import use_test_config
+
+use_test_config()
+
+from system_mapper.config import CONFIG  # noqa: E402
+from system_mapper.graph import (  # noqa: E402
+    BaseGraphMapper, Database, Disk, NetworkInterface, Property,
+    RelationshipBatch, SchemaError, Subnet, SyncState, VirtualMachine,
+    VirtualNetwork)
+
+
+class GraphTestCase(unittest.TestCase):
+    """Base of the tests using a mapper with a fake database."""
+
+    def mapper(self, answer=None, **config):
+        patcher = mock.patch.dict(CONFIG, config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        mapper = BaseGraphMapper()
+        mapper.db = FakeDatabase(answer)
+        return mapper
+
+
+class MigrationTest(GraphTestCase):
+    """Migrations of existing graphs."""
+
+    def test_node_storage_not_migrated(self):
+        mapper = self.mapper()
+        mapper.migrate_property_storage('node')
+        self.assertEqual(mapper.db.queries, [])
+
+    def test_unknown_storage(self):
+        mapper = self.mapper()
+        with self.assertRaises(ValueError):
+            mapper.migrate_property_storage('table')
+
+    def test_shared_storage_paged_by_id(self):
+        node_ids = [3, 5, 8, 13, 21]
+
+        def answer(query, params):
+            if 'RETURN id(p) ORDER BY id(p)' in query:
+                return [
+                    [node_id] for node_id in node_ids
+                    if node_id > params['last']][:params['batch_size']]
+            return [[1]]
+
+        mapper = self.mapper(answer, neo4j_migrate_batch_size=2)
+        mapper.migrate_property_storage('shared')
+        pages = mapper.db.matching('RETURN id(p) ORDER BY id(p)')
+        self.assertEqual(
+            [params['last'] for _, params in pages],
+            [-1, 5, 13, 21, -1, 5, 13, 21])
+        self.assertEqual(
+            [params['label_count'] for _, params in pages[:4]], [1] * 4)
+        self.assertEqual(
+            [params['label_count'] for _, params in pages[4:]], [2] * 4)
+        merges = mapper.db.matching('WHERE id(p) IN $ids')
+        self.assertEqual(
+            [params['ids'] for _, params in merges],
+            [[3, 5], [8, 13], [21]] * 2)
+        self.assertEqual(mapper.property_storage, 'shared')
+
+    def test_shared_storage_stuck_page(self):
+        def answer(query, params):
+            if 'RETURN id(p) ORDER BY id(p)' in query:
+                return [[3], [5]]
+            return [[0]]
+
+        mapper = self.mapper(answer, neo4j_migrate_batch_size=2)
+        with self.assertRaises(ValueError):
+            mapper.migrate_property_storage('shared')
+        self.assertEqual(
+            len(mapper.db.matching('RETURN id(p) ORDER BY id(p)')), 2)
+
+    def test_normalize_lookup_keys(self):
+        counts = {}
+
+        def answer(query, params):
+            # Two batches of each key
+            counts[query] = counts.get(query, 0) + 1
+            return [[2 if counts[query] < 3 else 0]]
+
+        mapper = self.mapper(answer, neo4j_migrate_batch_size=2)
+        mapper.normalize_lookup_keys()
+        self.assertEqual(len(mapper.db.queries), 6)
+        for query, params in mapper.db.queries:
+            self.assertIn('LIMIT $batch_size', query)
+            self.assertEqual(params['batch_size'], 2)
+        self.assertEqual(len(mapper.db.matching('n.uid = toLower')), 3)
+
+
+class SchemaTest(GraphTestCase):
+    """Creation of the indexes and constraints."""
+
+    def test_duplicated_uids(self):
+        def answer(query, params):
+            if 'count(n) AS count' in query and ':VirtualMachine)' in query:
+                return [['vm1']]
+            return []
+
+        mapper = self.mapper(answer)
+        with self.assertRaises(SchemaError) as context:
+            mapper.ensure_schema([VirtualMachine, Property])
+        self.assertIn('VirtualMachine.uid=vm1', str(context.exception))
+        self.assertEqual(mapper.db.matching('CREATE'), [])
+
+    def test_missing_indexes_created(self):
+        def answer(query, params):
+            if query.startswith('CALL db.indexes()'):
+                if mapper.db.matching('CREATE'):
+                    return [
+                        ('INDEX ON :Property(key)', 'ONLINE',
+                         'node_label_property'),
+                        ('INDEX ON :VirtualMachine(uid)', 'ONLINE',
+                         'node_unique_property')]
+                return []
+            return []
+
+        mapper = self.mapper(answer)
+        mapper.ensure_schema([VirtualMachine, Property])
+        self.assertEqual(
+            [query for query, _ in mapper.db.matching('CREATE')], [
+                'CREATE CONSTRAINT ON (n:VirtualMachine) '
+                'ASSERT n.uid IS UNIQUE',
+                'CREATE INDEX ON :Property(key)'])
+
+
+class DetachTest(GraphTestCase):
+    """Removal of the relationships of the changed nodes."""
+
+    def test_children_deleted(self):
+        mapper = self.mapper(neo4j_batch_size=2)
+        mapper.detach_nodes(
+            ['/A', '/b', '/c'], [VirtualNetwork, VirtualNetwork],
+            child_relationships=['SUBNET'])
+        self.assertEqual(len(mapper.db.queries), 2)
+        (first, params), (second, _) = mapper.db.queries
+        self.assertIn('MATCH (n:VirtualNetwork) WHERE n.uid IN $uids', first)
+        self.assertIn('(n)-[:SUBNET]->(c)', first)
+        self.assertIn('DETACH DELETE p, c', first)
+        self.assertEqual(params, {
+            'uids': ['/a', '/b'],
+            'kept': ['OBJ_PROPERTY', 'OBJ_TAG', 'SUBNET']})
+
+    def test_nodes_kept(self):
+        mapper = self.mapper()
+        mapper.detach_nodes(['/a'], [NetworkInterface, Subnet])
+        self.assertEqual(len(mapper.db.queries), 2)
+        for query, _ in mapper.db.queries:
+            self.assertNotIn('DETACH DELETE', query)
+            self.assertIn('DELETE r', query)
+
+    def test_shared_nodes_kept(self):
+        mapper = self.mapper(property_storage='shared')
+        mapper.detach_nodes(['/a'], [NetworkInterface])
+        self.assertEqual(len(mapper.db.queries), 1)
+        self.assertNotIn('collect', mapper.db.queries[0][0])
+
+    def test_replaced_shared_properties_deleted(self):
+        mapper = self.mapper(
+            lambda query, params: [[2, [4, 6]]], property_storage='shared')
+        mapper.remove_key_values([1, 2])
+        (remove, params), (delete, delete_params) = mapper.db.queries
+        self.assertIn('DELETE r\n', remove)
+        self.assertIn('collect(DISTINCT id(p))', remove)
+        self.assertEqual(params, {'ids': [1, 2]})
+        self.assertIn('NOT (p)--()', delete)
+        self.assertEqual(delete_params, {'ids': [4, 6]})
+
+    def test_unused_shared_properties_deleted(self):
+        def answer(query, params):
+            if 'collect(DISTINCT id(p))' in query:
+                return [[1, [7, 9] if params['uids'] == ['/a'] else [9]]]
+            return [[1]]
+
+        mapper = self.mapper(
+            answer, neo4j_batch_size=1, property_storage='shared')
+        mapper.detach_nodes(
+            ['/a', '/b'], [VirtualNetwork], child_relationships=['SUBNET'])
+        deletes = mapper.db.matching('NOT (p)--()')
+        self.assertEqual(
+            [params['ids'] for _, params in deletes], [[7], [9]])
+        self.assertNotIn('MATCH (p:Property) WHERE NOT', ''.join(
+            query for query, _ in mapper.db.queries))
+
+
+class SyncTest(GraphTestCase):
+    """Relationships written by a sync."""
+
+    def test_reclassified_endpoint(self):
+        disk = (Disk, {'uid': '/d1'})
+        previous = RelationshipBatch.identity(
+            'DISK', VirtualMachine(uid='/vm1'), disk)
+        mapper = self.mapper()
+        mapper.start_sync_run(sync=SyncState(
+            nodes={'/vm1': 'hash'}, relationships=[previous]))
+        mapper.db.answer = lambda query, params: [[0, [], []]]
+        relationships = RelationshipBatch(sync=mapper.sync)
+        relationships.add('DISK', Database(uid='/vm1'), disk)
+        self.assertEqual(len(relationships), 1)
+
+        mapper.delete_removed_relationships()
+        mapper.create_relationships(relationships)
+        (delete, delete_params), (merge, _) = mapper.db.queries
+        self.assertIn('MATCH (a:VirtualMachine)', delete)
+        self.assertIn('DELETE r', delete)
+        self.assertEqual(delete_params['edges'], [
+            {'from': {'uid': '/vm1'}, 'to': {'uid': '/d1'}}])
+        self.assertIn('MATCH (a:Database)', merge)
+        self.assertIn('MERGE (a)-[r:DISK]->(b)', merge)
+
+    def test_missing_endpoint_not_synced(self):
+        mapper = self.mapper()
+        mapper.start_sync_run(sync=SyncState())
+        relationships = RelationshipBatch(sync=mapper.sync)
+        relationships.add('DISK', VirtualMachine(uid='/vm1'), (Disk, {
+            'uid': '/d1'}))
+        relationships.add('DISK', VirtualMachine(uid='/vm1'), (Disk, {
+            'uid': '/d2'}))
+        missing = RelationshipBatch.identity(
+            'DISK', VirtualMachine(uid='/vm1'), (Disk, {'uid': '/d2'}))
+        mapper.db.answer = lambda query, params: [[1, [], [missing]]]
+
+        not_created = mapper.create_relationships(relationships)
+        self.assertEqual(not_created, [missing])
+        (merge, params), = mapper.db.queries
+        self.assertIn('THEN edge.identity END', merge)
+        self.assertEqual(
+            [edge['identity'] for edge in params['edges']], [
+                RelationshipBatch.identity(
+                    'DISK', VirtualMachine(uid='/vm1'),
+                    (Disk, {'uid': '/d1'})),
+                missing])
+        mapper.sync.forget_relationships(not_created)
+        self.assertNotIn(missing, mapper.sync.relationships)
+        self.assertEqual(len(mapper.sync.relationships), 1)
+
+
+class StagesTest(GraphTestCase):
+    """Mapping stages run in dependency order."""
+
+    def stages(self, calls, failing=()):
+        def stage(name):
+            def run():
+                if name in failing:
+                    raise RuntimeError(name)
+                calls.append(name)
+            return run
+
+        return OrderedDict([
+            ('d', (stage('d'), ['c'])),
+            ('c', (stage('c'), ['a', 'b'])),
+            ('a', (stage('a'), [])),
+            ('b', (stage('b'), [])),
+            ('e', (stage('e'), [])),
+        ])
+
+    def test_dependency_order(self):
+        for workers in [1, 4]:
+            calls = []
+            mapper = self.mapper(neo4j_write_workers=workers)
+            mapper.run_stages(self.stages(calls))
+            self.assertEqual(sorted(calls), ['a', 'b', 'c', 'd', 'e'])
+            self.assertLess(calls.index('a'), calls.index('c'))
+            self.assertLess(calls.index('b'), calls.index('c'))
+            self.assertLess(calls.index('c'), calls.index('d'))
+            # Each stage is committed in its own write batch
+            self.assertEqual(mapper.db.transactions.count('commit'), 5)
+
+    def test_failed_stage_stops_dependents(self):
+        for workers in [1, 4]:
+            calls = []
+            mapper = self.mapper(neo4j_write_workers=workers)
+            with self.assertRaises(RuntimeError):
+                mapper.run_stages(self.stages(calls, failing=['b']))
+            self.assertNotIn('c', calls)
+            self.assertNotIn('d', calls)
+            self.assertIn('rollback', mapper.db.transactions)
+
+    def test_unmet_dependencies(self):
+        mapper = self.mapper()
+        with self.assertRaises(ValueError):
+            mapper.run_stages({'a': (lambda: None, ['missing'])})
+
+
+class WriteBatchTest(GraphTestCase):
+    """Commits of the batched writes."""
+
+    def test_commit_every_size(self):
+        mapper = self.mapper(
+            neo4j_commit_size=3, neo4j_commit_interval=0)
+        with mapper.write_batch():
+            for _ in range(7):
+                mapper.record_operations()
+        self.assertEqual(mapper.db.transactions, [
+            'begin', 'commit', 'begin', 'commit', 'begin', 'commit'])
+        self.assertEqual(mapper.write_metrics()['operations'], 7)
+        self.assertEqual(mapper.write_metrics()['commits'], 3)
+
+    def test_commit_every_interval(self):
+        mapper = self.mapper(
+            neo4j_commit_size=1000, neo4j_commit_interval=5000)
+        now = [0]
+        with mock.patch(
+                'system_mapper.graph.time.monotonic',
+                side_effect=lambda: now[0]):
+            with mapper.write_batch():
+                now[0] = 4
+                mapper.record_operations()
+                self.assertEqual(mapper.db.transactions, ['begin'])
+                now[0] = 6
+                mapper.record_operations()
+                self.assertEqual(
+                    mapper.db.transactions, ['begin', 'commit', 'begin'])
+                now[0] = 10
+                mapper.record_operations()
+        self.assertEqual(mapper.db.transactions, [
+            'begin', 'commit', 'begin', 'commit'])
+
+    def test_single_transaction(self):
+        mapper = self.mapper(neo4j_commit_size=0)
+        with mapper.write_batch():
+            mapper.record_operations(100000)
+        self.assertEqual(mapper.db.transactions, ['begin', 'commit'])
+
+    def test_rolled_back(self):
+        mapper = self.mapper(neo4j_commit_size=2, neo4j_commit_interval=0)
+        with self.assertRaises(RuntimeError):
+            with mapper.write_batch():
+                mapper.record_operations(2)
+                mapper.record_operations()
+                raise RuntimeError('failed')
+        self.assertEqual(mapper.db.transactions, [
+            'begin', 'commit', 'begin', 'rollback'])
+
+    def test_operations_outside_batch(self):
+        mapper = self.mapper(neo4j_commit_size=1)
+        mapper.record_operations(5)
+        self.assertEqual(mapper.db.transactions, [])
+
+
+class ClearTest(GraphTestCase):
+    """Batched deletion of the whole graph."""
+
+    def test_deleted_until_empty(self):
+        remaining = {'relationships': 5, 'Disk': 3, 'Element': 4, None: 1}
+
+        def delete(key, batch_size):
+            count = min(batch_size, remaining[key])
+            remaining[key] -= count
+            return [[count]]
+
+        def answer(query, params):
+            if query == 'CALL db.labels()':
+                return [['Disk'], ['Element']]
+            if query.startswith('MATCH (n:`'):
+                label = query.split('`')[1]
+                if 'RETURN count(n)' in query and 'LIMIT' not in query:
+                    return [[remaining[label]]]
+                return delete(label, params['batch_size'])
+            if 'LIMIT' in query and 'DELETE r' in query:
+                return delete('relationships', params['batch_size'])
+            if 'LIMIT' in query:
+                return delete(None, params['batch_size'])
+            return [[remaining['relationships']]]
+
+        mapper = self.mapper(answer, neo4j_clear_batch_size=2)
+        mapper.clear_database()
+        self.assertEqual(set(remaining.values()), {0})
+        deletes = [
+            (query, params) for query, params in mapper.db.queries
+            if 'LIMIT $batch_size' in query]
+        self.assertTrue(all(
+            params == {'batch_size': 2} for _, params in deletes))
+        # Relationships first, then the largest labels and the unlabeled
+        # nodes, until a batch deletes nothing
+        self.assertEqual([
+            'DELETE r' in query and 'relationships' or
+            (query.split('`')[1] if '`' in query else 'unlabeled')
+            for query, _ in deletes], (
+                ['relationships'] * 4 + ['Element'] * 3 + ['Disk'] * 3 +
+                ['unlabeled'] * 2))
+
+    def test_not_batched(self):
+        mapper = self.mapper(neo4j_clear_batch_size=0)
+        with mock.patch(
+                'system_mapper.graph.clear_neo4j_database') as clear:
+            mapper.clear_database()
+        clear.assert_called_once_with(mapper.db)
+        self.assertEqual(mapper.db.queries, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the IIS application discovery against a fake IIS Administration
+API server.
+"""
+# Standard library imports
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Local imports
+from tests.fake_servers import FakeServer, use_test_config
+
+use_test_config()
+
+from system_mapper.config import CONFIG  # noqa: E402
+from system_mapper.provider_azure.azure_mapper import (  # noqa: E402
+    AzureGraphMapper)
+from system_mapper.provider_azure.iis import PoolClosedError  # noqa: E402
+
+
+WEB_CONFIG = (
+    b'<configuration><appSettings><add key="mode" value="test"/>'
+    b'</appSettings></configuration>')
+
+
+def website_routes(website_ids, broken=()):
+    """Return the routes of a fake IIS API with the given websites."""
+    routes = {'/api/webserver/websites/': (200, {}, {'websites': [
+        {'_links': {'self': {
+            'href': '/api/webserver/websites/{id}'.format(id=website_id)}}}
+        for website_id in website_ids]})}
+    for website_id in website_ids:
+        if website_id in broken:
+            routes['/api/webserver/websites/' + website_id] = None
+            continue
+        routes['/api/webserver/websites/' + website_id] = (200, {}, {
+            'id': website_id, 'name': 'site ' + website_id,
+            '_links': {'files': {
+                'href': '/api/webserver/files/' + website_id}}})
+        routes['/api/webserver/files/' + website_id] = (200, {}, {
+            '_links': {'files': {'href': '/api/files/' + website_id}}})
+        routes['/api/files/' + website_id] = (200, {}, {'files': [{
+            'name': 'web.config',
+            '_links': {'self': {'href': '/api/files/wc' + website_id}}}]})
+        routes['/api/files/wc' + website_id] = (200, {}, {'file_info': {
+            'last_modified': '2020-01-01',
+            '_links': {'self': {'href': '/api/files/wc' + website_id}}}})
+        routes['/api/files/content/wc' + website_id] = (
+            200, {'ETag': '"1"'}, WEB_CONFIG)
+    return routes
+
+
+class IISDiscoveryTest(unittest.TestCase):
+    """Discovery of the applications deployed in the virtual machines."""
+
+    def mapper(self, server, **config):
+        values = {
+            'app_container_url': '/api/webserver/websites/',
+            'app_container_scheme': 'http',
+            'port': server.port,
+            'database_strings': [],
+        }
+        values.update(config)
+        patcher = mock.patch.dict(CONFIG, values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return AzureGraphMapper()
+
+    def virtual_machine(self, vm_id):
+        return {
+            'id': vm_id, 'publicIpAddress': '', 'privateIpAddress':
+            '127.0.0.1', 'properties': {}}
+
+    def test_applications(self):
+        with FakeServer(website_routes(['1', '2'])) as server:
+            mapper = self.mapper(server)
+            applications = mapper.get_applications_data(
+                [self.virtual_machine('vm1')])
+        self.assertEqual(len(applications), 1)
+        self.assertEqual(applications[0]['virtual_machine_id'], 'vm1')
+        websites = applications[0]['applications']
+        self.assertEqual([website['id'] for website in websites], ['1', '2'])
+        self.assertEqual(websites[0]['web_config'], {'configuration': {
+            'appSettings': {'add': {'@key': 'mode', '@value': 'test'}}}})
+
+    def test_web_config_truncated(self):
+        with FakeServer(website_routes(['1'])) as server:
+            mapper = self.mapper(server, web_config_max_size=20)
+            applications = mapper.get_applications_data(
+                [self.virtual_machine('vm1')])
+        website, = applications[0]['applications']
+        self.assertEqual(
+            website['web_config'], {'configuration': {'@truncated': True}})
+
+    def test_failed_websites_skipped(self):
+        routes = website_routes(['1', '2', '3'], broken=['2'])
+        with FakeServer(routes) as server:
+            mapper = self.mapper(server)
+            applications = mapper.get_applications_data(
+                [self.virtual_machine('vm1')])
+        websites = applications[0]['applications']
+        self.assertEqual([website['id'] for website in websites], ['1', '3'])
+
+    def test_circuit_opens(self):
+        routes = website_routes(
+            ['1', '2', '3', '4'], broken=['1', '2', '3', '4'])
+        with FakeServer(routes) as server:
+            mapper = self.mapper(server, app_container_failure_threshold=2)
+            applications = mapper.get_applications_data(
+                [self.virtual_machine('vm1')])
+            paths = server.paths()
+        self.assertEqual(applications[0]['applications'], [])
+        # The websites after the threshold are not requested
+        self.assertEqual(paths, [
+            '/api/webserver/websites/', '/api/webserver/websites/1',
+            '/api/webserver/websites/2'])
+
+    def test_circuit_keeps_fetched_websites(self):
+        routes = website_routes(
+            ['1', '2', '3', '4', '5'], broken=['3', '4'])
+        with FakeServer(routes) as server:
+            mapper = self.mapper(server, app_container_failure_threshold=2)
+            mapper.iis_sessions.open()
+            failed = []
+            websites = mapper.fetch_app_data('127.0.0.1', failed=failed)
+            paths = server.paths()
+        self.assertEqual([website['id'] for website in websites], ['1', '2'])
+        self.assertEqual(
+            [website['_links']['self']['href'] for website in failed], [
+                '/api/webserver/websites/3', '/api/webserver/websites/4',
+                '/api/webserver/websites/5'])
+        self.assertNotIn('/api/webserver/websites/5', paths)
+
+    def test_closed_sessions(self):
+        with FakeServer(website_routes(['1'])) as server:
+            mapper = self.mapper(server)
+            mapper.get_applications_data([self.virtual_machine('vm1')])
+            with self.assertRaises(PoolClosedError):
+                mapper.iis_sessions.get('127.0.0.1', '/')
+
+    def test_partial_results_not_cached(self):
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        routes = website_routes(['1', '2'], broken=['2'])
+        with FakeServer(routes) as server:
+            mapper = self.mapper(server, cache_path=cache_path)
+            first = mapper.get_app_data('127.0.0.1')
+            routes.update(website_routes(['1', '2']))
+            second = mapper.get_app_data('127.0.0.1')
+            third = mapper.get_app_data('127.0.0.1')
+            paths = server.paths()
+        self.assertEqual([website['id'] for website in first], ['1'])
+        self.assertEqual([website['id'] for website in second], ['1', '2'])
+        self.assertEqual(third, second)
+        # The complete result is taken from the cache the third time
+        self.assertEqual(paths.count('/api/webserver/websites/'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the incremental ingestion helpers.
+"""
+# Standard library imports
+from datetime import datetime
+import unittest
+from unittest import mock
+
+# Local imports
+from tests.fake_database import FakeDatabase
+from tests.fake_servers import use_test_config
+
+use_test_config()
+
+from system_mapper.config import CONFIG  # noqa: E402
+from system_mapper.provider_azure.azure_mapper import (  # noqa: E402
+    AzureGraphMapper, mapping_mode, RESOURCES_KEYS, run_mapper)
+from system_mapper.provider_azure.incremental import (  # noqa: E402
+    expired_watermarks, split_changes)
+
+
+class WatermarksTest(unittest.TestCase):
+    """Detection of the watermarks older than the changes retention."""
+
+    def test_expired_watermarks(self):
+        watermarks = {
+            'recent': '2020-01-10T00:00:00Z', 'old': '2019-12-20T00:00:00Z'}
+        self.assertEqual(
+            expired_watermarks(watermarks, 14, now=datetime(2020, 1, 12)),
+            ['old'])
+
+    def test_last_change_wins(self):
+        changed, deleted = split_changes([
+            {'targetResourceId': '/A', 'changeType': 'Create'},
+            {'targetResourceId': '/a', 'changeType': 'Delete'},
+            {'targetResourceId': '/B', 'changeType': 'Delete'},
+            {'targetResourceId': '/b', 'changeType': 'Update'}])
+        self.assertEqual(changed, {'/b'})
+        self.assertEqual(deleted, {'/a'})
+
+
+class IncrementalRunTest(unittest.TestCase):
+    """Incremental mapping runs."""
+
+    def test_reset_ignored(self):
+        patcher = mock.patch.dict(CONFIG, {'neo4j_ensure_schema': False})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        mapper = AzureGraphMapper()
+        mapper.db = FakeDatabase()
+        data = {key: [] for key in RESOURCES_KEYS}
+        data.update(
+            subscriptions=[], resource_groups=[], deleted_ids=['/old'])
+        with mock.patch.object(
+                mapper, 'get_data', return_value=data) as get_data, \
+                mock.patch.object(mapper, 'clear_database') as clear, \
+                mock.patch.object(mapper, 'map_resources'), \
+                mock.patch.object(mapper, 'save_watermarks'):
+            mapper.map_data(reset=True, incremental=True)
+        get_data.assert_called_once_with(incremental=True)
+        clear.assert_not_called()
+        self.assertTrue(mapper.db.matching('n.uid IN $uids'))
+
+
+class MappingModeTest(unittest.TestCase):
+    """Flags used by the mapping runs."""
+
+    def test_graph_cleared(self):
+        def clear(**options):
+            values = dict(
+                reset=True, incremental=False, replay=None, upsert=False,
+                sync=False)
+            values.update(options)
+            return mapping_mode(**values)[3]
+
+        self.assertTrue(clear())
+        self.assertTrue(clear(incremental=True, replay='snapshot.json.gz'))
+        self.assertFalse(clear(reset=False))
+        self.assertFalse(clear(incremental=True))
+        # Upserts keep the graph even with reset
+        self.assertFalse(clear(upsert=True))
+        self.assertFalse(clear(sync=True))
+
+    def test_migrated_unless_cleared(self):
+        for options, migrated in [
+                ({}, False), ({'upsert': True}, True),
+                ({'sync': True}, True), ({'reset': False}, True)]:
+            with mock.patch(
+                    'system_mapper.provider_azure.azure_mapper.'
+                    'AzureGraphMapper') as mapper_class:
+                run_mapper(migrate=True, **options)
+            mapper = mapper_class.return_value
+            self.assertEqual(
+                mapper.migrate_property_storage.called, migrated, options)
+
+
+if __name__ == '__main__':
+    unittest.main()
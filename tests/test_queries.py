@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the Resource Graph queries.
+"""
+# Standard library imports
+import unittest
+
+# Local imports
+from system_mapper.provider_azure.queries import (
+    consolidated_query, partition_by_type, projected_queries,
+    RESOURCE_GRAPH_QUERIES, RESOURCE_TYPES)
+
+
+# Fields of `properties` read by the mappings, by data key
+MAPPED_PROPERTIES = {
+    'app_services': ['serverFarmId'],
+    'load_balancers': ['backendAddressPools', 'frontendIPConfigurations'],
+    'network_interfaces': ['ipConfigurations'],
+    'network_security_groups': ['networkInterfaces'],
+    'virtual_networks': ['subnets'],
+}
+
+# Columns read by the mappings from every resource row
+MAPPED_COLUMNS = [
+    'id', 'name', 'type', 'resourceGroup', 'subscriptionId', 'tags']
+
+
+class PartitionTest(unittest.TestCase):
+    """Rows of a consolidated query split by data key."""
+
+    def test_partition_by_type(self):
+        rows = [
+            {'id': '/disk1', 'type': 'microsoft.compute/disks'},
+            {'id': '/db1', 'type': 'Microsoft.Sql/servers/databases'},
+            {'id': '/server1', 'type': 'microsoft.sql/servers'},
+            {'id': '/disk2', 'type': 'MICROSOFT.COMPUTE/DISKS'},
+            {'id': '/other', 'type': 'microsoft.web/certificates'},
+        ]
+        data = partition_by_type(rows, RESOURCE_TYPES)
+        self.assertEqual(list(data), list(RESOURCE_TYPES))
+        self.assertEqual(
+            [row['id'] for row in data['disks']], ['/disk1', '/disk2'])
+        self.assertEqual([row['id'] for row in data['databases']], ['/db1'])
+        self.assertEqual(
+            [row['id'] for row in data['databases_servers']], ['/server1'])
+        self.assertEqual(data['app_services'], [])
+        self.assertEqual(sum(len(rows) for rows in data.values()), 4)
+
+    def test_consolidated_query(self):
+        query = consolidated_query(RESOURCE_TYPES)
+        self.assertTrue(query.startswith('resources | where type in~ ('))
+        for resource_type in RESOURCE_TYPES.values():
+            self.assertIn('"{type}"'.format(type=resource_type), query)
+        self.assertNotIn('project', query)
+
+
+class ProjectionTest(unittest.TestCase):
+    """Projection of the columns used by the mapper."""
+
+    def test_mapped_columns_kept(self):
+        queries = projected_queries(RESOURCE_GRAPH_QUERIES)
+        self.assertEqual(list(queries), list(RESOURCE_GRAPH_QUERIES))
+        for key in RESOURCE_TYPES:
+            project = queries[key].split('| project ', 1)[1]
+            columns = project.split(', properties = ')[0].split(', ')
+            for column in MAPPED_COLUMNS:
+                self.assertIn(column, columns, key)
+            for field in MAPPED_PROPERTIES.get(key, []):
+                self.assertIn(
+                    "'{field}', properties.{field}".format(field=field),
+                    project, key)
+
+    def test_queries_without_spec_unchanged(self):
+        queries = projected_queries(RESOURCE_GRAPH_QUERIES)
+        for key in ['subscriptions', 'resource_groups', 'virtual_machines']:
+            self.assertEqual(queries[key], RESOURCE_GRAPH_QUERIES[key])
+
+    def test_consolidated_projection(self):
+        query = consolidated_query(RESOURCE_TYPES, project=True)
+        self.assertIn("type =~ 'microsoft.web/sites', pack(", query)
+        self.assertIn("'serverFarmId', properties.serverFarmId", query)
+        # Rows of types without spec keep their properties
+        self.assertIn(', properties)', query)
+
+
+if __name__ == '__main__':
+    unittest.main()
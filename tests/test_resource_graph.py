@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the Resource Graph REST backend against a local stand-in server.
+"""
+# Standard library imports
+import json
+import unittest
+from unittest import mock
+
+# Local imports
+from tests.fake_servers import FakeServer, use_test_config
+
+use_test_config()
+
+from system_mapper.config import CONFIG  # noqa: E402
+from system_mapper.provider_azure import azure_mapper  # noqa: E402
+from system_mapper.provider_azure.azure_mapper import (  # noqa: E402
+    AzureGraphMapper)
+from system_mapper.provider_azure.resource_graph import (  # noqa: E402
+    ResourceGraphRestClient, StaticTokenProvider)
+from system_mapper.provider_azure.throttling import (  # noqa: E402
+    ThrottlingScheduler)
+
+
+def resource_graph_route(path, body):
+    """Answer the queries with one subscription and one paged disk."""
+    request = json.loads(body.decode('utf-8'))
+    query = request['query']
+    if '"microsoft.resources/subscriptions"' in query:
+        return 200, {}, {'data': [{'subscriptionId': 'sub1'}]}
+    if '"microsoft.compute/disks"' in query:
+        if '$skipToken' not in request['options']:
+            return 200, {}, {'data': [{'id': 'disk1'}], '$skipToken': 't'}
+        return 200, {}, {'data': [{'id': 'disk2'}]}
+    return 200, {}, {'data': []}
+
+
+class RestBackendTest(unittest.TestCase):
+    """Data retrieval with the REST backend and a configured token."""
+
+    def mapper(self, server):
+        patcher = mock.patch.dict(CONFIG, {
+            'resource_graph_backend': 'rest',
+            'resource_graph_endpoint': server.url + '/resources',
+            'resource_graph_token': 'test-token',
+            'get_app_container_info': False,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return AzureGraphMapper()
+
+    def test_get_data(self):
+        with FakeServer({'/resources': resource_graph_route}) as server:
+            mapper = self.mapper(server)
+            with mock.patch.object(
+                    azure_mapper, 'az_cli') as az_cli, mock.patch.object(
+                        azure_mapper, 'az_login') as az_login, \
+                    mock.patch.object(
+                        mapper.resource_graph_client, 'close',
+                        wraps=mapper.resource_graph_client.close) as close:
+                data = mapper.get_data()
+        az_login.assert_not_called()
+        az_cli.assert_not_called()
+        close.assert_called_once_with()
+        self.assertEqual(mapper.subscriptions, ['sub1'])
+        self.assertEqual(
+            [disk['id'] for disk in data['disks']], ['disk1', 'disk2'])
+        self.assertEqual(
+            set(headers['Authorization']
+                for _, _, headers, _ in server.requests),
+            {'Bearer test-token'})
+
+    def test_pages_logged_by_query(self):
+        with FakeServer({'/resources': resource_graph_route}) as server:
+            mapper = self.mapper(server)
+            with self.assertLogs(level='INFO') as logs:
+                mapper.get_data()
+        self.assertIn(
+            'INFO:root:Retrieved page 2 of disks (1 rows)', logs.output)
+        self.assertIn(
+            'INFO:root:Query disks finished: 2 pages, 2 rows', logs.output)
+
+
+class ThrottledRestTest(unittest.TestCase):
+    """Throttled REST requests with malformed headers."""
+
+    def test_malformed_headers_retried(self):
+        responses = [
+            (429, {'Retry-After': 'soon',
+                   'x-ms-user-quota-remaining': 'none'}, {}),
+            (200, {}, {'data': [{'id': 'disk1'}]})]
+
+        def route(path, body):
+            return responses.pop(0)
+
+        with FakeServer({'/resources': route}) as server, mock.patch(
+                'system_mapper.provider_azure.throttling.time.sleep') as sleep:
+            client = ResourceGraphRestClient(
+                endpoint=server.url + '/resources',
+                token_provider=StaticTokenProvider('test-token'),
+                scheduler=ThrottlingScheduler(base_delay=0.5))
+            response = client.query('Resources')
+            client.close()
+        self.assertEqual(response['data'], [{'id': 'disk1'}])
+        self.assertEqual(len(server.requests), 2)
+        # Backoff used instead of the invalid Retry-After
+        (delay,), _ = sleep.call_args
+        self.assertTrue(0.5 <= delay <= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the throttling aware scheduling of Resource Graph requests.
+"""
+# Standard library imports
+import unittest
+from unittest import mock
+
+# Local imports
+from system_mapper.provider_azure.throttling import (
+    parse_retry_after, QUOTA_REMAINING_HEADER, QUOTA_RESETS_AFTER_HEADER,
+    ThrottledError, ThrottlingScheduler)
+
+
+class RetryAfterTest(unittest.TestCase):
+    """Parsing of the `Retry-After` header."""
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertEqual(parse_retry_after('-1'), 0.0)
+
+    def test_http_date(self):
+        self.assertEqual(
+            parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertGreater(
+            parse_retry_after('Wed, 21 Oct 2099 07:28:00 GMT'), 0)
+
+    def test_malformed(self):
+        for value in ['', None, 'soon', 'inf', 'Mon, 99 Foo']:
+            self.assertIsNone(parse_retry_after(value), value)
+
+
+class SchedulerTest(unittest.TestCase):
+    """Pacing and retries of the scheduler."""
+
+    def setUp(self):
+        patcher = mock.patch(
+            'system_mapper.provider_azure.throttling.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retried_until_success(self):
+        func = mock.Mock(side_effect=[
+            ThrottledError('throttled', retry_after=2),
+            ThrottledError('throttled'), 'rows'])
+        scheduler = ThrottlingScheduler(max_retries=3, base_delay=1.0)
+        self.assertEqual(scheduler.run(func, 'query', first=10), 'rows')
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with('query', first=10)
+        # Retry-After first, then the exponential backoff
+        (first,), (second,) = [args for args, _ in self.sleep.call_args_list]
+        self.assertTrue(2 <= first <= 3)
+        self.assertTrue(1 <= second <= 4)
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['throttled'], 2)
+
+    def test_gives_up(self):
+        error = ThrottledError('throttled')
+        func = mock.Mock(side_effect=error)
+        scheduler = ThrottlingScheduler(max_retries=2)
+        with self.assertRaises(ThrottledError) as context:
+            scheduler.run(func)
+        self.assertIs(context.exception, error)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_waits_for_quota(self):
+        scheduler = ThrottlingScheduler()
+        scheduler.update_quota_from_headers({
+            QUOTA_REMAINING_HEADER: '0',
+            QUOTA_RESETS_AFTER_HEADER: '00:00:05'})
+        self.assertEqual(scheduler.run(lambda: 'rows'), 'rows')
+        (delay,), _ = self.sleep.call_args
+        self.assertTrue(4 < delay <= 5)
+
+    def test_malformed_quota_ignored(self):
+        scheduler = ThrottlingScheduler()
+        scheduler.update_quota_from_headers({QUOTA_REMAINING_HEADER: 'n/a'})
+        self.assertIsNone(scheduler.quota_remaining)
+        self.assertEqual(scheduler.run(lambda: 'rows'), 'rows')
+        self.sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
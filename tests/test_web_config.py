@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Licensed under the terms of the MIT License
+"""
+Tests of the bounded streaming extraction of web.config documents.
+"""
+# Standard library imports
+import unittest
+
+# Local imports
+from system_mapper.provider_azure.web_config import parse_web_config
+
+
+WEB_CONFIG = (
+    b'<?xml version="1.0"?>'
+    b'<configuration xmlns="urn:test">'
+    b'<appSettings><add key="mode" value="test"/>'
+    b'<add key="debug" value="false"/></appSettings>'
+    b'<system.web><compilation debug="true"/></system.web>'
+    b'<system.serviceModel><bindings><basicHttpBinding>'
+    b'<binding name="default"/></basicHttpBinding></bindings>'
+    b'<services><service name="ignored"/></services>'
+    b'</system.serviceModel>'
+    b'<connectionStrings><add name="db" connectionString="Server=db"/>'
+    b'</connectionStrings>'
+    b'</configuration>')
+
+
+def chunked(content, size):
+    """Split a document in chunks of the given size."""
+    return [content[index:index + size]
+            for index in range(0, len(content), size)]
+
+
+class WebConfigTest(unittest.TestCase):
+    """Extraction of the configured sections."""
+
+    def test_sections_filtered(self):
+        configuration = parse_web_config(chunked(WEB_CONFIG, 7))[
+            'configuration']
+        self.assertEqual(
+            sorted(configuration),
+            ['appSettings', 'connectionStrings', 'system.serviceModel'])
+        self.assertEqual(configuration['appSettings'], {'add': [
+            {'@key': 'mode', '@value': 'test'},
+            {'@key': 'debug', '@value': 'false'}]})
+        # Only the configured path of a nested section is kept
+        self.assertEqual(configuration['system.serviceModel'], {
+            'bindings': {'basicHttpBinding': {
+                'binding': {'@name': 'default'}}}})
+
+    def test_custom_sections(self):
+        configuration = parse_web_config(
+            [WEB_CONFIG], sections=['system.web'])['configuration']
+        self.assertEqual(configuration, {'system.web': {
+            'compilation': {'@debug': 'true'}}})
+
+    def test_truncated_at_max_size(self):
+        end = WEB_CONFIG.index(b'<system.web>')
+        configuration = parse_web_config(
+            chunked(WEB_CONFIG, 10), max_size=end + 5)['configuration']
+        self.assertTrue(configuration['@truncated'])
+        # Only the sections complete before the limit are kept
+        self.assertEqual(sorted(configuration), ['@truncated', 'appSettings'])
+
+    def test_whole_document_read(self):
+        configuration = parse_web_config(
+            chunked(WEB_CONFIG, 10), max_size=len(WEB_CONFIG))[
+                'configuration']
+        self.assertNotIn('@truncated', configuration)
+        self.assertIn('connectionStrings', configuration)
+
+    def test_invalid_document(self):
+        configuration = parse_web_config(
+            [b'<configuration><appSettings></configuration>'])[
+                'configuration']
+        self.assertIn('@error', configuration)
+
+
+if __name__ == '__main__':
+    unittest.main()